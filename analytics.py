@@ -0,0 +1,171 @@
+from datetime import date
+
+import numpy as np
+
+from assets import COLUMN
+
+# Позиции символов ДД.ММ.ГГГГ, из которых собирается ГГГГ-ММ-ДД
+_ISO_ORDER = [6, 7, 8, 9, 2, 3, 4, 5, 0, 1]
+
+
+# Числа из таблицы ("10.0", "1250,50", "-") -> float64, пропуски -> nan
+def parse_numbers(values):
+    if not len(values):
+        return np.empty(0, dtype=np.float64)
+    values = np.char.replace(np.asarray(values, dtype=str), ",", ".")
+    values[(values == "-") | (values == "")] = "nan"
+    try:
+        return values.astype(np.float64)
+    except ValueError:
+        return np.array([_to_float(value) for value in values], dtype=np.float64)
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return np.nan
+
+
+# Даты ДД.ММ.ГГГГ -> номер дня от 1970-01-01 (float64), пропуски -> nan.
+# Разбор идет перестановкой символов во всем массиве сразу, без strptime на строку.
+def parse_dates(values):
+    if not len(values):
+        return np.empty(0, dtype=np.float64)
+    values = np.asarray(values, dtype="U10")
+    chars = values.view("U1").reshape(len(values), 10)
+    valid = (chars[:, 2] == ".") & (chars[:, 5] == ".")
+    iso = np.ascontiguousarray(chars[:, _ISO_ORDER])
+    iso[:, 4] = "-"
+    iso[:, 7] = "-"
+    iso = iso.view("U10").ravel()
+    iso[~valid] = "NaT"
+    try:
+        days = iso.astype("datetime64[D]")
+    except ValueError:
+        days = np.array([_to_day(value) for value in iso], dtype="datetime64[D]")
+    result = days.astype(np.float64)
+    result[np.isnat(days)] = np.nan
+    return result
+
+
+def _to_day(value):
+    try:
+        return np.datetime64(value, "D")
+    except ValueError:
+        return np.datetime64("NaT")
+
+
+# Позиции пользователя в виде колонок NumPy
+class Portfolio:
+    def __init__(self, rows):
+        columns = list(zip(*rows)) if rows else [()] * len(COLUMN)
+        self.names = np.asarray(columns[COLUMN["asset_name"]], dtype=object)
+        self.currency = np.asarray(columns[COLUMN["currency"]], dtype=str)
+        self.amount = parse_numbers(columns[COLUMN["asset_amount"]])
+        self.entry_price = parse_numbers(columns[COLUMN["entry_price"]])
+        self.exit_price = parse_numbers(columns[COLUMN["exit_price"]])
+        self.entry_day = parse_dates(columns[COLUMN["entry_date"]])
+        self.exit_day = parse_dates(columns[COLUMN["exit_date"]])
+
+    def __len__(self):
+        return len(self.amount)
+
+    # Показатели по каждой позиции сразу для всех строк.
+    # current_price - текущие цены открытых позиций (nan, если котировки нет).
+    def metrics(self, current_price=None, today=None):
+        today = float(np.datetime64(today or date.today(), "D").astype(np.int64))
+        if current_price is None:
+            current_price = np.full(len(self), np.nan)
+        closed = ~np.isnan(self.exit_price)
+        cost = self.amount * self.entry_price
+        price = np.where(closed, self.exit_price, current_price)
+        pnl = (price - self.entry_price) * self.amount
+        end_day = np.where(np.isnan(self.exit_day), today, self.exit_day)
+        holding_days = end_day - self.entry_day
+        with np.errstate(divide="ignore", invalid="ignore"):
+            total_return = price / self.entry_price - 1
+            annualized = np.where(
+                holding_days > 0,
+                np.power(1 + total_return, 365.0 / holding_days) - 1,
+                np.nan
+            )
+        return {
+            "closed": closed,
+            "cost": cost,
+            "realized_pnl": np.where(closed, pnl, 0.0),
+            "unrealized_pnl": np.where(closed, 0.0, pnl),
+            "holding_days": holding_days,
+            "return": total_return,
+            "annualized_return": annualized,
+        }
+
+    # Итоги всего портфеля в валюте base по курсам на даты сделок (rates - fx.RateTable):
+    # вложения по курсу на дату входа, выручка по курсу на дату выхода,
+    # открытые позиции по текущим ценам и курсу на сегодня.
+    def in_currency(self, rates, base, current_price=None, today=None):
+        today = np.datetime64(today or date.today(), "D")
+        if current_price is None:
+            current_price = np.full(len(self), np.nan)
+        metrics = self.metrics(current_price, today)
+        closed = metrics["closed"]
+        today_day = np.full(len(self), float(today.astype(np.int64)))
+        cost = rates.convert(metrics["cost"], self.currency, self.entry_day, base)
+        proceeds = rates.convert(self.amount * self.exit_price, self.currency, self.exit_day, base)
+        value = rates.convert(self.amount * current_price, self.currency, today_day, base)
+        realized = np.where(closed, proceeds - cost, np.nan)
+        unrealized = np.where(closed, np.nan, value - cost)
+        quoted = ~closed & ~np.isnan(unrealized)
+        return {
+            "currency": base,
+            "positions": len(self),
+            "converted": int(np.count_nonzero(~np.isnan(cost))),
+            "invested": float(np.nansum(cost)),
+            "realized_pnl": float(np.nansum(realized)),
+            "unrealized_pnl": float(np.nansum(unrealized)) if quoted.any() or closed.all() else None,
+        }
+
+    # Итоги по валютам: суммы через bincount, без цикла по строкам
+    def summary(self, current_price=None, today=None):
+        metrics = self.metrics(current_price, today)
+        currencies, index = np.unique(self.currency, return_inverse=True)
+        size = len(currencies)
+
+        def total(values, mask=None):
+            values = np.nan_to_num(values) if mask is None else np.where(mask, np.nan_to_num(values), 0.0)
+            return np.bincount(index, weights=values, minlength=size)
+
+        closed = metrics["closed"]
+        has_quote = ~closed & ~np.isnan(metrics["unrealized_pnl"])
+        annualized_known = ~np.isnan(metrics["annualized_return"])
+        days_known = ~np.isnan(metrics["holding_days"])
+        weighted_cost = np.where(annualized_known, np.nan_to_num(metrics["cost"]), 0.0)
+
+        positions = np.bincount(index, minlength=size)
+        open_positions = np.bincount(index, weights=~closed, minlength=size)
+        quoted = np.bincount(index, weights=has_quote, minlength=size)
+        invested = total(metrics["cost"])
+        closed_cost = total(metrics["cost"], closed)
+        realized = total(metrics["realized_pnl"])
+        unrealized = total(metrics["unrealized_pnl"], has_quote)
+        days_sum = total(metrics["holding_days"], days_known)
+        days_count = np.bincount(index, weights=days_known, minlength=size)
+        annualized_sum = total(metrics["annualized_return"] * weighted_cost, annualized_known)
+        annualized_weight = np.bincount(index, weights=weighted_cost, minlength=size)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return [
+                {
+                    "currency": str(currencies[i]),
+                    "positions": int(positions[i]),
+                    "open_positions": int(open_positions[i]),
+                    "invested": float(invested[i]),
+                    "realized_pnl": float(realized[i]),
+                    "realized_return": float(realized[i] / closed_cost[i]) if closed_cost[i] else None,
+                    "unrealized_pnl": float(unrealized[i]) if quoted[i] or not open_positions[i] else None,
+                    "avg_holding_days": float(days_sum[i] / days_count[i]) if days_count[i] else None,
+                    "annualized_return": float(annualized_sum[i] / annualized_weight[i])
+                    if annualized_weight[i] else None,
+                }
+                for i in range(size)
+            ]
@@ -0,0 +1,83 @@
+# Поля одного актива в данных анкеты (FSM) в порядке колонок таблицы
+ASSET_FIELDS = (
+    "asset_group", "asset_subgroup", "asset_name", "asset_amount", "currency",
+    "entry_date", "entry_price", "exit_date", "exit_price", "image_url"
+)
+
+
+# Колонки строки в таблице: поля актива, затем контакты пользователя,
+# его Telegram id (по нему бот находит строки пользователя) и время отправки
+# анкеты "ДД.ММ.ГГГГ ЧЧ:ММ:СС"
+ROW_FIELDS = ASSET_FIELDS + ("contact_name", "contact_email", "contact_phone", "username", "user_id", "submitted_at")
+COLUMN = {field: index for index, field in enumerate(ROW_FIELDS)}
+
+
+# Один заполненный актив. Между шагами анкеты хранится в FSM компактным
+# списком значений (to_list/from_list), чтобы данные оставались
+# сериализуемыми для любого хранилища состояний.
+class AssetRecord:
+    __slots__ = ASSET_FIELDS
+
+    def __init__(self, *values):
+        for field, value in zip(ASSET_FIELDS, values):
+            setattr(self, field, value)
+
+    @classmethod
+    def from_data(cls, data):
+        return cls(*(data.get(field, '') for field in ASSET_FIELDS))
+
+    @classmethod
+    def from_list(cls, values):
+        return cls(*values)
+
+    def to_list(self):
+        return [getattr(self, field) for field in ASSET_FIELDS]
+
+    def to_data(self):
+        return dict(zip(ASSET_FIELDS, self.to_list()))
+
+    # Строка для Google Sheets: актив + контакты пользователя
+    def to_row(self, contact_name, contact_email, phone, username, user_id, submitted_at):
+        return [
+            self.asset_group[2:],  # Убираем эмодзи
+            self.asset_subgroup[2:],  # Убираем эмодзи
+            self.asset_name,
+            self.asset_amount,
+            self.currency,
+            self.entry_date,
+            self.entry_price,
+            self.exit_date,
+            self.exit_price,
+            self.image_url,
+            contact_name,
+            contact_email,
+            phone,
+            username,
+            str(user_id),
+            submitted_at.strftime("%d.%m.%Y %H:%M:%S")
+        ]
+
+
+# Переносит текущий актив из полей анкеты в список готовых активов
+def push_asset(data):
+    data = dict(data)
+    record = AssetRecord.from_data(data)
+    for field in ASSET_FIELDS:
+        data.pop(field, None)
+    data["assets"] = data.get("assets", []) + [record.to_list()]
+    return data
+
+
+# Обратная операция: последний готовый актив снова становится текущим
+# (пользователь нажал "Назад" после сохранения актива)
+def pop_asset(data):
+    data = dict(data)
+    assets = list(data.get("assets", []))
+    if assets:
+        data.update(AssetRecord.from_list(assets.pop()).to_data())
+        data["assets"] = assets
+    return data
+
+
+def load_assets(data):
+    return [AssetRecord.from_list(values) for values in data.get("assets", [])]
@@ -0,0 +1,295 @@
+import abc
+import asyncio
+import functools
+import logging
+import queue
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from assets import ROW_FIELDS
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ("sheets", "sql", "memory")
+
+
+# Хранилище строк анкет, в которое пишет очередь записи (WriteBehindQueue)
+# и из которого локальная копия (SheetMirror) докачивает строки. Строки
+# нумеруются как в листе: первая - заголовок, данные начинаются со второй.
+# append_rows возвращает ответ в формате Sheets API ("updates.updatedRange"),
+# по которому копия узнает номера записанных строк. Бэкенд без любого из
+# абстрактных методов не создается.
+class RowStorage(abc.ABC):
+    # Шарды для чтения: [(смещение номеров строк в локальной копии, шард)]
+    def shards(self):
+        return [(0, None)]
+
+    # Пачка из журнала [(id, строка)] по шардам: [(ключ шарда, часть пачки)]
+    def partition(self, batch):
+        return [(None, batch)]
+
+    @abc.abstractmethod
+    async def ensure_header(self, header):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def append_rows(self, rows, key=None):
+        raise NotImplementedError
+
+    # Число строк вместе с заголовком
+    @abc.abstractmethod
+    async def count_rows(self, shard=None):
+        raise NotImplementedError
+
+    # Строки с first по last включительно
+    @abc.abstractmethod
+    async def get_rows(self, first, last, shard=None):
+        raise NotImplementedError
+
+    # Фоновое обслуживание подключения; локальным хранилищам оно не нужно
+    async def maintain_forever(self, *args, **kwargs):
+        return
+
+    def close(self):
+        pass
+
+
+def _updated_range(first_line, count):
+    return {"updates": {"updatedRange": f"rows!A{first_line}:A{first_line + count - 1}", "updatedRows": count}}
+
+
+# Хранилище в памяти процесса: для нагрузочных тестов и запуска без сети
+class InMemoryStorage(RowStorage):
+    def __init__(self):
+        self.header = None
+        self.rows = []
+
+    async def ensure_header(self, header):
+        if self.header is None:
+            self.header = list(header)
+
+    async def append_rows(self, rows, key=None):
+        first_line = len(self.rows) + 2
+        self.rows.extend(list(row) for row in rows)
+        return _updated_range(first_line, len(rows))
+
+    async def count_rows(self, shard=None):
+        return len(self.rows) + 1
+
+    async def get_rows(self, first, last, shard=None):
+        lines = [list(self.header or [])] + self.rows
+        return [list(row) for row in lines[max(first, 1) - 1:last]]
+
+
+# Пул соединений с базой: соединение берется на одну транзакцию и
+# возвращается обратно, новые открываются, только если все заняты
+# (не больше size). Транзакция фиксируется при выходе из блока
+# и откатывается при исключении.
+class ConnectionPool:
+    def __init__(self, connect, size=4):
+        self._connect = connect
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._all = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        self._slots.acquire()
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+                with self._lock:
+                    self._all.append(conn)
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            else:
+                conn.commit()
+            self._idle.put(conn)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        with self._lock:
+            for conn in self._all:
+                conn.close()
+            self._all = []
+
+
+_POSTGRES_SCHEMES = ("postgresql://", "postgres://")
+# Предел числа параметров одного запроса в SQLite 3.32+
+_SQLITE_MAX_VARIABLES = 32766
+
+
+# Подключение и диалект SQL по адресу базы: postgresql://... - PostgreSQL
+# (нужен psycopg), иначе путь к файлу SQLite (можно с префиксом sqlite:///).
+# Возвращает подключение, плейсхолдер, тип id и объявление автоинкрементного id.
+def _dialect(url):
+    if url.startswith(_POSTGRES_SCHEMES):
+        # psycopg - необязательная зависимость, нужна только для PostgreSQL
+        import psycopg
+        return (functools.partial(psycopg.connect, url), "%s", "BIGINT",
+                "BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY")
+
+    path = url.removeprefix("sqlite:///")
+
+    def connect():
+        conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+    # AUTOINCREMENT не выдает повторно id удаленных строк
+    return connect, "?", "INTEGER", "INTEGER PRIMARY KEY AUTOINCREMENT"
+
+
+# Хранилище в SQL-базе (SQLite или PostgreSQL): таблица assets с колонкой
+# на каждое поле строки. Строка с id N - это строка N + 1 "листа".
+# Пачка записывается в одной транзакции, запросы идут в пуле потоков через
+# пул соединений. id выдает сама база (INSERT ... RETURNING id), поэтому
+# писать в таблицу могут несколько процессов. Если чужая запись вклинилась
+# в пачку и ее id идут не подряд, номера строк в ответе не возвращаются -
+# локальная копия докачает их при синхронизации.
+# Если replicate включен, id записанных строк в той же транзакции попадают
+# в таблицу sheets_outbox - журнал для копирования в Google Sheets
+# (см. replication_log()).
+class SQLStorage(RowStorage):
+    def __init__(self, url, pool_size=4, replicate=False, fields=ROW_FIELDS):
+        connect, self._param, id_type, identity = _dialect(url)
+        self._postgres = url.startswith(_POSTGRES_SCHEMES)
+        self.fields = fields
+        self.replicate = replicate
+        self.header = None
+        self.pool = ConnectionPool(connect, pool_size)
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="sql")
+        columns = ", ".join(f"{field} TEXT NOT NULL DEFAULT ''" for field in fields)
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"CREATE TABLE IF NOT EXISTS assets (id {identity}, {columns})")
+            cursor.execute("CREATE INDEX IF NOT EXISTS assets_user_id ON assets (user_id)")
+            cursor.execute(f"CREATE TABLE IF NOT EXISTS sheets_outbox (asset_id {id_type} PRIMARY KEY)")
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args))
+
+    def _query(self, sql, params=()):
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(sql.replace("?", self._param), params)
+            return cursor.fetchall()
+
+    # Колонки схемы заданы полями строки, заголовок хранится только для get_rows
+    async def ensure_header(self, header):
+        self.header = list(header)
+
+    def _insert(self, rows):
+        width = len(self.fields)
+        values = [tuple(row[:width]) + ("",) * (width - len(row)) for row in rows]
+        placeholders = f"({', '.join([self._param] * width)})"
+        insert = f"INSERT INTO assets ({', '.join(self.fields)}) VALUES "
+        params = [tuple("" if value is None else str(value) for value in row) for row in values]
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            if self._postgres:
+                # psycopg отправляет пачку конвейером и отдает id по результату на строку
+                cursor.executemany(f"{insert}{placeholders} RETURNING id", params, returning=True)
+                ids = [cursor.fetchone()[0]]
+                while cursor.nextset():
+                    ids.append(cursor.fetchone()[0])
+            else:
+                # sqlite3 не отдает результат executemany, поэтому пачка уходит
+                # многострочными INSERT ... RETURNING id (SQLite 3.35+). SQLite
+                # пишет транзакции по одной, так что id строк одного INSERT идут
+                # подряд в порядке VALUES, но RETURNING отдает их в любом порядке.
+                ids = []
+                chunk = _SQLITE_MAX_VARIABLES // width
+                for start in range(0, len(params), chunk):
+                    part = params[start:start + chunk]
+                    cursor.execute(f"{insert}{', '.join([placeholders] * len(part))} RETURNING id",
+                                   [value for row in part for value in row])
+                    ids.extend(sorted(row_id for row_id, in cursor.fetchall()))
+            if self.replicate:
+                cursor.executemany(f"INSERT INTO sheets_outbox (asset_id) VALUES ({self._param})",
+                                   [(row_id,) for row_id in ids])
+        return ids
+
+    async def append_rows(self, rows, key=None):
+        if not rows:
+            return None
+        ids = await self._run(self._insert, rows)
+        if ids[-1] - ids[0] != len(ids) - 1:
+            return None
+        return _updated_range(ids[0] + 1, len(ids))
+
+    async def count_rows(self, shard=None):
+        return (await self._run(self._query, "SELECT COALESCE(MAX(id), 0) FROM assets"))[0][0] + 1
+
+    # Пропуски в id (строки удалили из базы) отдаются пустыми строками, чтобы не сдвигать номера
+    async def get_rows(self, first, last, shard=None):
+        found = await self._run(
+            self._query,
+            f"SELECT id, {', '.join(self.fields)} FROM assets WHERE id BETWEEN ? AND ? ORDER BY id",
+            (first - 1, last - 1)
+        )
+        if not found:
+            return [list(self.header or [])] if first <= 1 else []
+        by_id = {row[0]: list(row[1:]) for row in found}
+        empty = [""] * len(self.fields)
+        rows = [by_id.get(row_id, empty) for row_id in range(max(first - 1, 1), found[-1][0] + 1)]
+        return ([list(self.header or [])] if first <= 1 else []) + rows
+
+    # Журнал строк, которые еще не скопированы в Google Sheets
+    def replication_log(self):
+        return ReplicationLog(self)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.pool.close()
+
+
+# Журнал копирования SQLStorage в Google Sheets с интерфейсом Outbox:
+# его читает отдельная очередь записи, у которой хранилище - лист.
+# Строки добавляет только SQLStorage, поэтому append не поддерживается.
+class ReplicationLog:
+    def __init__(self, storage):
+        self.storage = storage
+
+    def __len__(self):
+        return self.storage._query(
+            "SELECT COUNT(*) FROM sheets_outbox JOIN assets ON assets.id = sheets_outbox.asset_id"
+        )[0][0]
+
+    def peek(self, limit):
+        fields = ", ".join(f"assets.{field}" for field in self.storage.fields)
+        rows = self.storage._query(
+            f"SELECT assets.id, {fields} FROM sheets_outbox "
+            "JOIN assets ON assets.id = sheets_outbox.asset_id ORDER BY sheets_outbox.asset_id LIMIT ?",
+            (limit,)
+        )
+        return [(row[0], list(row[1:])) for row in rows]
+
+    def ack(self, ids):
+        with self.storage.pool.connection() as conn:
+            conn.cursor().executemany(
+                f"DELETE FROM sheets_outbox WHERE asset_id = {self.storage._param}", [(row_id,) for row_id in ids]
+            )
+
+    def close(self):
+        pass
+
+
+# Локальное хранилище по названию (STORAGE_BACKEND); Google Sheets
+# подключается отдельно, через SheetsStorage.connect()
+def create_storage(kind, sql_url="assets.sqlite3", pool_size=4, replicate=False):
+    if kind == "memory":
+        return InMemoryStorage()
+    if kind == "sql":
+        return SQLStorage(sql_url, pool_size=pool_size, replicate=replicate)
+    raise ValueError(f"Unknown storage backend: {kind}")
@@ -0,0 +1,38 @@
+import threading
+import time
+
+
+# Локальная замена листа gspread для бенчмарков: хранит строки в памяти
+# и имитирует сетевую задержку Google API блокирующим sleep.
+class FakeWorksheet:
+    def __init__(self, latency=0.2, title="Sheet1"):
+        self.latency = latency
+        self.title = title
+        self.rows = []
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _round_trip(self):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.latency)
+
+    def get_all_values(self):
+        self._round_trip()
+        with self._lock:
+            return [list(row) for row in self.rows]
+
+    def row_values(self, row):
+        self._round_trip()
+        with self._lock:
+            return list(self.rows[row - 1]) if len(self.rows) >= row else []
+
+    def append_row(self, row, **kwargs):
+        self._round_trip()
+        with self._lock:
+            self.rows.append(list(row))
+
+    def append_rows(self, rows, **kwargs):
+        self._round_trip()
+        with self._lock:
+            self.rows.extend(list(row) for row in rows)
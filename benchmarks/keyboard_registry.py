@@ -0,0 +1,78 @@
+# Микробенчмарк клавиатур: сборка ReplyKeyboardMarkup на каждое сообщение
+# (как было раньше) против готовых клавиатур из реестра.
+# Для обоих вариантов сообщение сериализуется так же, как это делает aiogram
+# при отправке: model_dump метода SendMessage вместе с вложенной клавиатурой.
+#
+# Запуск: python benchmarks/keyboard_registry.py
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK-TOKEN")
+
+from aiogram.methods import SendMessage
+from aiogram.types import KeyboardButton, ReplyKeyboardMarkup
+
+from financial_bot import CURRENCIES, CURRENCY_KEYBOARD, BACK_KEYBOARD, EMOJI
+
+
+def send_message(keyboard):
+    return SendMessage(chat_id=1, text="Выберите валюту", reply_markup=keyboard).model_dump(warnings=False)
+
+
+def build_currency_keyboard():
+    buttons = []
+    for i in range(0, len(CURRENCIES), 2):
+        buttons.append([KeyboardButton(text=item) for item in CURRENCIES[i:i + 2]])
+    buttons.append([KeyboardButton(text=f"{EMOJI['back']} Назад")])
+    keyboard = ReplyKeyboardMarkup(
+        keyboard=buttons,
+        resize_keyboard=True,
+        one_time_keyboard=True,
+        input_field_placeholder="Выберите вариант..."
+    )
+    return send_message(keyboard)
+
+
+def build_back_keyboard():
+    keyboard = ReplyKeyboardMarkup(
+        keyboard=[[KeyboardButton(text=f"{EMOJI['back']} Назад")]],
+        resize_keyboard=True
+    )
+    return send_message(keyboard)
+
+
+def cached_currency_keyboard():
+    return send_message(CURRENCY_KEYBOARD)
+
+
+def cached_back_keyboard():
+    return send_message(BACK_KEYBOARD)
+
+
+# Пиковый объем памяти, выделяемой за одно сообщение
+def allocated(func, number=1000):
+    tracemalloc.start()
+    total = 0
+    for _ in range(number):
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        func()
+        total += tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+    return total / number
+
+
+def measure(name, func, number=20000):
+    func()
+    seconds = min(timeit.repeat(func, number=number, repeat=5)) / number
+    print(f"{name:<22} {seconds * 1e6:8.2f} us/msg  {allocated(func):8.1f} B/msg allocated")
+
+
+if __name__ == "__main__":
+    measure("currency: per message", build_currency_keyboard)
+    measure("currency: registry", cached_currency_keyboard)
+    measure("back: per message", build_back_keyboard)
+    measure("back: registry", cached_back_keyboard)
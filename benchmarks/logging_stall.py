@@ -0,0 +1,107 @@
+# Бенчмарк задержек цикла событий из-за логирования.
+#
+# Пачка апдейтов: каждый "обработчик" пишет в лог столько же строк, сколько
+# настоящий обработчик шага анкеты, плюс одну отладочную, которая отсекается
+# по уровню. Параллельно раз в миллисекунду просыпается задача-пульс и меряет,
+# на сколько позже положенного цикл событий смог ее разбудить.
+#
+# Сравниваются синхронные FileHandler + StreamHandler (как было в
+# logging.basicConfig) и очередь QueueHandler/QueueListener из bot_logging.
+# --disk-latency имитирует медленный диск (сетевой том, загруженный сервер).
+#
+# Запуск: python benchmarks/logging_stall.py --updates 5000 --disk-latency 0.0005
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bot_logging import FORMAT, create_sinks, setup_logging
+
+logger = logging.getLogger("benchmark")
+
+
+# Обработчик, каждая запись которого ждет диск disk_latency секунд
+def slow(handler, disk_latency):
+    emit = handler.emit
+
+    def slow_emit(record):
+        time.sleep(disk_latency)
+        emit(record)
+
+    handler.emit = slow_emit
+    return handler
+
+
+def sync_logging(directory, disk_latency):
+    root = logging.getLogger()
+    root.handlers.clear()
+    root.setLevel(logging.INFO)
+    for handler in (logging.FileHandler(os.path.join(directory, "sync.log")),
+                    logging.StreamHandler(open(os.path.join(directory, "console.log"), "w"))):
+        handler.setFormatter(logging.Formatter(FORMAT))
+        root.addHandler(slow(handler, disk_latency))
+    return None
+
+
+def queue_logging(directory, disk_latency):
+    sinks = create_sinks(os.path.join(directory, "queue.log"), 10 * 1024 * 1024, 3)
+    sinks[1].setStream(open(os.path.join(directory, "console.log"), "w"))
+    return setup_logging([slow(sink, disk_latency) for sink in sinks])
+
+
+async def handler(user_id, text):
+    logger.debug("Raw update from %s: %s", user_id, text)
+    logger.info("User %s entered asset name: %s", user_id, text)
+    logger.info("User %s moved to the next step", user_id)
+    await asyncio.sleep(0)
+
+
+async def heartbeat(lateness, stop):
+    while not stop.is_set():
+        expected = time.perf_counter() + 0.001
+        await asyncio.sleep(0.001)
+        lateness.append(time.perf_counter() - expected)
+
+
+async def run(name, setup, updates, disk_latency):
+    with tempfile.TemporaryDirectory() as directory:
+        listener = setup(directory, disk_latency)
+        lateness = []
+        stop = asyncio.Event()
+        pulse = asyncio.create_task(heartbeat(lateness, stop))
+        await asyncio.sleep(0.01)
+
+        started = time.perf_counter()
+        for start in range(0, updates, 100):
+            await asyncio.gather(*(handler(user_id, "Акции Сбербанка") for user_id in range(start, start + 100)))
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await pulse
+        if listener is not None:
+            listener.stop()
+        drained = time.perf_counter() - started
+
+    lateness.sort()
+    p99 = lateness[int(len(lateness) * 0.99) - 1] * 1000
+    print(f"{name:<12} burst={elapsed:6.2f} s  stall p99={p99:8.2f} ms  max={lateness[-1] * 1000:8.2f} ms  "
+          f"log written={drained:6.2f} s")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--disk-latency", type=float, default=0.0, help="задержка одной записи на диск, с")
+    args = parser.parse_args()
+
+    print(f"{args.updates} updates, {args.updates * 2} log lines, disk latency {args.disk_latency * 1000:.2f} ms")
+    await run("sync", sync_logging, args.updates, args.disk_latency)
+    await run("queue", queue_logging, args.updates, args.disk_latency)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,60 @@
+# Бенчмарк планировщика уведомлений: добавление задач, загрузка кучи из
+# базы при запуске и выполнение всех задач пачками по batch_size, а также
+# время одного пустого такта (ничего не наступило) при полной куче.
+# Обработчик ничего не отправляет, меряются только куча и SQLite.
+#
+# Запуск: python benchmarks/notification_jobs.py --jobs 100000 --batch-size 500
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from notifications import Job, NotificationScheduler
+
+
+async def handle(job):
+    return None
+
+
+async def run(jobs, batch_size):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "notifications.sqlite3")
+        now = time.time()
+        scheduler = NotificationScheduler(path, {"reminder": handle}, batch_size=batch_size)
+        started = time.perf_counter()
+        await scheduler.add([Job(f"reminder:{i}", i, "reminder", {"name": f"Актив {i}"}, now + i) for i in range(jobs)])
+        print(f"add:        {time.perf_counter() - started:7.2f} s")
+        scheduler.close()
+
+        scheduler = NotificationScheduler(path, {"reminder": handle}, batch_size=batch_size)
+        started = time.perf_counter()
+        await scheduler.reload()
+        print(f"reload:     {time.perf_counter() - started:7.2f} s ({len(scheduler)} jobs)")
+
+        started = time.perf_counter()
+        await scheduler.run_tick(now - 1)
+        print(f"idle tick:  {(time.perf_counter() - started) * 1e6:7.0f} us")
+
+        started = time.perf_counter()
+        done = 0
+        while ran := await scheduler.run_tick(now + jobs):
+            done += ran
+        elapsed = time.perf_counter() - started
+        print(f"run all:    {elapsed:7.2f} s ({done / elapsed:,.0f} jobs/s)")
+        scheduler.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=100_000)
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+    asyncio.run(run(args.jobs, args.batch_size))
+
+
+if __name__ == "__main__":
+    main()
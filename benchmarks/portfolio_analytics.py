@@ -0,0 +1,65 @@
+# Бенчмарк расчета портфеля на синтетической таблице.
+#
+# Строки генерируются в том же виде, в каком их возвращает Google Sheets
+# (все значения строками, пропуски "-"), и прогоняются через Portfolio:
+# разбор колонок, показатели по позициям и итоги по валютам.
+#
+# Запуск: python benchmarks/portfolio_analytics.py --rows 1000000
+import argparse
+import os
+import random
+import sys
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+import numpy as np
+
+from analytics import Portfolio
+
+CURRENCIES = ["USD (Доллар)", "EUR (Евро)", "CNY (Юань)", "RUB (Рубль)", "CHF (Франк)"]
+
+
+def make_rows(count, seed=1):
+    rng = random.Random(seed)
+    rows = []
+    for index in range(count):
+        entry_day = rng.randint(1, 28)
+        entry_month = rng.randint(1, 12)
+        closed = rng.random() < 0.5
+        entry_price = rng.uniform(1, 1000)
+        rows.append([
+            "Финансовые активы", "Акции", f"Актив {index}",
+            str(rng.randint(1, 100)),
+            rng.choice(CURRENCIES),
+            f"{entry_day:02d}.{entry_month:02d}.2022",
+            f"{entry_price:.2f}".replace(".", ",") if index % 3 == 0 else f"{entry_price:.2f}",
+            f"{entry_day:02d}.{entry_month:02d}.2024" if closed else "-",
+            f"{entry_price * rng.uniform(0.5, 2):.2f}" if closed else "-",
+            "-", "Иван", "ivan@example.com", "+79991234567", f"user{index % 1000}"
+        ])
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    args = parser.parse_args()
+
+    for count in args.rows:
+        rows = make_rows(count)
+        current_price = np.full(count, np.nan)
+
+        started = time.perf_counter()
+        portfolio = Portfolio(rows)
+        parsed = time.perf_counter()
+        summary = portfolio.summary(current_price, today="2025-01-01")
+        finished = time.perf_counter()
+
+        print(f"rows={count:<9} parse={parsed - started:6.3f} s  summary={finished - parsed:6.3f} s  "
+              f"total={finished - started:6.3f} s  currencies={len(summary)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+# Бенчмарк задержки обработчиков при сохранении в Google Sheets.
+#
+# Один "пользователь" сохраняет анкету, остальные в это время шлют обычные
+# сообщения. Сравниваем синхронные вызовы gspread прямо в обработчике
+# и неблокирующий SheetsStorage. Запуск: python benchmarks/sheets_latency.py
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_sheets import FakeWorksheet
+from sheets_storage import SheetsStorage
+
+
+async def save_blocking(worksheet, row):
+    if not worksheet.get_all_values():
+        worksheet.append_row(["header"])
+    worksheet.append_row(row)
+
+
+async def save_non_blocking(storage, row):
+    if not await storage.get_all_values():
+        await storage.append_row(["header"])
+    await storage.append_row(row)
+
+
+# Обычное сообщение другого пользователя приходит в момент arrival;
+# меряем, на сколько позже цикл событий смог его обработать
+async def other_user_update(latencies, arrival):
+    await asyncio.sleep(arrival - time.perf_counter())
+    latencies.append(time.perf_counter() - arrival)
+
+
+async def run(save, target, saves, messages):
+    latencies = []
+    started = time.perf_counter()
+    tasks = [
+        asyncio.create_task(other_user_update(latencies, started + 0.005 * (i + 1)))
+        for i in range(messages)
+    ]
+    tasks += [asyncio.create_task(save(target, [str(i)])) for i in range(saves)]
+    await asyncio.gather(*tasks)
+    return latencies, time.perf_counter() - started
+
+
+def report(name, latencies, elapsed):
+    latencies = sorted(latencies)
+    p50 = statistics.median(latencies) * 1000
+    p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000
+    print(f"{name:<14} p50={p50:8.2f} ms  p99={p99:8.2f} ms  max={latencies[-1] * 1000:8.2f} ms  "
+          f"drain={elapsed:.2f} s")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--latency", type=float, default=0.1, help="задержка одного вызова Sheets, с")
+    parser.add_argument("--saves", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    worksheet = FakeWorksheet(latency=args.latency)
+    latencies, elapsed = await run(save_blocking, worksheet, args.saves, args.messages)
+    report("blocking", latencies, elapsed)
+
+    storage = SheetsStorage(FakeWorksheet(latency=args.latency), max_workers=args.workers)
+    try:
+        latencies, elapsed = await run(save_non_blocking, storage, args.saves, args.messages)
+        report("SheetsStorage", latencies, elapsed)
+    finally:
+        storage.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,111 @@
+# Бенчмарк хранилищ анкет: пропускная способность очереди записи
+# (журнал на диске -> хранилище) для памяти, SQLite и листа Google Sheets
+# с имитацией сетевой задержки (--latency), а также время копирования
+# записанных в SQLite строк в лист через журнал sheets_outbox.
+# --writers N: N хранилищ со своими пулами соединений пишут в одну базу
+# одновременно, после записи проверяется, что все строки получили свои id.
+# --sql-url: то же для внешней базы, например PostgreSQL (нужен psycopg);
+# строки остаются в ее таблице assets.
+#
+# Запуск: python benchmarks/storage_write.py --rows 20000 --batch 500 --latency 0.2
+#         python benchmarks/storage_write.py --sql-url postgresql://localhost/bench --writers 4
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_sheets import FakeWorksheet
+from assets import ROW_FIELDS
+from backends import InMemoryStorage, SQLStorage
+from outbox import Outbox
+from sheets_storage import SheetsStorage
+from write_queue import WriteBehindQueue
+
+HEADER = list(ROW_FIELDS)
+
+
+def make_rows(count):
+    return [[f"{field} {i}" for field in ROW_FIELDS] for i in range(count)]
+
+
+# Строки кладутся в журнал анкетами по одной строке, как это делают обработчики
+async def write(storage, outbox_path, rows, batch):
+    queue = WriteBehindQueue(storage, HEADER, Outbox(outbox_path), max_batch=batch, flush_interval=0.05,
+                             max_request_rows=batch)
+    await queue.start()
+    started = time.perf_counter()
+    for row in rows:
+        await queue.put([row])
+    await queue.stop()
+    queue.outbox.close()
+    return time.perf_counter() - started
+
+
+# Несколько писателей в одну базу: каждый со своим SQLStorage, как отдельные процессы
+async def write_concurrently(url, directory, rows, batch, writers):
+    storages = [SQLStorage(url) for _ in range(writers)]
+    before = await storages[0].count_rows()
+    part = -(-len(rows) // writers)
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        write(storage, os.path.join(directory, f"outbox-writer-{i}.sqlite3"), rows[i * part:(i + 1) * part], batch)
+        for i, storage in enumerate(storages)
+    ))
+    elapsed = time.perf_counter() - started
+    written = (await storages[0]._run(storages[0]._query, "SELECT COUNT(*) FROM assets WHERE id >= ?", (before,)))[0][0]
+    for storage in storages:
+        storage.close()
+    return elapsed, written
+
+
+async def run(count, batch, latency, writers, sql_url):
+    rows = make_rows(count)
+    with tempfile.TemporaryDirectory() as directory:
+        storages = [
+            ("memory", InMemoryStorage()),
+            ("sqlite", SQLStorage(os.path.join(directory, "assets.sqlite3"), replicate=True)),
+            ("sheets", SheetsStorage(FakeWorksheet(latency=latency))),
+        ]
+        if sql_url:
+            storages.append(("sql-url", SQLStorage(sql_url)))
+        for name, storage in storages:
+            elapsed = await write(storage, os.path.join(directory, f"outbox-{name}.sqlite3"), rows, batch)
+            print(f"{name:8} {elapsed:7.2f} s ({count / elapsed:,.0f} rows/s)")
+
+        sql = storages[1][1]
+        sheets = SheetsStorage(FakeWorksheet(latency=latency))
+        replica = WriteBehindQueue(sheets, HEADER, sql.replication_log(), max_request_rows=batch)
+        started = time.perf_counter()
+        await replica.start()
+        await replica.stop()
+        print(f"replica  {time.perf_counter() - started:7.2f} s ({len(sheets.worksheet.rows) - 1} rows)")
+        for _, storage in storages:
+            storage.close()
+        sheets.close()
+
+        targets = [("sqlite", os.path.join(directory, "concurrent.sqlite3"))]
+        if sql_url:
+            targets.append(("sql-url", sql_url))
+        for name, url in targets:
+            elapsed, written = await write_concurrently(url, directory, rows, batch, writers)
+            status = "ok" if written == count else f"MISMATCH: {written} of {count} rows"
+            print(f"{name:8} {elapsed:7.2f} s ({count / elapsed:,.0f} rows/s, {writers} writers, {status})")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=20_000)
+    parser.add_argument("--batch", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--sql-url", default="")
+    args = parser.parse_args()
+    asyncio.run(run(args.rows, args.batch, args.latency, args.writers, args.sql_url))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+# Бенчмарк проверок ввода: прежние функции из financial_bot.py (re.match со
+# строкой шаблона, datetime.strptime, float) против модуля validators на
+# корректных и некорректных ответах пользователей.
+#
+# Запуск: python benchmarks/validation_speed.py --number 200000
+import argparse
+import os
+import re
+import sys
+import timeit
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import validators
+
+
+def legacy_email(email):
+    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
+    return re.match(pattern, email) is not None
+
+
+def legacy_phone(phone):
+    pattern = r'^(\+7|7|8)?[\s\-]?\(?[0-9]{3}\)?[\s\-]?[0-9]{3}[\s\-]?[0-9]{2}[\s\-]?[0-9]{2}$'
+    return re.match(pattern, phone) is not None
+
+
+def legacy_date(date_str):
+    try:
+        datetime.strptime(date_str, '%d.%m.%Y')
+        return True
+    except ValueError:
+        return False
+
+
+def legacy_number(text):
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+def new_number(text):
+    try:
+        return validators.parse_number(text)
+    except ValueError:
+        return None
+
+
+CASES = [
+    ("email", legacy_email, validators.is_valid_email, "ivan.petrov@example.com", "ivan.petrov@example"),
+    ("phone", legacy_phone, validators.normalize_phone, "8 (999) 123-45-67", "8 (999) 123-45"),
+    ("date", legacy_date, validators.is_valid_date, "15.05.2023", "31.02.2023"),
+    ("number", legacy_number, new_number, "1250.50", "12,5 руб"),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=200_000, help="вызовов на один замер")
+    args = parser.parse_args()
+
+    print(f"{'check':<8} {'input':<8} {'before':>10} {'after':>10}  speedup")
+    for name, legacy, new, valid, invalid in CASES:
+        for kind, value in (("valid", valid), ("invalid", invalid)):
+            before = min(timeit.repeat(lambda: legacy(value), number=args.number, repeat=3)) / args.number
+            after = min(timeit.repeat(lambda: new(value), number=args.number, repeat=3)) / args.number
+            print(f"{name:<8} {kind:<8} {before * 1e9:7.0f} ns {after * 1e9:7.0f} ns  {before / after:5.1f}x")
+
+
+if __name__ == "__main__":
+    main()
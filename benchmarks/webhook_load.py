@@ -0,0 +1,196 @@
+# Нагрузочный тест: long polling против вебхука.
+#
+# Поднимает локальную заглушку Telegram Bot API, направляет в нее бота и
+# отправляет синтетические апдейты (/start от разных пользователей) либо
+# через getUpdates (polling), либо POST-запросами на вебхук. Задержка
+# считается от момента отправки апдейта до получения ответа бота заглушкой.
+# Все работает в одном процессе, поэтому цифры полезны для сравнения
+# режимов между собой, а не как абсолютные.
+#
+# Запуск: python benchmarks/webhook_load.py --mode both --updates 2000
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import sys
+import time
+
+from aiohttp import ClientSession, web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "123456:LOAD-TEST-TOKEN")
+# Заглушка Bot API не ограничивает частоту ответов, поэтому лимиты Telegram
+# в очереди отправки отключены: иначе тест меряет их, а не прием апдейтов
+os.environ.setdefault("TELEGRAM_GLOBAL_RATE", "0")
+
+from aiogram.client.telegram import TelegramAPIServer
+
+import financial_bot
+from webhook import create_webhook_app
+
+API_PORT = 8181
+WEBHOOK_PORT = 8182
+WEBHOOK_PATH = "/webhook"
+
+
+# Заглушка Bot API: раздает апдейты через getUpdates и запоминает ответы бота
+class FakeTelegram:
+    def __init__(self):
+        self.updates = []
+        self.emitted = {}
+        self.replied = {}
+        self.expected = 0
+        self.done = asyncio.Event()
+        self._new_updates = asyncio.Condition()
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    def reset(self, expected):
+        self.updates.clear()
+        self.emitted.clear()
+        self.replied.clear()
+        self.expected = expected
+        self.done.clear()
+
+    async def push(self, updates):
+        async with self._new_updates:
+            now = time.perf_counter()
+            for update in updates:
+                self.emitted[update["message"]["chat"]["id"]] = now
+            self.updates.extend(updates)
+            self._new_updates.notify_all()
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        params = await request.post()
+        if method == "getMe":
+            return self.ok({"id": 123456, "is_bot": True, "first_name": "Load", "username": "load_bot"})
+        if method == "getUpdates":
+            return self.ok(await self.get_updates(int(params.get("offset", 0)), float(params.get("timeout", 0))))
+        if method == "sendMessage":
+            chat_id = int(params["chat_id"])
+            self.replied.setdefault(chat_id, time.perf_counter())
+            if len(self.replied) >= self.expected:
+                self.done.set()
+            return self.ok({
+                "message_id": 1, "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", "")
+            })
+        return self.ok(True)
+
+    async def get_updates(self, offset, timeout):
+        async with self._new_updates:
+            pending = [u for u in self.updates if u["update_id"] >= offset]
+            if not pending and timeout:
+                try:
+                    await asyncio.wait_for(self._new_updates.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                pending = [u for u in self.updates if u["update_id"] >= offset]
+            return pending[:100]
+
+    @staticmethod
+    def ok(result):
+        return web.json_response({"ok": True, "result": result})
+
+    def latencies(self):
+        return [self.replied[chat_id] - emitted for chat_id, emitted in self.emitted.items()]
+
+
+def make_updates(count, first_id):
+    return [
+        {
+            "update_id": first_id + i,
+            "message": {
+                "message_id": i + 1,
+                "date": int(time.time()),
+                "chat": {"id": first_id + i, "type": "private"},
+                "from": {"id": first_id + i, "is_bot": False, "first_name": "Load"},
+                "text": "/start"
+            }
+        }
+        for i in range(count)
+    ]
+
+
+async def run_polling(telegram, updates):
+    dp, bot = financial_bot.dp, financial_bot.bot
+    polling = asyncio.create_task(
+        dp.start_polling(bot, handle_signals=False, close_bot_session=False, polling_timeout=1)
+    )
+    started = time.perf_counter()
+    await telegram.push(updates)
+    await telegram.done.wait()
+    elapsed = time.perf_counter() - started
+    await dp.stop_polling()
+    await polling
+    return elapsed
+
+
+async def run_webhook(telegram, updates, concurrency):
+    app = create_webhook_app(financial_bot.dp, financial_bot.bot, WEBHOOK_PATH)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", WEBHOOK_PORT).start()
+    url = f"http://127.0.0.1:{WEBHOOK_PORT}{WEBHOOK_PATH}"
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with ClientSession() as session:
+        async def post(update):
+            async with semaphore:
+                telegram.emitted[update["message"]["chat"]["id"]] = time.perf_counter()
+                async with session.post(url, json=update) as response:
+                    response.raise_for_status()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(post(update) for update in updates))
+        await telegram.done.wait()
+        elapsed = time.perf_counter() - started
+    await runner.cleanup()
+    return elapsed
+
+
+def report(mode, telegram, elapsed):
+    latencies = sorted(telegram.latencies())
+    p50 = statistics.median(latencies) * 1000
+    p99 = latencies[max(int(len(latencies) * 0.99) - 1, 0)] * 1000
+    print(f"{mode:<8} {len(latencies) / elapsed:8.0f} updates/s  p50={p50:7.2f} ms  p99={p99:7.2f} ms")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["polling", "webhook", "both"], default="both")
+    parser.add_argument("--updates", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=50, help="одновременных POST на вебхук")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    telegram = FakeTelegram()
+    api_runner = web.AppRunner(telegram.app())
+    await api_runner.setup()
+    await web.TCPSite(api_runner, "127.0.0.1", API_PORT).start()
+    financial_bot.bot.session.api = TelegramAPIServer.from_base(f"http://127.0.0.1:{API_PORT}")
+
+    modes = ["polling", "webhook"] if args.mode == "both" else [args.mode]
+    first_id = 1
+    try:
+        for mode in modes:
+            updates = make_updates(args.updates, first_id)
+            first_id += args.updates
+            telegram.reset(args.updates)
+            if mode == "polling":
+                elapsed = await run_polling(telegram, updates)
+            else:
+                elapsed = await run_webhook(telegram, updates, args.concurrency)
+            report(mode, telegram, elapsed)
+    finally:
+        await financial_bot.bot.session.close()
+        await api_runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,137 @@
+# Бенчмарк масштабирования по числу рабочих процессов.
+#
+# Главный процесс раздает апдейты через UpdateRouter, рабочие процессы
+# прогоняют через настоящие обработчики бота полную анкету каждого
+# пользователя (ответы Telegram подменены заглушкой) и пишут строки в общий
+# журнал, а главный процесс выгружает журнал в поддельный лист Google Sheets.
+#
+# Запуск: python benchmarks/workers_scaling.py --workers 1 2 4 --users 200
+import argparse
+import asyncio
+import datetime
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK-TOKEN")
+# Анкета отправляется без пауз и с повторами ("-" несколько раз подряд):
+# ограничение частоты сообщений пользователя отбросило бы ее часть
+os.environ.setdefault("THROTTLE_RATE", "0")
+os.environ.setdefault("DUPLICATE_WINDOW", "0")
+
+from fake_sheets import FakeWorksheet
+from outbox import Outbox
+from sheets_storage import SheetsStorage
+from workers import UpdateRouter
+from write_queue import WriteBehindQueue
+
+FORM = [
+    "/start", "➕ Добавить актив", "📈 Финансовые активы", "📊 Акции", "Акции Сбербанка", "10",
+    "RUB (Рубль)", "250", "15.05.2023", "-", "-", "-", "Нет", "Иван", "ivan@example.com", "+79991234567"
+]
+
+
+def make_updates(users):
+    updates = []
+    update_id = 0
+    # Сообщения разных пользователей перемешаны, как в реальном потоке
+    for text in FORM:
+        for user_id in range(1, users + 1):
+            update_id += 1
+            updates.append({
+                "update_id": update_id,
+                "message": {
+                    "message_id": update_id,
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "from": {"id": user_id, "is_bot": False, "first_name": "Bench", "username": f"user{user_id}"},
+                    "text": text
+                }
+            })
+    return updates
+
+
+def bench_worker(index, queue, outbox_path, ready):
+    from aiogram.client.session.base import BaseSession
+    from aiogram.methods import SendMessage
+    from aiogram.types import Chat, Message
+
+    import financial_bot
+    from workers import serve_shard
+
+    # Заглушка Bot API: все отправки сразу "успешны"
+    class FakeSession(BaseSession):
+        async def make_request(self, bot, method, timeout=None):
+            if isinstance(method, SendMessage):
+                return Message(message_id=1, date=datetime.datetime.now(),
+                               chat=Chat(id=method.chat_id, type="private"), text=method.text)
+            return True
+
+        async def close(self):
+            pass
+
+        async def stream_content(self, *args, **kwargs):
+            yield b""
+
+    logging.disable(logging.WARNING)
+    financial_bot.bot.session = FakeSession()
+    financial_bot.write_queue = WriteBehindQueue(None, financial_bot.SHEET_HEADERS, Outbox(outbox_path))
+    ready.put(index)
+    asyncio.run(serve_shard(queue, lambda update: financial_bot.dp.feed_raw_update(financial_bot.bot, update)))
+
+
+async def run(workers, updates, users, latency, timeout):
+    outbox_path = os.path.join(tempfile.mkdtemp(), "outbox.sqlite3")
+    ready = multiprocessing.get_context("spawn").Queue()
+    router = UpdateRouter(workers, bench_worker, args=(outbox_path, ready))
+    router.start()
+    for _ in range(workers):
+        await asyncio.to_thread(ready.get)
+
+    worksheet = FakeWorksheet(latency=latency)
+    storage = SheetsStorage(worksheet)
+    write_queue = WriteBehindQueue(storage, ["header"], Outbox(outbox_path), poll_interval=0.05)
+    await write_queue.start()
+
+    started = time.perf_counter()
+    for update in updates:
+        router.dispatch(update)
+    await router.stop()
+    processed = time.perf_counter() - started
+    while len(worksheet.rows) < users + 1:
+        if time.perf_counter() - started > timeout:
+            break
+        await asyncio.sleep(0.01)
+    saved = time.perf_counter() - started
+
+    await write_queue.stop()
+    write_queue.outbox.close()
+    storage.close()
+    print(f"workers={workers:<2} {len(updates) / processed:8.0f} updates/s  "
+          f"handlers={processed:6.2f} s  all rows in sheet={saved:6.2f} s  sheet calls={worksheet.calls}")
+    if len(worksheet.rows) < users + 1:
+        print(f"  timed out: {max(len(worksheet.rows) - 1, 0)} of {users} rows saved")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.2, help="задержка одного вызова Sheets, с")
+    parser.add_argument("--timeout", type=float, default=120, help="сколько ждать записи всех строк, с")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    updates = make_updates(args.users)
+    print(f"{len(updates)} updates from {args.users} users, {os.cpu_count()} CPU")
+    for workers in args.workers:
+        await run(workers, updates, args.users, args.latency, args.timeout)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,67 @@
+import json
+import logging
+import logging.handlers
+import queue
+from datetime import datetime, timezone
+
+FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+
+# Запись лога одной строкой JSON (для сборщиков логов)
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "process": record.process,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+# Обработчики, которые пишут на диск и в консоль. Работают только в потоке
+# QueueListener, поэтому ротация и запись файла не останавливают цикл событий.
+def create_sinks(path, max_bytes, backup_count, json_path=None):
+    file_handler = logging.handlers.RotatingFileHandler(
+        path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8", delay=True
+    )
+    file_handler.setFormatter(logging.Formatter(FORMAT))
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter(FORMAT))
+    sinks = [file_handler, console]
+    if json_path:
+        json_handler = logging.handlers.RotatingFileHandler(
+            json_path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8", delay=True
+        )
+        json_handler.setFormatter(JsonFormatter())
+        sinks.append(json_handler)
+    return sinks
+
+
+# Корневой логгер только кладет записи в очередь, а на диск их пишет
+# отдельный поток. Сообщения форматируются лениво (logger.info("... %s", x)),
+# то есть только для записей, которые прошли фильтр уровня.
+def setup_logging(sinks, level=logging.INFO, log_queue=None):
+    log_queue = log_queue if log_queue is not None else queue.SimpleQueue()
+    forward_logging(log_queue, level)
+    return start_listener(log_queue, sinks)
+
+
+# Поток, который выгружает записи из очереди в обработчики
+def start_listener(log_queue, sinks):
+    listener = logging.handlers.QueueListener(log_queue, *sinks, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+# Рабочие процессы отправляют записи в очередь главного процесса,
+# поэтому в файл лога пишет только один процесс.
+def forward_logging(log_queue, level=logging.INFO):
+    root = logging.getLogger()
+    root.setLevel(level)
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
@@ -0,0 +1,78 @@
+import asyncio
+import csv
+import io
+import time
+from tempfile import SpooledTemporaryFile
+
+from aiogram.types import InputFile
+
+# Файл выгрузки держится в памяти, пока не превысит этот размер, затем уходит на диск
+SPOOL_MAX_SIZE = 1024 * 1024
+FORMATS = ("csv", "xlsx")
+
+
+# Выгрузка строк в CSV (с BOM и ";", чтобы Excel открывал кириллицу) или XLSX.
+# Строки пишутся по одной по мере чтения, файл возвращается открытым с начала.
+def build_export(rows, header, kind):
+    file = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, mode="w+b")
+    try:
+        if kind == "csv":
+            text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+            writer = csv.writer(text, delimiter=";")
+            writer.writerow(header)
+            for row in rows:
+                writer.writerow(row)
+            text.flush()
+            text.detach()
+        else:
+            from openpyxl import Workbook
+
+            workbook = Workbook(write_only=True)
+            sheet = workbook.create_sheet()
+            sheet.append(header)
+            for row in rows:
+                sheet.append(row)
+            workbook.save(file)
+        file.seek(0)
+        return file
+    except Exception:
+        file.close()
+        raise
+
+
+# Отправка открытого файла в Telegram кусками, без чтения целиком в память
+class SpooledInputFile(InputFile):
+    def __init__(self, file, filename, chunk_size=64 * 1024):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.file = file
+
+    async def read(self, bot):
+        self.file.seek(0)
+        while chunk := await asyncio.to_thread(self.file.read, self.chunk_size):
+            yield chunk
+
+
+# file_id уже отправленных выгрузок: повторная выгрузка тех же данных в течение
+# ttl секунд отправляется по file_id без сборки и загрузки файла.
+# version - отпечаток данных пользователя; если данные изменились, кэш не используется.
+class ExportCache:
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._entries = {}
+
+    def get(self, key, version):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, cached_version, file_id = entry
+        if expires_at < time.monotonic() or cached_version != version:
+            del self._entries[key]
+            return None
+        return file_id
+
+    def put(self, key, version, file_id):
+        now = time.monotonic()
+        # Заодно выбрасываем истекшие записи, чтобы кэш не рос
+        for stale in [k for k, (expires_at, _, _) in self._entries.items() if expires_at < now]:
+            del self._entries[stale]
+        self._entries[key] = (now + self.ttl, version, file_id)
@@ -1,39 +1,216 @@
 import os
+import asyncio
+import html
+import json
 import logging
-import re
+import multiprocessing
+import tempfile
+import uuid
+from typing import Any, Callable, NamedTuple
 from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import Command
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import TelegramForbiddenError
+from aiogram.filters import Command, CommandObject, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
+from aiogram.types import KeyboardButton, ReplyKeyboardMarkup
 from dotenv import load_dotenv
-import gspread
-from google.oauth2.service_account import Credentials
 from datetime import datetime
-
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler("bot.log"),
-        logging.StreamHandler()
-    ]
-)
-logger = logging.getLogger(__name__)
+from backends import BACKENDS as STORAGE_BACKENDS, create_storage
+from sheets_storage import SheetsStorage
+from sheets_client import CircuitBreaker
+from shards import MODES as SHARDING_MODES, ShardedSheetsStorage, ShardIndex
+from write_queue import WriteBehindQueue
+from outbox import Outbox
+from throttling import ThrottlingMiddleware
+from send_scheduler import SendScheduler, bulk_sends
+from notifications import Job, NotificationScheduler
+from assets import ASSET_FIELDS, COLUMN, ROW_FIELDS, AssetRecord, load_assets, pop_asset, push_asset
+from importer import FORMATS, import_table
+from exporter import FORMATS as EXPORT_FORMATS, ExportCache, SpooledInputFile, build_export
+from analytics import Portfolio
+from fsm_storage import create_fsm_storage
+from mirror import LINE_SPAN, SheetMirror
+from fx import CSVRateProvider, RateTable
+from webhook import run_webhook, serve_webhook
+from workers import UpdateRouter, create_gateway_app, poll_updates, serve_shard
+from validators import is_valid_date, is_valid_email, normalize_phone, parse_date, parse_number
+from funnel import FunnelRecorder
+from metrics import (REGISTRY, HandlerMetricsMiddleware, InstrumentedStorage, TelegramMetricsMiddleware,
+                     serve_metrics)
+from bot_logging import create_sinks, forward_logging, setup_logging, start_listener
 
 # Загрузка переменных окружения
 load_dotenv()
 
+# Настройка логирования: обработчики пишут лог в отдельном потоке, файл
+# ротируется по размеру, LOG_JSON_PATH включает дополнительный лог в JSON.
+# Поток запускает main(), поэтому импорт модуля (рабочие процессы,
+# бенчмарки) не меняет настройки логирования и не создает потоков.
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_PATH = os.getenv('LOG_PATH', 'bot.log')
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', 5))
+LOG_JSON_PATH = os.getenv('LOG_JSON_PATH')
+LOG_SINKS = create_sinks(LOG_PATH, LOG_MAX_BYTES, LOG_BACKUP_COUNT, json_path=LOG_JSON_PATH)
+log_listener = None  # Поток записи лога, создается в main()
+logger = logging.getLogger(__name__)
+
 # Настройка Google Sheets API
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 SERVICE_ACCOUNT_FILE = 'model-hexagon-466415-b1-cae1b431f892.json'
 SPREADSHEET_ID = '12BDetUqLfdHTbEd29eZ4jj6-CQqxYBABRtNTCObkWns'
+# Сколько потоков одновременно ходят в Google Sheets
+SHEETS_MAX_WORKERS = int(os.getenv('SHEETS_MAX_WORKERS', 4))
+# Запись пачками: не больше N строк или раз в T миллисекунд
+SHEETS_BATCH_SIZE = int(os.getenv('SHEETS_BATCH_SIZE', 50))
+SHEETS_FLUSH_INTERVAL_MS = int(os.getenv('SHEETS_FLUSH_INTERVAL_MS', 500))
+# Локальный журнал строк, еще не отправленных в Google Sheets
+OUTBOX_PATH = os.getenv('OUTBOX_PATH', 'outbox.sqlite3')
+SHEETS_MAX_RETRY_DELAY = float(os.getenv('SHEETS_MAX_RETRY_DELAY', 300))
+# Подключение к Google: после скольких ошибок подряд запросы приостанавливаются
+# и на сколько секунд, за сколько секунд до истечения обновлять токен и через
+# сколько секунд простоя отправлять запрос, поддерживающий соединение
+SHEETS_BREAKER_FAILURES = int(os.getenv('SHEETS_BREAKER_FAILURES', 5))
+SHEETS_BREAKER_RESET = float(os.getenv('SHEETS_BREAKER_RESET', 30))
+SHEETS_TOKEN_REFRESH_MARGIN = float(os.getenv('SHEETS_TOKEN_REFRESH_MARGIN', 600))
+SHEETS_KEEPALIVE_INTERVAL = float(os.getenv('SHEETS_KEEPALIVE_INTERVAL', 120))
+# Локальная копия листа для чтения без обращения к Google и период ее синхронизации, с
+MIRROR_PATH = os.getenv('MIRROR_PATH', 'mirror.sqlite3')
+MIRROR_SYNC_INTERVAL = float(os.getenv('MIRROR_SYNC_INTERVAL', 300))
+# Шарды: новые строки пишутся не в первый лист, а в листы по месяцу записи
+# (month) или по хэшу Telegram id пользователя (hash); пусто - без шардов.
+# Лист с SHEETS_SHARD_MAX_ROWS строками закрывается, ключ продолжается в новом листе.
+# Листы шардов создаются в таблицах SHEETS_SHARD_SPREADSHEETS (id через запятую,
+# таблицы создаются заранее и открываются сервисному аккаунту), пока в них
+# хватает ячеек (10 млн на таблицу); пусто - в основной таблице.
+SHEETS_SHARDING = os.getenv('SHEETS_SHARDING', '')
+if SHEETS_SHARDING and SHEETS_SHARDING not in SHARDING_MODES:
+    raise ValueError(f"SHEETS_SHARDING must be one of {', '.join(SHARDING_MODES)}")
+SHEETS_SHARD_MAX_ROWS = int(os.getenv('SHEETS_SHARD_MAX_ROWS', 100_000))
+SHEETS_SHARD_BUCKETS = int(os.getenv('SHEETS_SHARD_BUCKETS', 16))
+SHEETS_SHARD_SPREADSHEETS = [
+    spreadsheet_id for spreadsheet_id in os.getenv('SHEETS_SHARD_SPREADSHEETS', '').replace(' ', '').split(',')
+    if spreadsheet_id
+]
+SHARD_INDEX_PATH = os.getenv('SHARD_INDEX_PATH', 'shards.sqlite3')
+# Куда пишутся анкеты: sheets - прямо в Google Sheets, sql - в базу SQL_URL
+# (файл SQLite или postgresql://..., нужен psycopg) с пулом из SQL_POOL_SIZE
+# соединений, memory - в память процесса (нагрузочные тесты, запуск без сети).
+# При sql строки копируются в Google Sheets в фоне, если SHEETS_SYNC=1.
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'sheets')
+if STORAGE_BACKEND not in STORAGE_BACKENDS:
+    raise ValueError(f"STORAGE_BACKEND must be one of {', '.join(STORAGE_BACKENDS)}")
+SQL_URL = os.getenv('SQL_URL', 'assets.sqlite3')
+SQL_POOL_SIZE = int(os.getenv('SQL_POOL_SIZE', 4))
+SHEETS_SYNC = os.getenv('SHEETS_SYNC', '1') == '1'
+# Уведомления пользователям: база задач, период сводки портфеля в днях
+# (0 - без сводок), час напоминания в дату выхода из актива, период проверки (с)
+NOTIFY_PATH = os.getenv('NOTIFY_PATH', 'notifications.sqlite3')
+DIGEST_INTERVAL_DAYS = float(os.getenv('DIGEST_INTERVAL_DAYS', 7))
+REMINDER_HOUR = int(os.getenv('REMINDER_HOUR', 10))
+NOTIFY_TICK = float(os.getenv('NOTIFY_TICK', 30))
+
+# Заголовки таблицы
+SHEET_HEADERS = [
+    "Категория актива", "Подкатегория актива", "Название актива",
+    "Количество", "Валюта", "Дата входа/покупки", "Цена входа/покупки",
+    "Дата выхода/продажи", "Цена выхода/продажи",
+    "Ссылка на изображение", "Имя", "Email", "Телефон", "Пользователь",
+    "ID пользователя", "Дата записи"
+]
+
+# Хранилище состояний анкеты: memory, redis или sqlite.
+# Брошенные анкеты удаляются через FSM_TTL секунд без активности
+# (в sqlite - фоновой задачей главного процесса).
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'memory')
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+FSM_SQLITE_PATH = os.getenv('FSM_SQLITE_PATH', 'fsm.sqlite3')
+FSM_TTL = int(os.getenv('FSM_TTL', 7 * 24 * 60 * 60))
+
+# Режим получения апдейтов: polling или webhook
+RUN_MODE = os.getenv('RUN_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # Публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8080))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+# Количество рабочих процессов. При BOT_WORKERS > 1 главный процесс только
+# получает апдейты и отправляет строки в Google Sheets, а обработчики
+# работают в рабочих процессах, каждый со своей долей пользователей.
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', 1))
+
+# Курсы валют для пересчета портфеля в одну валюту. CSV со строками
+# "дата,валюта,курс" (курс в FX_QUOTE_CURRENCY); без файла пересчет отключен.
+FX_RATES_CSV = os.getenv('FX_RATES_CSV')
+FX_QUOTE_CURRENCY = os.getenv('FX_QUOTE_CURRENCY', 'RUB')
+FX_BASE_CURRENCY = os.getenv('FX_BASE_CURRENCY', 'RUB')
+FX_CACHE_PATH = os.getenv('FX_CACHE_PATH', 'fx.sqlite3')
+
+# Локальный эндпоинт /metrics (0 - отключен). Рабочие процессы
+# используют следующие порты: METRICS_PORT + 1 + номер процесса.
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9102))
+
+# Воронка анкеты: размер буфера событий, период пересчета сводки (с) и через
+# сколько секунд без действий анкета считается брошенной. События всех
+# процессов бота собираются в файле FUNNEL_PATH раз в FUNNEL_PERSIST_INTERVAL секунд.
+FUNNEL_CAPACITY = int(os.getenv('FUNNEL_CAPACITY', 100_000))
+FUNNEL_INTERVAL = float(os.getenv('FUNNEL_INTERVAL', 300))
+FUNNEL_PATH = os.getenv('FUNNEL_PATH', 'funnel.sqlite3')
+FUNNEL_PERSIST_INTERVAL = float(os.getenv('FUNNEL_PERSIST_INTERVAL', 5))
+FUNNEL_ABANDON_AFTER = float(os.getenv('FUNNEL_ABANDON_AFTER', 1800))
+# Импорт портфеля из CSV/XLSX: максимум строк в файле и размер файла
+# (Bot API отдает ботам файлы не больше 20 МБ)
+IMPORT_MAX_ROWS = int(os.getenv('IMPORT_MAX_ROWS', 10_000))
+IMPORT_MAX_FILE_SIZE = 20 * 1024 * 1024
+
+# Сколько секунд повторная выгрузка /export отправляется из кэша
+EXPORT_CACHE_TTL = float(os.getenv('EXPORT_CACHE_TTL', 300))
+
+# Ограничение частоты сообщений от одного пользователя: сообщений в секунду,
+# сколько можно отправить подряд и окно (с), в котором повтор того же сообщения
+# на последнем шаге анкеты (отправка) отбрасывается.
+# THROTTLE_RATE=0 и DUPLICATE_WINDOW=0 отключают соответствующую проверку.
+THROTTLE_RATE = float(os.getenv('THROTTLE_RATE', 1))
+THROTTLE_BURST = int(os.getenv('THROTTLE_BURST', 5))
+DUPLICATE_WINDOW = float(os.getenv('DUPLICATE_WINDOW', 1))
+
+# Лимиты исходящих сообщений Telegram: всего в секунду (на все рабочие процессы),
+# в секунду в один личный чат и сколько можно отправить в чат подряд;
+# число одновременных соединений с Bot API. 0 снимает ограничение
+# (TELEGRAM_GLOBAL_RATE=0 - сообщения уходят без очереди)
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', 30))
+TELEGRAM_CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', 1))
+TELEGRAM_CHAT_BURST = int(os.getenv('TELEGRAM_CHAT_BURST', 5))
+TELEGRAM_CONNECTIONS = int(os.getenv('TELEGRAM_CONNECTIONS', 20))
+
+# Telegram id администраторов через запятую (команда /funnel)
+ADMIN_IDS = {int(user_id) for user_id in os.getenv('ADMIN_IDS', '').replace(' ', '').split(',') if user_id}
 
 # Инициализация бота
 BOT_TOKEN = os.getenv('BOT_TOKEN')
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
+bot = Bot(token=BOT_TOKEN, session=AiohttpSession(limit=TELEGRAM_CONNECTIONS))
+fsm_storage = create_fsm_storage(FSM_STORAGE, redis_url=REDIS_URL, sqlite_path=FSM_SQLITE_PATH, ttl=FSM_TTL)
+# Несколько процессов с общим Redis не должны обрабатывать апдейты одного пользователя одновременно
+dp = Dispatcher(
+    storage=InstrumentedStorage(fsm_storage),
+    events_isolation=fsm_storage.create_isolation() if FSM_STORAGE == 'redis' else None
+)
+# Все исходящие сообщения проходят через общую очередь с лимитами Telegram
+send_scheduler = SendScheduler(
+    global_rate=TELEGRAM_GLOBAL_RATE, chat_rate=TELEGRAM_CHAT_RATE, chat_burst=TELEGRAM_CHAT_BURST
+)
+bot.session.middleware(send_scheduler)
+# Время обработчиков, хранилища состояний и запросов к Telegram
+dp.message.middleware(HandlerMetricsMiddleware())
+bot.session.middleware(TelegramMetricsMiddleware())
+storage = None  # Хранилище анкет (STORAGE_BACKEND), создается в connect_storage()
+sheets_replica = None  # Очередь копирования из базы в Google Sheets (STORAGE_BACKEND=sql)
+mirror = None  # Локальная копия листа, создается при запуске
+notifications = None  # Планировщик уведомлений, создается при запуске
+rates = None  # Таблица курсов валют, создается при запуске, если задан FX_RATES_CSV
+export_cache = ExportCache(ttl=EXPORT_CACHE_TTL)
 
 # Эмодзи для красоты
 EMOJI = {
@@ -85,27 +262,6 @@ def italic(text):
     return f"<i>{text}</i>"
 
 
-# Валидация email
-def is_valid_email(email):
-    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    return re.match(pattern, email) is not None
-
-
-# Валидация телефона
-def is_valid_phone(phone):
-    pattern = r'^(\+7|7|8)?[\s\-]?\(?[0-9]{3}\)?[\s\-]?[0-9]{3}[\s\-]?[0-9]{2}[\s\-]?[0-9]{2}$'
-    return re.match(pattern, phone) is not None
-
-
-# Валидация даты
-def is_valid_date(date_str):
-    try:
-        datetime.strptime(date_str, '%d.%m.%Y')
-        return True
-    except ValueError:
-        return False
-
-
 # Класс для хранения состояний (измененный порядок)
 class Form(StatesGroup):
     choose_asset_group = State()
@@ -124,6 +280,17 @@ class Form(StatesGroup):
     contact_phone = State()
 
 
+# Лишние сообщения отбрасываются до фильтров и обработчиков. Повтор того же
+# сообщения отбрасывается только на шаге телефона: ответ на него отправляет
+# анкету, а на остальных шагах одинаковые ответы подряд ("-", "Назад") обычны.
+dp.message.outer_middleware(ThrottlingMiddleware(
+    rate=THROTTLE_RATE, burst=THROTTLE_BURST, duplicate_window=DUPLICATE_WINDOW,
+    warning="⚠️ Слишком много сообщений, подождите несколько секунд",
+    duplicate_states={Form.contact_phone.state},
+    duplicate_notice="⏳ Анкета уже отправляется, подождите"
+))
+
+
 # Данные для кнопок с точными названиями
 asset_groups = {
     f"{EMOJI['stock']} Финансовые активы": [
@@ -175,6 +342,39 @@ def create_keyboard(items, row_width=2, back_button=True):
     )
 
 
+# Все клавиатуры бота статичны, поэтому собираем их один раз при загрузке модуля
+START_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text=f"{EMOJI['add']} Добавить актив")]
+    ],
+    resize_keyboard=True,
+    input_field_placeholder="Выберите действие..."
+)
+BACK_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[[KeyboardButton(text=f"{EMOJI['back']} Назад")]],
+    resize_keyboard=True
+)
+YES_NO_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="Да"), KeyboardButton(text="Нет")],
+        [KeyboardButton(text=f"{EMOJI['back']} Назад")]
+    ],
+    resize_keyboard=True
+)
+MAIN_MENU_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text=f"{EMOJI['chart']} В главное меню")]
+    ],
+    resize_keyboard=True
+)
+ASSET_GROUPS_KEYBOARD = create_keyboard(items=list(asset_groups.keys()), row_width=2, back_button=True)
+ASSET_SUBGROUP_KEYBOARDS = {
+    group: create_keyboard(items=subgroups, row_width=2, back_button=True)
+    for group, subgroups in asset_groups.items()
+}
+CURRENCY_KEYBOARD = create_keyboard(items=CURRENCIES, row_width=2, back_button=True)
+
+
 # Главное меню
 async def show_start_menu(message: types.Message):
     welcome_text = f"""
@@ -186,21 +386,13 @@ async def show_start_menu(message: types.Message):
 {italic('Выбери действие:')}
 """
 
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text=f"{EMOJI['add']} Добавить актив")]
-        ],
-        resize_keyboard=True,
-        input_field_placeholder="Выберите действие..."
-    )
-
-    await message.answer(welcome_text, reply_markup=keyboard, parse_mode="HTML")
+    await message.answer(welcome_text, reply_markup=START_KEYBOARD, parse_mode="HTML")
 
 
 # Команда /start
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message, state: FSMContext):
-    logger.info(f"User {message.from_user.id} started the bot")
+    logger.info("User %s started the bot", message.from_user.id)
     await state.clear()
     await show_start_menu(message)
 
@@ -208,516 +400,714 @@ async def cmd_start(message: types.Message, state: FSMContext):
 # Обработчик кнопки "Добавить актив"
 @dp.message(F.text == f"{EMOJI['add']} Добавить актив")
 async def add_asset(message: types.Message, state: FSMContext):
-    logger.info(f"User {message.from_user.id} started adding an asset")
+    logger.info("User %s started adding an asset", message.from_user.id)
     await state.set_state(Form.choose_asset_group)
+    # Ключ идемпотентности анкеты: повторная отправка не запишет ее второй раз
+    await state.set_data({'submission_id': uuid.uuid4().hex})
+    funnel.record(message.from_user.id, Form.choose_asset_group.state)
+    await send_prompt(message, STEPS[Form.choose_asset_group.state], {})
 
-    keyboard = create_keyboard(
-        items=list(asset_groups.keys()),
-        row_width=2,
-        back_button=True
-    )
 
-    await message.answer(
-        f"{EMOJI['chart']} {bold('Выберите категорию актива:')}",
-        reply_markup=keyboard,
-        parse_mode="HTML"
-    )
+# Имя пользователя, под которым его активы записываются в таблицу
+def display_username(user: types.User):
+    return user.username or f"{user.first_name} {user.last_name or ''}".strip()
 
 
-# Обработчик кнопки "Назад" (обновлен под новый порядок)
-@dp.message(F.text == f"{EMOJI['back']} Назад")
-async def back_handler(message: types.Message, state: FSMContext):
-    current_state = await state.get_state()
-    data = await state.get_data()
-
-    state_mapping = {
-        Form.choose_asset_subgroup.state: (
-        Form.choose_asset_group, None, "Выберите категорию актива:", list(asset_groups.keys())),
-        Form.asset_name.state: (Form.choose_asset_subgroup, data.get('asset_group'), "Выберите подкатегорию:",
-                                asset_groups.get(data.get('asset_group', ''), [])),
-        Form.asset_amount.state: (Form.asset_name, None,
-                                  f"Введите название актива:\nПример: {ASSET_EXAMPLES.get(data.get('asset_subgroup', 'Актив')[2:], 'Актив')}",
-                                  None),
-        Form.currency.state: (
-        Form.asset_amount, None, "Введите количество:\nЦелое число или дробное через точку", None),
-        Form.entry_price.state: (Form.currency, None, "Выберите валюту:", CURRENCIES),
-        Form.entry_date.state: (
-        Form.entry_price, None, "Введите цену входа/покупки:\nСумма в выбранной валюте (например: 15000 или 1250.50)",
-        None),
-        Form.exit_date.state: (
-        Form.entry_date, None, "Введите дату входа/покупки:\nФормат: ДД.ММ.ГГГГ (например: 15.05.2023)", None),
-        Form.exit_price.state: (
-        Form.exit_date, None, "Введите дату выхода/продажи:\nФормат: ДД.ММ.ГГГГ или '-' если актив не продан", None),
-        Form.image_url.state: (
-        Form.exit_price, None, "Введите цену выхода/продажи:\nСумма в выбранной валюте или '-' если актив не продан",
-        None),
-        Form.add_another_asset.state: (
-        Form.image_url, None, "Пришлите ссылку на изображение:\nИли отправьте '-' если изображения нет", None),
-        Form.contact_name.state: (Form.add_another_asset, None, "Хотите добавить еще один актив?", ["Да", "Нет"]),
-        Form.contact_email.state: (Form.contact_name, None, "Введите ваше имя:", None),
-        Form.contact_phone.state: (Form.contact_email, None, "Введите ваш email:\nПример: example@mail.com", None),
-    }
-
-    if current_state in state_mapping:
-        prev_state, extra_data, message_text, items = state_mapping[current_state]
-        await state.set_state(prev_state)
-
-        if items is not None:
-            keyboard = create_keyboard(
-                items=items,
-                row_width=2,
-                back_button=True
-            )
-            await message.answer(
-                f"{EMOJI['chart']} {bold(message_text)}",
-                reply_markup=keyboard,
-                parse_mode="HTML"
-            )
-        else:
-            await message.answer(
-                f"{EMOJI['chart']} {bold(message_text)}",
-                reply_markup=ReplyKeyboardMarkup(
-                    keyboard=[[KeyboardButton(text=f"{EMOJI['back']} Назад")]],
-                    resize_keyboard=True
-                ),
-                parse_mode="HTML"
-            )
-    else:
-        await state.clear()
-        await show_start_menu(message)
+def format_amount(value):
+    return f"{value:,.2f}".replace(",", " ")
 
 
-# Обработчик выбора группы активов
-@dp.message(Form.choose_asset_group)
-async def process_asset_group(message: types.Message, state: FSMContext):
-    if message.text not in asset_groups:
-        logger.warning(f"User {message.from_user.id} selected invalid asset group: {message.text}")
-        await message.answer(
-            f"{EMOJI['error']} {bold('Пожалуйста, выберите вариант из меню')}",
-            parse_mode="HTML"
-        )
-        return
+def format_percent(value):
+    return f"{value * 100:+.1f}%" if value is not None else "-"
 
-    await state.update_data(asset_group=message.text)
-    logger.info(f"User {message.from_user.id} selected asset group: {message.text}")
 
-    keyboard = create_keyboard(
-        items=asset_groups[message.text],
-        row_width=2,
-        back_button=True
-    )
+# Сводка портфеля по одной валюте
+def format_portfolio_summary(item):
+    currency = (item['currency'].split() or ['-'])[0]
+    unrealized = format_amount(item['unrealized_pnl']) if item['unrealized_pnl'] is not None else 'нет котировок'
+    holding = f"{item['avg_holding_days']:.0f} дн." if item['avg_holding_days'] is not None else '-'
+    return f"""{bold(f"{EMOJI['money']} {currency}")}
+{EMOJI['list']} {bold('Позиций:')} {item['positions']} (открытых: {item['open_positions']})
+{EMOJI['price']} {bold('Вложено:')} {format_amount(item['invested'])}
+{EMOJI['done']} {bold('Реализованная прибыль:')} {format_amount(item['realized_pnl'])} ({format_percent(item['realized_return'])})
+{EMOJI['stock']} {bold('Нереализованная прибыль:')} {unrealized}
+{EMOJI['calendar']} {bold('Средний срок владения:')} {holding}
+{EMOJI['chart']} {bold('Годовая доходность:')} {format_percent(item['annualized_return'])}
+"""
 
-    await state.set_state(Form.choose_asset_subgroup)
-    await message.answer(
-        f"{EMOJI['chart']} {bold('Выберите подкатегорию:')}",
-        reply_markup=keyboard,
-        parse_mode="HTML"
-    )
 
+# Итог портфеля, пересчитанный в базовую валюту по курсам на даты сделок
+def format_portfolio_total(total):
+    unrealized = format_amount(total['unrealized_pnl']) if total['unrealized_pnl'] is not None else 'нет котировок'
+    skipped = total['positions'] - total['converted']
+    note = f"\n{italic(f'Без курса валюты или даты входа: {skipped}')}" if skipped else ''
+    return f"""{bold(f"{EMOJI['bank']} Итого в {total['currency']}")}
+{EMOJI['price']} {bold('Вложено:')} {format_amount(total['invested'])}
+{EMOJI['done']} {bold('Реализованная прибыль:')} {format_amount(total['realized_pnl'])}
+{EMOJI['stock']} {bold('Нереализованная прибыль:')} {unrealized}{note}
+"""
 
-# Обработчик выбора подгруппы
-@dp.message(Form.choose_asset_subgroup)
-async def process_asset_subgroup(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    current_group = data.get('asset_group')
 
-    if message.text not in asset_groups[current_group]:
-        logger.warning(f"User {message.from_user.id} selected invalid asset subgroup: {message.text}")
-        await message.answer(
-            f"{EMOJI['error']} {bold('Пожалуйста, выберите вариант из меню')}",
-            parse_mode="HTML"
-        )
+# Курсы валют (если задан FX_RATES_CSV)
+def open_rate_table():
+    if not FX_RATES_CSV:
+        return None
+    currencies = [currency.split()[0] for currency in CURRENCIES]
+    if FX_BASE_CURRENCY not in currencies:
+        raise ValueError(f"FX_BASE_CURRENCY must be one of {', '.join(currencies)}, got {FX_BASE_CURRENCY!r}")
+    provider = CSVRateProvider(FX_RATES_CSV, quote=FX_QUOTE_CURRENCY)
+    return RateTable(provider, currencies, FX_CACHE_PATH)
+
+
+# Сообщения с итогами портфеля пользователя (пустой список, если активов нет).
+# Строки берутся из локальной копии листа, без запроса к Google.
+async def portfolio_report(user_id, title='Ваш портфель'):
+    rows = await asyncio.to_thread(mirror.user_rows, user_id)
+    if not rows:
+        return []
+
+    # Расчет на NumPy не блокирует цикл событий даже на больших таблицах
+    def calculate():
+        portfolio = Portfolio(rows)
+        total = portfolio.in_currency(rates, FX_BASE_CURRENCY) if rates is not None else None
+        return portfolio.summary(), total
+
+    summary, total = await asyncio.to_thread(calculate)
+    blocks = [f"{bold(EMOJI['chart'] + ' ' + title)}\nВсего активов: {len(rows)}\n"]
+    blocks.extend(format_portfolio_summary(item) for item in summary)
+    if total is not None:
+        blocks.append(format_portfolio_total(total))
+    return split_message(blocks)
+
+
+# Команда /portfolio: итоги по всем активам пользователя из таблицы
+@dp.message(Command("portfolio"))
+async def show_portfolio(message: types.Message):
+    logger.info("User %s requested portfolio", message.from_user.id)
+    if mirror is None:
+        await message.answer(f"{EMOJI['error']} Таблица сейчас недоступна, попробуйте позже")
         return
 
-    await state.update_data(asset_subgroup=message.text)
-    logger.info(f"User {message.from_user.id} selected asset subgroup: {message.text}")
-    await state.set_state(Form.asset_name)
-
-    example = ASSET_EXAMPLES.get(message.text[2:], "Актив")
-    await message.answer(
-        f"{EMOJI['price']} {bold('Введите название актива:')}\n"
-        f"{italic(f'Пример: {example}')}",
-        reply_markup=ReplyKeyboardMarkup(
-            keyboard=[[KeyboardButton(text=f"{EMOJI['back']} Назад")]],
-            resize_keyboard=True
-        ),
-        parse_mode="HTML"
-    )
+    messages = await portfolio_report(message.from_user.id)
+    if not messages:
+        await message.answer(f"{EMOJI['list']} У вас пока нет сохраненных активов", reply_markup=MAIN_MENU_KEYBOARD)
+        return
+    for text in messages[:-1]:
+        await message.answer(text, parse_mode="HTML")
+    await message.answer(messages[-1], reply_markup=MAIN_MENU_KEYBOARD, parse_mode="HTML")
+
+
+# Команда /export [csv|xlsx]: все активы пользователя файлом.
+# Строки берутся из локальной копии листа и пишутся в файл по одной.
+@dp.message(Command("export"))
+async def export_portfolio(message: types.Message, command: CommandObject):
+    kind = (command.args or 'csv').strip().lower()
+    logger.info("User %s requested %s export", message.from_user.id, kind)
+    if kind not in EXPORT_FORMATS:
+        await message.answer(f"{EMOJI['error']} Формат выгрузки: /export csv или /export xlsx")
+        return
+    if mirror is None:
+        await message.answer(f"{EMOJI['error']} Таблица сейчас недоступна, попробуйте позже")
+        return
 
+    user_id = message.from_user.id
+    version = await asyncio.to_thread(mirror.user_version, user_id)
+    if not version[0]:
+        await message.answer(f"{EMOJI['list']} У вас пока нет сохраненных активов", reply_markup=MAIN_MENU_KEYBOARD)
+        return
 
-# Обработчик ввода названия актива
-@dp.message(Form.asset_name)
-async def process_asset_name(message: types.Message, state: FSMContext):
-    if len(message.text) > 100:
-        await message.answer(
-            f"{EMOJI['error']} {bold('Название слишком длинное! Максимум 100 символов.')}",
-            parse_mode="HTML"
-        )
+    caption = f"{EMOJI['list']} Ваши активы: {version[0]}"
+    file_id = export_cache.get((user_id, kind), version)
+    if file_id is not None:
+        await message.answer_document(file_id, caption=caption, reply_markup=MAIN_MENU_KEYBOARD)
         return
 
-    await state.update_data(asset_name=message.text)
-    logger.info(f"User {message.from_user.id} entered asset name: {message.text}")
-    await state.set_state(Form.asset_amount)
-    await message.answer(
-        f"{EMOJI['chart']} {bold('Введите количество:')}\n"
-        f"{italic('Целое число или дробное через точку')}",
-        reply_markup=ReplyKeyboardMarkup(
-            keyboard=[[KeyboardButton(text=f"{EMOJI['back']} Назад")]],
-            resize_keyboard=True
-        ),
-        parse_mode="HTML"
-    )
+    file = await asyncio.to_thread(build_export, mirror.iter_user_rows(user_id), SHEET_HEADERS, kind)
+    try:
+        sent = await message.answer_document(
+            SpooledInputFile(file, f"portfolio_{datetime.now():%Y-%m-%d}.{kind}"),
+            caption=caption, reply_markup=MAIN_MENU_KEYBOARD
+        )
+    finally:
+        file.close()
+    if sent.document is not None:
+        export_cache.put((user_id, kind), version, sent.document.file_id)
 
 
-# Обработчик ввода количества
-@dp.message(Form.asset_amount)
-async def process_asset_amount(message: types.Message, state: FSMContext):
+# Уведомлений не получают пользователи, заблокировавшие бота: возвращает False
+async def notify(user_id, messages):
     try:
-        amount = float(message.text)
-        if amount <= 0:
-            raise ValueError
-        await state.update_data(asset_amount=amount)
-        logger.info(f"User {message.from_user.id} entered asset amount: {amount}")
-        await state.set_state(Form.currency)
-
-        keyboard = create_keyboard(
-            items=CURRENCIES,
-            row_width=2,
-            back_button=True
-        )
-        await message.answer(
-            f"{EMOJI['money']} {bold('Выберите валюту:')}",
-            reply_markup=keyboard,
-            parse_mode="HTML"
-        )
-    except ValueError:
-        logger.warning(f"User {message.from_user.id} entered invalid amount: {message.text}")
+        with bulk_sends():
+            for text in messages:
+                await bot.send_message(user_id, text, parse_mode="HTML")
+    except TelegramForbiddenError:
+        logger.info("User %s blocked the bot, notifications disabled", user_id)
+        return False
+    return True
+
+
+def digest_key(user_id):
+    return f"digest:{user_id}"
+
+
+# Предложение подписаться на сводку в конце анкеты (пустая строка, если сводки отключены)
+def digest_offer():
+    if not DIGEST_INTERVAL_DAYS:
+        return ''
+    return (f"\n{EMOJI['calendar']} Сводку портфеля раз в {DIGEST_INTERVAL_DAYS:g} дн. можно получать здесь: "
+            f"/digest on\n")
+
+
+# Сводка портфеля раз в DIGEST_INTERVAL_DAYS дней
+async def send_digest(job):
+    messages = await portfolio_report(job.user_id, title='Сводка портфеля')
+    if messages:
+        messages[-1] += "\n\nОтключить сводку: /digest off"
+    if messages and not await notify(job.user_id, messages):
+        return None
+    interval = DIGEST_INTERVAL_DAYS * 86400
+    now = datetime.now().timestamp()
+    # После простоя бота пропущенные сводки не досылаются
+    return job.due + interval if job.due + interval > now else now + interval
+
+
+# Напоминание в дату выхода из актива
+async def send_exit_reminder(job):
+    await notify(job.user_id, [f"""{bold(f"{EMOJI['calendar']} Напоминание")}
+Сегодня дата выхода из актива {bold(html.escape(job.payload['name']))} ({job.payload['date']}).
+
+Итоги портфеля: /portfolio"""])
+    return None
+
+
+NOTIFICATION_HANDLERS = {'digest': send_digest, 'exit_reminder': send_exit_reminder}
+
+
+# Напоминания о будущих датах выхода по строкам листа. Сводки портфеля
+# отсюда не создаются: пользователь включает их сам командой /digest on.
+def notification_jobs(rows, now):
+    jobs = []
+    name_column, exit_column = COLUMN['asset_name'], COLUMN['exit_date']
+    for _, user_id, row in rows:
+        parsed = parse_date(row[exit_column]) if len(row) > exit_column else None
+        if parsed is None:
+            continue
+        due = datetime(*parsed, REMINDER_HOUR).timestamp()
+        if due > now:
+            name, exit_date = row[name_column], row[exit_column]
+            jobs.append(Job(f"exit:{user_id}:{name}:{exit_date}", user_id, 'exit_reminder',
+                            {'name': name, 'date': exit_date}, due))
+    return jobs
+
+
+# Задачи по строкам копии листа, которых еще не видели.
+# seen - последняя просмотренная строка каждого шарда (по смещению), обновляется на месте.
+async def refresh_notifications(seen):
+    rows = []
+    for base in await asyncio.to_thread(mirror.line_bases):
+        after_line = seen.get(base, base)
+        if after_line > await asyncio.to_thread(mirror.last_line, base):
+            # Копию шарда собрали заново: уже известные задачи не продублируются
+            after_line = base
+        shard_rows = await asyncio.to_thread(mirror.rows_with_users, after_line, base + LINE_SPAN)
+        seen[base] = shard_rows[-1][0] if shard_rows else after_line
+        rows.extend(shard_rows)
+    added = await notifications.add(notification_jobs(rows, datetime.now().timestamp()))
+    if added:
+        logger.info("Scheduled %s new notifications", added)
+    return added
+
+
+# Периодически добавляет задачи по новым строкам и перечитывает расписание
+# (его меняют и рабочие процессы командой /digest)
+async def refresh_notifications_forever(interval):
+    seen = {}
+    while True:
+        try:
+            await refresh_notifications(seen)
+            await notifications.reload()
+        except Exception as e:
+            logger.error("Failed to refresh notifications: %s", e)
+        await asyncio.sleep(interval)
+
+
+# Команда /digest on|off: подписка на периодическую сводку портфеля (по умолчанию выключена)
+@dp.message(Command("digest"))
+async def toggle_digest(message: types.Message, command: CommandObject):
+    if not DIGEST_INTERVAL_DAYS or notifications is None:
+        await message.answer(f"{EMOJI['error']} Сводки портфеля сейчас не отправляются")
+        return
+    user_id = message.from_user.id
+    action = (command.args or '').strip().lower()
+    if action not in ('on', 'off'):
+        job = await asyncio.to_thread(notifications.get, digest_key(user_id))
+        status = 'включена' if job is not None and job.due is not None else 'выключена'
         await message.answer(
-            f"{EMOJI['error']} {bold('Некорректное число!')}\n"
-            f"Пожалуйста, введите положительное число (например: 10 или 5.5)",
-            parse_mode="HTML"
+            f"{EMOJI['calendar']} Сводка портфеля раз в {DIGEST_INTERVAL_DAYS:g} дн. {status}\n"
+            f"Включить: /digest on, выключить: /digest off"
         )
+        return
 
+    due = datetime.now().timestamp() + DIGEST_INTERVAL_DAYS * 86400 if action == 'on' else None
+    await notifications.put(Job(digest_key(user_id), user_id, 'digest', {}, due))
+    logger.info("User %s turned digest %s", user_id, action)
+    await message.answer(f"{EMOJI['done']} Сводка портфеля {'включена' if due else 'выключена'}")
+
+
+# Строка сводки воронки по одному шагу анкеты
+def format_funnel_stage(item):
+    step = STEPS.get(item['stage'])
+    name = step.label if step is not None else 'анкета отправлена'
+    dwell = f"{item['median_dwell']:.0f} с" if item['median_dwell'] is not None else '-'
+    return (f"{bold(name)}: {item['users']} ({item['conversion'] * 100:.0f}%), "
+            f"медиана {dwell}, бросили {item['abandoned']}")
+
+
+# Команда /funnel (только для ADMIN_IDS): сколько пользователей доходит до
+# каждого шага анкеты, сколько времени на нем проводит и где бросает анкету
+@dp.message(Command("funnel"), F.from_user.id.in_(ADMIN_IDS))
+async def show_funnel(message: types.Message):
+    logger.info("Admin %s requested funnel report", message.from_user.id)
+    report = await funnel.refresh(FUNNEL_ABANDON_AFTER)
+    blocks = [bold(f"{EMOJI['chart']} Воронка анкеты")]
+    blocks.extend(format_funnel_stage(item) for item in report)
+    for text in split_message(blocks):
+        await message.answer(text, parse_mode="HTML")
+
+
+# Загрузка портфеля файлом: CSV или XLSX с заголовком как в таблице.
+# Файл разбирается построчно в отдельном потоке, все принятые строки
+# ставятся в очередь записи одной пачкой.
+@dp.message(F.document)
+async def import_document(message: types.Message):
+    document = message.document
+    kind = FORMATS.get(os.path.splitext(document.file_name or '')[1].lower())
+    logger.info("User %s uploaded %s for import", message.from_user.id, document.file_name)
+    if kind is None:
+        await message.answer(f"{EMOJI['error']} Поддерживаются файлы CSV и XLSX")
+        return
+    if document.file_size and document.file_size > IMPORT_MAX_FILE_SIZE:
+        await message.answer(f"{EMOJI['error']} Файл слишком большой, максимум 20 МБ")
+        return
 
-# Обработчик выбора валюты
-@dp.message(Form.currency)
-async def process_currency(message: types.Message, state: FSMContext):
-    if message.text not in CURRENCIES:
-        logger.warning(f"User {message.from_user.id} selected invalid currency: {message.text}")
-        await message.answer(
-            f"{EMOJI['error']} {bold('Пожалуйста, выберите вариант из меню')}",
-            parse_mode="HTML"
+    handle, path = tempfile.mkstemp(suffix=f".{kind}")
+    os.close(handle)
+    try:
+        await bot.download(document, destination=path)
+        contact = {
+            'contact_name': message.from_user.full_name,
+            'contact_email': '-',
+            'contact_phone': '-',
+            'username': display_username(message.from_user),
+            'user_id': message.from_user.id,
+            'submitted_at': datetime.now(),
+        }
+        result = await asyncio.to_thread(
+            import_table, path, kind, IMPORT_COLUMNS, IMPORT_REQUIRED,
+            lambda values: import_row(values, contact), IMPORT_MAX_ROWS, titles=FIELD_TITLES
         )
+        if result.rows:
+            await write_queue.put(result.rows, key=f"import:{message.chat.id}:{message.message_id}")
+    except ValueError as e:
+        await message.answer(f"{EMOJI['error']} {bold('Файл не принят:')} {e}", parse_mode="HTML")
+        return
+    except Exception as e:
+        logger.error("Error importing file for user %s: %s", message.from_user.id, e)
+        await message.answer(f"{EMOJI['error']} Не удалось обработать файл, попробуйте позже")
         return
+    finally:
+        os.remove(path)
 
-    await state.update_data(currency=message.text)
-    logger.info(f"User {message.from_user.id} selected currency: {message.text}")
-    await state.set_state(Form.entry_price)
-    await message.answer(
-        f"{EMOJI['money']} {bold('Введите цену входа/покупки:')}\n"
-        f"{italic('Сумма в выбранной валюте (например: 15000 или 1250.50)')}",
-        reply_markup=ReplyKeyboardMarkup(
-            keyboard=[[KeyboardButton(text=f"{EMOJI['back']} Назад")]],
-            resize_keyboard=True
-        ),
-        parse_mode="HTML"
-    )
+    logger.info("User %s imported %s rows, rejected %s", message.from_user.id, len(result.rows), result.rejected)
+    lines = [bold(f"{EMOJI['done']} Импорт завершен"),
+             f"Принято активов: {len(result.rows)} из {result.total}"]
+    if result.truncated:
+        lines.append(f"{EMOJI['warning']} Обработаны только первые {IMPORT_MAX_ROWS} строк")
+    if result.rejected:
+        lines.append(f"\n{EMOJI['error']} {bold(f'Отклонено строк: {result.rejected}')}")
+        lines.extend(f"Строка {line}: {error}" for line, error in result.errors)
+        if result.rejected > len(result.errors):
+            lines.append(italic(f"и еще {result.rejected - len(result.errors)}"))
+    messages = split_message(lines)
+    for text in messages[:-1]:
+        await message.answer(text, parse_mode="HTML")
+    await message.answer(messages[-1], reply_markup=MAIN_MENU_KEYBOARD, parse_mode="HTML")
 
 
-# Обработчик ввода цены покупки
-@dp.message(Form.entry_price)
-async def process_entry_price(message: types.Message, state: FSMContext):
-    try:
-        price = float(message.text)
-        if price <= 0:
+# Сводка воронки в лог (в JSON-логе - одна запись на пересчет)
+def log_funnel(report):
+    logger.info("Funnel report: %s", json.dumps(report, ensure_ascii=False))
+
+
+# Проверки ответов: возвращают значение для сохранения или бросают ValueError
+def parse_asset_group(text, data):
+    if text not in asset_groups:
+        raise ValueError
+    return text
+
+
+def parse_asset_subgroup(text, data):
+    if text not in asset_groups.get(data.get('asset_group'), ()):
+        raise ValueError
+    return text
+
+
+def parse_currency(text, data):
+    if text not in CURRENCIES:
+        raise ValueError
+    return text
+
+
+def max_length(limit):
+    def parse(text, data):
+        if len(text) > limit:
             raise ValueError
-        await state.update_data(entry_price=price)
-        logger.info(f"User {message.from_user.id} entered entry price: {price}")
-        await state.set_state(Form.entry_date)
-        await message.answer(
-            f"{EMOJI['calendar']} {bold('Введите дату входа/покупки:')}\n"
-            f"{italic('Формат: ДД.ММ.ГГГГ (например: 15.05.2023)')}",
-            reply_markup=ReplyKeyboardMarkup(
-                keyboard=[[KeyboardButton(text=f"{EMOJI['back']} Назад")]],
-                resize_keyboard=True
-            ),
-            parse_mode="HTML"
-        )
-    except ValueError:
-        logger.warning(f"User {message.from_user.id} entered invalid entry price: {message.text}")
-        await message.answer(
-            f"{EMOJI['error']} {bold('Некорректная сумма!')}\n"
-            f"Пожалуйста, введите положительное число (например: 15000 или 1250.50)",
-            parse_mode="HTML"
-        )
+        return text
+    return parse
 
 
-# Обработчик ввода даты покупки
-@dp.message(Form.entry_date)
-async def process_entry_date(message: types.Message, state: FSMContext):
-    if message.text != '-' and not is_valid_date(message.text):
-        logger.warning(f"User {message.from_user.id} entered invalid date: {message.text}")
-        await message.answer(
-            f"{EMOJI['error']} {bold('Некорректная дата!')}\n"
-            f"Пожалуйста, введите дату в формате ДД.ММ.ГГГГ или '-'",
-            parse_mode="HTML"
-        )
-        return
+def parse_positive(text, data):
+    value = parse_number(text)
+    if value <= 0:
+        raise ValueError
+    return value
 
-    await state.update_data(entry_date=message.text)
-    logger.info(f"User {message.from_user.id} entered entry date: {message.text}")
-    await state.set_state(Form.exit_date)
-    await message.answer(
-        f"{EMOJI['calendar']} {bold('Введите дату выхода/продажи:')}\n"
-        f"{italic('Формат: ДД.ММ.ГГГГ или "-" если актив не продан')}",
-        reply_markup=ReplyKeyboardMarkup(
-            keyboard=[[KeyboardButton(text=f"{EMOJI['back']} Назад")]],
-            resize_keyboard=True
-        ),
-        parse_mode="HTML"
-    )
 
+def parse_positive_or_dash(text, data):
+    return text if text == '-' else parse_positive(text, data)
 
-# Обработчик ввода даты продажи
-@dp.message(Form.exit_date)
-async def process_exit_date(message: types.Message, state: FSMContext):
-    if message.text != '-' and not is_valid_date(message.text):
-        logger.warning(f"User {message.from_user.id} entered invalid exit date: {message.text}")
-        await message.answer(
-            f"{EMOJI['error']} {bold('Некорректная дата!')}\n"
-            f"Пожалуйста, введите дату в формате ДД.ММ.ГГГГ или '-'",
-            parse_mode="HTML"
-        )
-        return
 
-    await state.update_data(exit_date=message.text)
-    logger.info(f"User {message.from_user.id} entered exit date: {message.text}")
-    await state.set_state(Form.exit_price)
-    await message.answer(
-        f"{EMOJI['money']} {bold('Введите цену выхода/продажи:')}\n"
-        f"{italic('Сумма в выбранной валюте или "-" если актив не продан')}",
-        reply_markup=ReplyKeyboardMarkup(
-            keyboard=[[KeyboardButton(text=f"{EMOJI['back']} Назад")]],
-            resize_keyboard=True
-        ),
-        parse_mode="HTML"
-    )
+def parse_date_or_dash(text, data):
+    if text != '-' and not is_valid_date(text):
+        raise ValueError
+    return text
+
+
+def parse_image_url(text, data):
+    if text != '-' and not text.startswith(('http://', 'https://')):
+        raise ValueError
+    return text
+
+
+def parse_yes_no(text, data):
+    answer = text.lower()
+    if answer not in ("да", "нет"):
+        raise ValueError
+    return answer
 
 
-# Обработчик ввода цены продажи
-@dp.message(Form.exit_price)
-async def process_exit_price(message: types.Message, state: FSMContext):
-    if message.text != '-':
+def parse_email(text, data):
+    if not is_valid_email(text):
+        raise ValueError
+    return text
+
+
+def parse_phone(text, data):
+    phone = normalize_phone(text)
+    if phone is None:
+        raise ValueError
+    return phone
+
+
+# Текст вопроса шага: заголовок и подсказка
+def prompt_text(emoji, title, hint=None):
+    text = f"{EMOJI[emoji]} {bold(title)}"
+    return f"{text}\n{italic(hint)}" if hint else text
+
+
+def error_text(title, hint=None):
+    text = f"{EMOJI['error']} {bold(title)}"
+    return f"{text}\n{hint}" if hint else text
+
+
+def static_prompt(emoji, title, hint=None, keyboard=BACK_KEYBOARD):
+    prompt = (prompt_text(emoji, title, hint), keyboard)
+    return lambda data: prompt
+
+
+# Вопросы, зависящие от ранее выбранных вариантов, тоже готовятся заранее
+SUBGROUP_PROMPTS = {
+    group: (prompt_text('chart', 'Выберите подкатегорию:'), keyboard)
+    for group, keyboard in ASSET_SUBGROUP_KEYBOARDS.items()
+}
+ASSET_NAME_PROMPTS = {
+    subgroup: (
+        prompt_text('price', 'Введите название актива:', f"Пример: {ASSET_EXAMPLES.get(subgroup[2:], 'Актив')}"),
+        BACK_KEYBOARD
+    )
+    for subgroups in asset_groups.values()
+    for subgroup in subgroups
+}
+DEFAULT_SUBGROUP_PROMPT = (prompt_text('chart', 'Выберите подкатегорию:'), BACK_KEYBOARD)
+DEFAULT_ASSET_NAME_PROMPT = (prompt_text('price', 'Введите название актива:', 'Пример: Актив'), BACK_KEYBOARD)
+CHOICE_ERROR = error_text('Пожалуйста, выберите вариант из меню')
+
+
+# Шаг анкеты: как проверить ответ, куда его сохранить, что спросить и куда идти дальше.
+# next - следующее состояние (или функция от ответа), None - анкета заполнена.
+# prev - состояние для кнопки "Назад", None - возврат в главное меню.
+# restores_asset - шаг идет сразу после сохранения актива, "Назад" возвращает актив в работу.
+class Step(NamedTuple):
+    state: State
+    label: str
+    parse: Callable[[str, dict], Any]
+    error: str
+    prompt: Callable[[dict], tuple]
+    next: Any
+    prev: State | None
+    key: str | None = None
+    store: Callable[[dict, Any], dict] | None = None
+    restores_asset: bool = False
+
+
+# Сохраняем заполненный актив в список активов анкеты, чтобы следующий его не затер
+def store_asset(data, answer):
+    return push_asset(data)
+
+
+STEPS = {step.state.state: step for step in [
+    Step(Form.choose_asset_group, "asset group", parse_asset_group, CHOICE_ERROR,
+         static_prompt('chart', 'Выберите категорию актива:', keyboard=ASSET_GROUPS_KEYBOARD),
+         next=Form.choose_asset_subgroup, prev=Form.add_another_asset, key='asset_group', restores_asset=True),
+    Step(Form.choose_asset_subgroup, "asset subgroup", parse_asset_subgroup, CHOICE_ERROR,
+         lambda data: SUBGROUP_PROMPTS.get(data.get('asset_group'), DEFAULT_SUBGROUP_PROMPT),
+         next=Form.asset_name, prev=Form.choose_asset_group, key='asset_subgroup'),
+    Step(Form.asset_name, "asset name", max_length(100),
+         error_text('Название слишком длинное! Максимум 100 символов.'),
+         lambda data: ASSET_NAME_PROMPTS.get(data.get('asset_subgroup'), DEFAULT_ASSET_NAME_PROMPT),
+         next=Form.asset_amount, prev=Form.choose_asset_subgroup, key='asset_name'),
+    Step(Form.asset_amount, "asset amount", parse_positive,
+         error_text('Некорректное число!', 'Пожалуйста, введите положительное число (например: 10 или 5,5)'),
+         static_prompt('chart', 'Введите количество:', 'Целое число или дробное через точку или запятую'),
+         next=Form.currency, prev=Form.asset_name, key='asset_amount'),
+    Step(Form.currency, "currency", parse_currency, CHOICE_ERROR,
+         static_prompt('money', 'Выберите валюту:', keyboard=CURRENCY_KEYBOARD),
+         next=Form.entry_price, prev=Form.asset_amount, key='currency'),
+    Step(Form.entry_price, "entry price", parse_positive,
+         error_text('Некорректная сумма!', 'Пожалуйста, введите положительное число (например: 15000 или 1250,50)'),
+         static_prompt('money', 'Введите цену входа/покупки:', 'Сумма в выбранной валюте (например: 15000 или 1250,50)'),
+         next=Form.entry_date, prev=Form.currency, key='entry_price'),
+    Step(Form.entry_date, "entry date", parse_date_or_dash,
+         error_text('Некорректная дата!', "Пожалуйста, введите дату в формате ДД.ММ.ГГГГ или '-'"),
+         static_prompt('calendar', 'Введите дату входа/покупки:', 'Формат: ДД.ММ.ГГГГ (например: 15.05.2023)'),
+         next=Form.exit_date, prev=Form.entry_price, key='entry_date'),
+    Step(Form.exit_date, "exit date", parse_date_or_dash,
+         error_text('Некорректная дата!', "Пожалуйста, введите дату в формате ДД.ММ.ГГГГ или '-'"),
+         static_prompt('calendar', 'Введите дату выхода/продажи:', 'Формат: ДД.ММ.ГГГГ или "-" если актив не продан'),
+         next=Form.exit_price, prev=Form.entry_date, key='exit_date'),
+    Step(Form.exit_price, "exit price", parse_positive_or_dash,
+         error_text('Некорректная сумма!', "Пожалуйста, введите положительное число или '-'"),
+         static_prompt('money', 'Введите цену выхода/продажи:', 'Сумма в выбранной валюте или "-" если актив не продан'),
+         next=Form.image_url, prev=Form.exit_date, key='exit_price'),
+    Step(Form.image_url, "image URL", parse_image_url,
+         error_text('Некорректная ссылка!', "Пожалуйста, введите корректную URL-ссылку или '-'"),
+         static_prompt('camera', 'Пришлите ссылку на изображение:', 'Или отправьте "-" если изображения нет'),
+         next=Form.add_another_asset, prev=Form.exit_price, key='image_url'),
+    Step(Form.add_another_asset, "add another asset", parse_yes_no,
+         error_text('Пожалуйста, выберите "Да" или "Нет"'),
+         static_prompt('chart', 'Хотите добавить еще один актив?', keyboard=YES_NO_KEYBOARD),
+         next=lambda answer: Form.choose_asset_group if answer == "да" else Form.contact_name,
+         prev=Form.image_url, store=store_asset),
+    Step(Form.contact_name, "name", max_length(50),
+         error_text('Имя слишком длинное! Максимум 50 символов.'),
+         static_prompt('user', 'Введите ваше имя:', 'Как к вам можно обращаться?'),
+         next=Form.contact_email, prev=Form.add_another_asset, key='contact_name', restores_asset=True),
+    Step(Form.contact_email, "email", parse_email,
+         error_text('Некорректный email!', 'Пожалуйста, введите действительный email (например: example@mail.com)'),
+         static_prompt('email', 'Введите ваш email:', 'Пример: example@mail.com'),
+         next=Form.contact_phone, prev=Form.contact_name, key='contact_email'),
+    Step(Form.contact_phone, "phone", parse_phone,
+         error_text('Некорректный номер телефона!',
+                    'Пожалуйста, введите действительный номер (например: +79991234567 или 89991234567)'),
+         static_prompt('phone', 'Введите ваш номер телефона:', 'Формат: +79991234567 или 89991234567'),
+         next=None, prev=Form.contact_email, key='contact_phone'),
+]}
+
+# Импорт из файла проверяет каждую строку теми же правилами, что и шаги анкеты.
+# Колонки узнаются по заголовкам таблицы или по именам полей.
+FIELD_TITLES = dict(zip(ROW_FIELDS, SHEET_HEADERS))
+IMPORT_COLUMNS = {
+    **{field: field for field in ROW_FIELDS},
+    **{title.lower(): field for field, title in FIELD_TITLES.items()},
+}
+IMPORT_REQUIRED = ('asset_group', 'asset_subgroup', 'asset_name', 'asset_amount', 'currency', 'entry_price')
+IMPORT_STEPS = [step for step in STEPS.values() if step.key in ASSET_FIELDS]
+CONTACT_STEPS = [STEPS[Form.contact_name.state], STEPS[Form.contact_email.state], STEPS[Form.contact_phone.state]]
+
+
+# Варианты выбора из меню без эмодзи и в любом регистре: "акции" -> "📊 Акции"
+def choice_names(options):
+    names = {}
+    for option in options:
+        names[option.lower()] = option
+        names[option.split(' ', 1)[-1].lower()] = option
+    return names
+
+
+GROUP_NAMES = choice_names(asset_groups)
+SUBGROUP_NAMES = {group: choice_names(subgroups) for group, subgroups in asset_groups.items()}
+CURRENCY_NAMES = {**choice_names(CURRENCIES), **{currency.split()[0].lower(): currency for currency in CURRENCIES}}
+
+
+def import_choice(field, text, data):
+    if field == 'asset_group':
+        return GROUP_NAMES.get(text.lower(), text)
+    if field == 'asset_subgroup':
+        return SUBGROUP_NAMES.get(data.get('asset_group'), {}).get(text.lower(), text)
+    if field == 'currency':
+        return CURRENCY_NAMES.get(text.lower(), text)
+    return text
+
+
+# Одна строка файла -> строка для таблицы. Необязательные поля можно не
+# заполнять, контакты без колонок в файле берутся из профиля Telegram.
+def import_row(values, contact):
+    data = {}
+    for step in IMPORT_STEPS + CONTACT_STEPS:
+        text = values.get(step.key, '')
+        if not text:
+            if step.key in IMPORT_REQUIRED:
+                raise ValueError(f"не заполнено поле «{FIELD_TITLES[step.key]}»")
+            data[step.key] = contact.get(step.key, '-')
+            continue
         try:
-            price = float(message.text)
-            if price <= 0:
-                raise ValueError
-            await state.update_data(exit_price=price)
-            logger.info(f"User {message.from_user.id} entered exit price: {price}")
+            data[step.key] = step.parse(import_choice(step.key, text, data), data)
         except ValueError:
-            logger.warning(f"User {message.from_user.id} entered invalid exit price: {message.text}")
-            await message.answer(
-                f"{EMOJI['error']} {bold('Некорректная сумма!')}\n"
-                f"Пожалуйста, введите положительное число или '-'",
-                parse_mode="HTML"
-            )
-            return
-    else:
-        await state.update_data(exit_price=message.text)
-        logger.info(f"User {message.from_user.id} has no exit price")
-
-    await state.set_state(Form.image_url)
-    await message.answer(
-        f"{EMOJI['camera']} {bold('Пришлите ссылку на изображение:')}\n"
-        f"{italic('Или отправьте "-" если изображения нет')}",
-        reply_markup=ReplyKeyboardMarkup(
-            keyboard=[[KeyboardButton(text=f"{EMOJI['back']} Назад")]],
-            resize_keyboard=True
-        ),
-        parse_mode="HTML"
+            raise ValueError(f"некорректное значение «{text}» в поле «{FIELD_TITLES[step.key]}»") from None
+    return AssetRecord.from_data(data).to_row(
+        data['contact_name'], data['contact_email'], data['contact_phone'], contact['username'], contact['user_id'],
+        contact['submitted_at']
     )
 
 
-# Обработчик ввода ссылки на изображение
-@dp.message(Form.image_url)
-async def process_image_url(message: types.Message, state: FSMContext):
-    if message.text != '-' and not message.text.startswith(('http://', 'https://')):
-        logger.warning(f"User {message.from_user.id} entered invalid image URL: {message.text}")
-        await message.answer(
-            f"{EMOJI['error']} {bold('Некорректная ссылка!')}\n"
-            f"Пожалуйста, введите корректную URL-ссылку или '-'",
-            parse_mode="HTML"
-        )
-        return
+# Переходы пользователей по шагам анкеты; последний этап - анкета отправлена
+FUNNEL_SUBMITTED = 'submitted'
+funnel = FunnelRecorder(list(STEPS) + [FUNNEL_SUBMITTED], capacity=FUNNEL_CAPACITY, path=FUNNEL_PATH)
 
-    await state.update_data(image_url=message.text)
-    logger.info(f"User {message.from_user.id} entered image URL: {message.text}")
-    await state.set_state(Form.add_another_asset)
 
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Да"), KeyboardButton(text="Нет")],
-            [KeyboardButton(text=f"{EMOJI['back']} Назад")]
-        ],
-        resize_keyboard=True
-    )
+async def send_prompt(message: types.Message, step: Step, data):
+    text, keyboard = step.prompt(data)
+    await message.answer(text, reply_markup=keyboard, parse_mode="HTML")
 
-    await message.answer(
-        f"{EMOJI['chart']} {bold('Хотите добавить еще один актив?')}",
-        reply_markup=keyboard,
-        parse_mode="HTML"
-    )
 
+# Обработчик кнопки "Назад": возвращает на предыдущий шаг по таблице STEPS
+@dp.message(F.text == f"{EMOJI['back']} Назад")
+async def back_handler(message: types.Message, state: FSMContext, raw_state: str | None):
+    step = STEPS.get(raw_state)
+    data = await state.get_data()
 
-# Обработчик выбора "Добавить еще актив"
-@dp.message(Form.add_another_asset)
-async def process_add_another_asset(message: types.Message, state: FSMContext):
-    if message.text.lower() not in ["да", "нет"]:
-        await message.answer(
-            f"{EMOJI['error']} {bold('Пожалуйста, выберите "Да" или "Нет"')}",
-            parse_mode="HTML"
-        )
+    if step is not None and step.restores_asset and data.get('assets'):
+        # Возврат к уже сохраненному активу: он снова становится текущим
+        data = pop_asset(data)
+        await state.set_data(data)
+    elif step is None or step.prev is None or step.restores_asset:
+        # С первого шага первого актива "Назад" возвращает в главное меню
+        await state.clear()
+        await show_start_menu(message)
         return
 
-    if message.text.lower() == "да":
-        # Сохраняем текущий актив и начинаем новый
-        await save_current_asset(message, state)
-        await add_asset(message, state)
-    else:
-        # Переходим к вводу контактных данных
-        await save_current_asset(message, state)
-        await state.set_state(Form.contact_name)
-        await message.answer(
-            f"{EMOJI['user']} {bold('Введите ваше имя:')}\n"
-            f"{italic('Как к вам можно обращаться?')}",
-            reply_markup=ReplyKeyboardMarkup(
-                keyboard=[[KeyboardButton(text=f"{EMOJI['back']} Назад")]],
-                resize_keyboard=True
-            ),
-            parse_mode="HTML"
-        )
-
+    await state.set_state(step.prev)
+    funnel.record(message.from_user.id, step.prev.state)
+    await send_prompt(message, STEPS[step.prev.state], data)
 
-async def save_current_asset(message: types.Message, state: FSMContext):
-    # Здесь можно добавить логику сохранения текущего актива
-    pass
 
+# Единый обработчик шагов анкеты: одно чтение данных и одна запись на шаг
+@dp.message(StateFilter(*STEPS))
+async def process_step(message: types.Message, state: FSMContext, raw_state: str):
+    step = STEPS[raw_state]
+    data = await state.get_data()
 
-# Обработчик ввода имени
-@dp.message(Form.contact_name)
-async def process_contact_name(message: types.Message, state: FSMContext):
-    if len(message.text) > 50:
-        await message.answer(
-            f"{EMOJI['error']} {bold('Имя слишком длинное! Максимум 50 символов.')}",
-            parse_mode="HTML"
-        )
+    try:
+        if message.text is None:
+            raise ValueError
+        answer = step.parse(message.text, data)
+    except ValueError:
+        logger.warning("User %s entered invalid %s: %s", message.from_user.id, step.label, message.text)
+        REGISTRY.counter("bot_validation_failures_total", field=step.label).inc()
+        await message.answer(step.error, parse_mode="HTML")
         return
 
-    await state.update_data(contact_name=message.text)
-    logger.info(f"User {message.from_user.id} entered name: {message.text}")
-    await state.set_state(Form.contact_email)
-    await message.answer(
-        f"{EMOJI['email']} {bold('Введите ваш email:')}\n"
-        f"{italic('Пример: example@mail.com')}",
-        reply_markup=ReplyKeyboardMarkup(
-            keyboard=[[KeyboardButton(text=f"{EMOJI['back']} Назад")]],
-            resize_keyboard=True
-        ),
-        parse_mode="HTML"
-    )
-
+    logger.info("User %s entered %s: %s", message.from_user.id, step.label, answer)
+    if step.store is not None:
+        data = step.store(data, answer)
+    else:
+        data = {**data, step.key: answer}
 
-# Обработчик ввода email
-@dp.message(Form.contact_email)
-async def process_contact_email(message: types.Message, state: FSMContext):
-    if not is_valid_email(message.text):
-        logger.warning(f"User {message.from_user.id} entered invalid email: {message.text}")
-        await message.answer(
-            f"{EMOJI['error']} {bold('Некорректный email!')}\n"
-            f"Пожалуйста, введите действительный email (например: example@mail.com)",
-            parse_mode="HTML"
-        )
+    next_state = step.next if step.next is None or isinstance(step.next, State) else step.next(answer)
+    if next_state is None:
+        await submit_form(message, state, data)
         return
 
-    await state.update_data(contact_email=message.text)
-    logger.info(f"User {message.from_user.id} entered email: {message.text}")
-    await state.set_state(Form.contact_phone)
-    await message.answer(
-        f"{EMOJI['phone']} {bold('Введите ваш номер телефона:')}\n"
-        f"{italic('Формат: +79991234567 или 89991234567')}",
-        reply_markup=ReplyKeyboardMarkup(
-            keyboard=[[KeyboardButton(text=f"{EMOJI['back']} Назад")]],
-            resize_keyboard=True
-        ),
-        parse_mode="HTML"
-    )
+    await state.set_data(data)
+    await state.set_state(next_state)
+    funnel.record(message.from_user.id, next_state.state)
+    await send_prompt(message, STEPS[next_state.state], data)
+
+
+# Описание одного актива для итогового сообщения
+def format_asset_summary(asset, number=None):
+    currency = asset.currency.split()[0] if asset.currency else ''
+    title = f"{bold(f'Актив {number}:')}\n" if number else ''
+    return f"""{title}{EMOJI['price']} {bold('Категория:')} {asset.asset_group[2:] or '-'}
+{EMOJI['price']} {bold('Подкатегория:')} {asset.asset_subgroup[2:] or '-'}
+{EMOJI['price']} {bold('Название актива:')} {asset.asset_name or '-'}
+{EMOJI['chart']} {bold('Количество:')} {asset.asset_amount or '-'}
+{EMOJI['money']} {bold('Валюта:')} {asset.currency or '-'}
+{EMOJI['calendar']} {bold('Дата входа:')} {asset.entry_date or '-'}
+{EMOJI['money']} {bold('Цена входа:')} {asset.entry_price or '-'} {currency if asset.entry_price != '-' else ''}
+{EMOJI['calendar']} {bold('Дата выхода:')} {asset.exit_date or '-'}
+{EMOJI['money']} {bold('Цена выхода:')} {asset.exit_price or '-'} {currency if asset.exit_price != '-' else ''}
+{EMOJI['camera']} {bold('Изображение:')} {'Есть' if asset.image_url not in ('', '-') else 'Нет'}
+"""
 
 
-# Обработчик ввода телефона
-@dp.message(Form.contact_phone)
-async def process_contact_phone(message: types.Message, state: FSMContext):
-    if not is_valid_phone(message.text):
-        logger.warning(f"User {message.from_user.id} entered invalid phone: {message.text}")
-        await message.answer(
-            f"{EMOJI['error']} {bold('Некорректный номер телефона!')}\n"
-            f"Пожалуйста, введите действительный номер (например: +79991234567 или 89991234567)",
-            parse_mode="HTML"
-        )
-        return
+# Склеиваем блоки текста в сообщения, не превышающие лимит Telegram
+def split_message(blocks, limit=4096):
+    messages = []
+    current = ''
+    for block in blocks:
+        if current and len(current) + len(block) + 1 > limit:
+            messages.append(current)
+            current = ''
+        current = f"{current}\n{block}" if current else block
+    if current:
+        messages.append(current)
+    return messages
 
-    data = await state.get_data()
-    username = message.from_user.username or f"{message.from_user.first_name} {message.from_user.last_name or ''}".strip()
-
-    # Форматируем итоговые данные для проверки
-    summary_text = f"""
-{bold(f'{EMOJI["done"]} Данные сохранены в таблицу:')}
-
-{EMOJI['price']} {bold('Категория:')} {data.get('asset_group', '-')[2:]}
-{EMOJI['price']} {bold('Подкатегория:')} {data.get('asset_subgroup', '-')[2:]}
-{EMOJI['price']} {bold('Название актива:')} {data.get('asset_name', '-')}
-{EMOJI['chart']} {bold('Количество:')} {data.get('asset_amount', '-')}
-{EMOJI['money']} {bold('Валюта:')} {data.get('currency', '-')}
-{EMOJI['calendar']} {bold('Дата входа:')} {data.get('entry_date', '-')}
-{EMOJI['money']} {bold('Цена входа:')} {data.get('entry_price', '-')} {data.get('currency', '').split()[0] if data.get('entry_price') != '-' else ''}
-{EMOJI['calendar']} {bold('Дата выхода:')} {data.get('exit_date', '-')}
-{EMOJI['money']} {bold('Цена выхода:')} {data.get('exit_price', '-')} {data.get('currency', '').split()[0] if data.get('exit_price') != '-' else ''}
-{EMOJI['camera']} {bold('Изображение:')} {'Есть' if data.get('image_url', '-') != '-' else 'Нет'}
-{EMOJI['user']} {bold('Имя:')} {data.get('contact_name', '-')}
+
+# Анкета заполнена: записываем все активы и благодарим пользователя
+async def submit_form(message: types.Message, state: FSMContext, data):
+    username = display_username(message.from_user)
+
+    assets = load_assets(data)
+    contact_text = f"""{EMOJI['user']} {bold('Имя:')} {data.get('contact_name', '-')}
 {EMOJI['email']} {bold('Email:')} {data.get('contact_email', '-')}
-{EMOJI['phone']} {bold('Телефон:')} {message.text}
+{EMOJI['phone']} {bold('Телефон:')} {data['contact_phone']}
 """
 
-    # Подготовка данных для Google Sheets
-    row_data = [
-        data.get('asset_group', '')[2:],  # Убираем эмодзи
-        data.get('asset_subgroup', '')[2:],  # Убираем эмодзи
-        data.get('asset_name', ''),
-        data.get('asset_amount', ''),
-        data.get('currency', ''),
-        data.get('entry_date', ''),
-        data.get('entry_price', ''),
-        data.get('exit_date', ''),
-        data.get('exit_price', ''),
-        data.get('image_url', ''),
-        data.get('contact_name', ''),
-        data.get('contact_email', ''),
-        message.text,  # phone
-        username
+    # Подготовка данных для Google Sheets: одна строка на каждый актив
+    submitted_at = datetime.now()
+    rows = [
+        asset.to_row(data.get('contact_name', ''), data.get('contact_email', ''), data['contact_phone'],
+                     username, message.from_user.id, submitted_at)
+        for asset in assets
     ]
 
     try:
-        all_values = sheet.get_all_values()
-        if not all_values:
-            sheet.append_row([
-                "Категория актива", "Подкатегория актива", "Название актива",
-                "Количество", "Валюта", "Дата входа/покупки", "Цена входа/покупки",
-                "Дата выхода/продажи", "Цена выхода/продажи",
-                "Ссылка на изображение", "Имя", "Email", "Телефон", "Пользователь"
-            ])
-        sheet.append_row(row_data)
-        logger.info(f"User {message.from_user.id} successfully saved data to Google Sheets")
-
-        await message.answer(summary_text, parse_mode="HTML")
+        if not await write_queue.put(rows, key=data.get('submission_id')):
+            # Эту анкету уже сохранил параллельный или повторный запрос
+            logger.info("User %s resubmitted form %s, ignored", message.from_user.id, data['submission_id'])
+            await state.clear()
+            return
+        logger.info("User %s successfully queued %s assets for Google Sheets", message.from_user.id, len(rows))
+
+        # Итоговые данные для проверки (длинный портфель делим на несколько сообщений)
+        blocks = [bold(f'{EMOJI["done"]} Данные сохранены в таблицу:')]
+        for number, asset in enumerate(assets, start=1):
+            blocks.append(format_asset_summary(asset, number if len(assets) > 1 else None))
+        blocks.append(contact_text)
+        for summary_text in split_message(blocks):
+            await message.answer(summary_text, parse_mode="HTML")
 
         # Финальное сообщение с благодарностью
         final_message = f"""
@@ -725,67 +1115,253 @@ async def process_contact_phone(message: types.Message, state: FSMContext):
 
 Вы получите индивидуальные рекомендации и результаты анализа на указанные контакты:
 📧 Email: {bold(data.get('contact_email'))}
-
+{digest_offer()}
 Спасибо за доверие!
 """
-        keyboard = ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text=f"{EMOJI['chart']} В главное меню")]
-            ],
-            resize_keyboard=True
-        )
         await message.answer(
             final_message,
-            reply_markup=keyboard,
+            reply_markup=MAIN_MENU_KEYBOARD,
             parse_mode="HTML"
         )
+        await state.clear()
+        funnel.record(message.from_user.id, FUNNEL_SUBMITTED)
 
     except Exception as e:
-        logger.error(f"Error saving data for user {message.from_user.id}: {str(e)}")
+        # Анкету не сбрасываем: пользователь может отправить телефон еще раз
+        logger.error("Error saving data for user %s: %s", message.from_user.id, e)
         await message.answer(
-            f"{EMOJI['error']} {bold('Ошибка сохранения:')}\n{str(e)}",
+            f"{EMOJI['error']} {bold('Ошибка сохранения:')}\n{str(e)}\n"
+            f"Пожалуйста, отправьте номер телефона еще раз",
             parse_mode="HTML"
         )
 
-    await state.clear()
-
 
 # Обработчик кнопки "В главное меню"
 @dp.message(F.text == f"{EMOJI['chart']} В главное меню")
 async def back_to_main_menu(message: types.Message):
-    logger.info(f"User {message.from_user.id} returned to main menu")
+    logger.info("User %s returned to main menu", message.from_user.id)
     await show_start_menu(message)
 
 
+# Подключение к Google Sheets: у каждого процесса свой клиент и пул потоков
+# Если Google недоступен, клиент переподключится сам, а строки ждут в журнале.
+# sharded=False - без шардов (рабочие процессы в таблицу не пишут).
+async def connect_sheets(sharded=True):
+    storage_class, options = SheetsStorage, {}
+    if sharded and SHEETS_SHARDING:
+        storage_class = ShardedSheetsStorage
+        options = dict(index=ShardIndex(SHARD_INDEX_PATH), header=SHEET_HEADERS, mode=SHEETS_SHARDING,
+                       max_rows=SHEETS_SHARD_MAX_ROWS, buckets=SHEETS_SHARD_BUCKETS,
+                       spreadsheets=SHEETS_SHARD_SPREADSHEETS)
+    sheets, error = await storage_class.connect(
+        SERVICE_ACCOUNT_FILE, SCOPES, SPREADSHEET_ID, max_workers=SHEETS_MAX_WORKERS,
+        breaker=CircuitBreaker(SHEETS_BREAKER_FAILURES, SHEETS_BREAKER_RESET), **options
+    )
+    if error is not None:
+        logger.error("%s Ошибка подключения к Google Sheets, повторим позже: %s", EMOJI['error'], error)
+    else:
+        logger.info("%s Успешное подключение к Google Sheets", EMOJI['done'])
+    return sheets
+
+
+async def connect_storage(sharded=True):
+    global storage
+    if STORAGE_BACKEND == 'sheets':
+        storage = await connect_sheets(sharded)
+    else:
+        storage = create_storage(STORAGE_BACKEND, SQL_URL, SQL_POOL_SIZE, replicate=SHEETS_SYNC)
+        logger.info("Using %s storage backend", STORAGE_BACKEND)
+
+
+# Очередь записи. Журнал OUTBOX_PATH общий для всех процессов,
+# а отправляет строки из него только главный процесс.
+def create_write_queue(poll_interval=None):
+    return WriteBehindQueue(
+        storage, SHEET_HEADERS, Outbox(OUTBOX_PATH),
+        max_batch=SHEETS_BATCH_SIZE,
+        flush_interval=SHEETS_FLUSH_INTERVAL_MS / 1000,
+        max_retry_delay=SHEETS_MAX_RETRY_DELAY,
+        poll_interval=poll_interval,
+        mirror=mirror
+    )
+
+
+# Эндпоинт /metrics процесса (None, если METRICS_PORT = 0)
+async def start_metrics(port):
+    if not METRICS_PORT:
+        return None
+    try:
+        runner = await serve_metrics(METRICS_HOST, port)
+    except OSError as e:
+        logger.error("Failed to start metrics endpoint on port %s: %s", port, e)
+        return None
+    logger.info("Metrics available at http://%s:%s/metrics", METRICS_HOST, port)
+    return runner
+
+
+# Копирование строк из базы (STORAGE_BACKEND=sql) в Google Sheets: та же
+# очередь записи, но журналом служит таблица sheets_outbox в базе, а
+# хранилищем - лист. Пока Google недоступен, строки ждут в базе.
+async def start_sheets_replica():
+    global sheets_replica
+    if STORAGE_BACKEND != 'sql' or not SHEETS_SYNC:
+        return
+    sheets = await connect_sheets()
+    sheets_replica = WriteBehindQueue(
+        sheets, SHEET_HEADERS, storage.replication_log(),
+        max_batch=SHEETS_BATCH_SIZE,
+        flush_interval=SHEETS_FLUSH_INTERVAL_MS / 1000,
+        max_retry_delay=SHEETS_MAX_RETRY_DELAY,
+        poll_interval=SHEETS_FLUSH_INTERVAL_MS / 1000
+    )
+    REGISTRY.gauge("sheets_replica_pending", lambda: len(sheets_replica))
+    await sheets_replica.start()
+
+
+# Рабочий процесс (BOT_WORKERS > 1)
+def run_worker(index, queue, log_queue):
+    # Лог рабочего процесса пишет главный процесс
+    forward_logging(log_queue, level=LOG_LEVEL)
+    asyncio.run(worker_main(index, queue))
+
+
+async def worker_main(index, queue):
+    global storage, write_queue, mirror, rates, notifications
+    storage = None
+    mirror = SheetMirror(MIRROR_PATH)
+    # Уведомления отправляет главный процесс, здесь - только подписка /digest
+    notifications = NotificationScheduler(NOTIFY_PATH, NOTIFICATION_HANDLERS)
+    rates = open_rate_table()
+    # Запись идет через общий журнал, поэтому без подключения к Google процесс продолжает работу
+    await connect_storage(sharded=False)
+    write_queue = create_write_queue()
+    # Общий лимит Telegram делится между рабочими процессами и главным (уведомления)
+    send_scheduler.set_global_rate(TELEGRAM_GLOBAL_RATE / (BOT_WORKERS + 1))
+    metrics_runner = await start_metrics(METRICS_PORT + 1 + index)
+    # Сводку воронки по событиям всех процессов пишет в лог главный процесс
+    funnel_task = asyncio.create_task(funnel.persist_forever(FUNNEL_PERSIST_INTERVAL))
+    logger.info("Worker %s started", index)
+    try:
+        await serve_shard(queue, lambda update: dp.feed_raw_update(bot, update))
+    finally:
+        funnel_task.cancel()
+        await funnel.persist()
+        funnel.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        write_queue.outbox.close()
+        mirror.close()
+        notifications.close()
+        if rates is not None:
+            rates.close()
+        if storage is not None:
+            storage.close()
+        await send_scheduler.close()
+        await bot.session.close()
+
+
+# Главный процесс при BOT_WORKERS > 1: получает апдейты и раздает их рабочим процессам
+async def run_gateway():
+    log_queue = multiprocessing.get_context('spawn').Queue()
+    worker_logs = start_listener(log_queue, LOG_SINKS)
+    router = UpdateRouter(BOT_WORKERS, run_worker, args=(log_queue,))
+    router.start()
+    try:
+        if RUN_MODE == 'webhook':
+            app = create_gateway_app(router, WEBHOOK_PATH, WEBHOOK_SECRET)
+            await serve_webhook(app, bot, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_HOST, WEBHOOK_PORT,
+                                WEBHOOK_SECRET, dp.resolve_used_update_types())
+        else:
+            await bot.delete_webhook()
+            await poll_updates(bot, router, dp.resolve_used_update_types())
+    finally:
+        await router.stop()
+        worker_logs.stop()
+        await bot.session.close()
+
+
 # Запуск бота
 async def main():
-    # Подключение к Google Sheets
+    global write_queue, mirror, rates, notifications, log_listener
+    log_listener = setup_logging(LOG_SINKS, level=LOG_LEVEL)
+    await connect_storage()
+    await start_sheets_replica()
+    # Заголовки таблицы создает очередь записи перед первой отправкой
+    sheets = sheets_replica.storage if sheets_replica is not None else storage
+    sheets_maintenance = asyncio.create_task(
+        sheets.maintain_forever(SHEETS_TOKEN_REFRESH_MARGIN, SHEETS_KEEPALIVE_INTERVAL)
+    )
     try:
-        creds = Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SCOPES)
-        client = gspread.authorize(creds)
-        global sheet
-        sheet = client.open_by_key(SPREADSHEET_ID).sheet1
-        logger.info(f"{EMOJI['done']} Успешное подключение к Google Sheets")
-
-        # Проверяем и создаем заголовки если нужно
-        if not sheet.get_all_values():
-            sheet.append_row([
-                "Категория актива", "Подкатегория актива", "Название актива",
-                "Количество", "Валюта", "Дата входа/покупки", "Цена входа/покупки",
-                "Дата выхода/продажи", "Цена выхода/продажи",
-                "Ссылка на изображение", "Имя", "Email", "Телефон", "Пользователь"
-            ])
-            logger.info("Created headers in Google Sheets")
-
+        rates = open_rate_table()
     except Exception as e:
-        logger.error(f"{EMOJI['error']} Ошибка подключения: {e}")
+        logger.error("%s Ошибка загрузки курсов валют: %s", EMOJI['error'], e)
         exit()
 
-    logger.info("Starting bot...")
-    await dp.start_polling(bot)
+    # Копию листа пополняют отправленные ботом строки, а синхронизация
+    # докачивает то, что добавили в таблицу вручную
+    mirror = SheetMirror(MIRROR_PATH)
+    mirror_sync = asyncio.create_task(mirror.sync_forever(storage, MIRROR_SYNC_INTERVAL))
+
+    # Напоминания и сводки по расписанию, которое пополняется из копии листа
+    notifications = NotificationScheduler(NOTIFY_PATH, NOTIFICATION_HANDLERS, tick=NOTIFY_TICK)
+    notifications_refresh = asyncio.create_task(refresh_notifications_forever(MIRROR_SYNC_INTERVAL))
+    notifications_task = asyncio.create_task(notifications.run_forever())
+    if BOT_WORKERS > 1:
+        send_scheduler.set_global_rate(TELEGRAM_GLOBAL_RATE / (BOT_WORKERS + 1))
+
+    # Строки рабочих процессов появляются в журнале без ведома главного процесса
+    write_queue = create_write_queue(
+        poll_interval=SHEETS_FLUSH_INTERVAL_MS / 1000 if BOT_WORKERS > 1 else None
+    )
+    REGISTRY.gauge("sheets_write_queue_pending", lambda: len(write_queue))
+    REGISTRY.gauge("telegram_send_queue_pending", lambda: len(send_scheduler))
+    REGISTRY.gauge("notifications_scheduled", lambda: len(notifications))
+    metrics_runner = await start_metrics(METRICS_PORT)
+    funnel_task = asyncio.create_task(funnel.refresh_forever(FUNNEL_INTERVAL, FUNNEL_ABANDON_AFTER, log_funnel))
+    funnel_persist = asyncio.create_task(funnel.persist_forever(FUNNEL_PERSIST_INTERVAL))
+    # Истекшие анкеты в SQLite удаляет только главный процесс: рабочие пишут в тот же файл
+    fsm_purge = asyncio.create_task(fsm_storage.purge_forever()) if FSM_STORAGE == 'sqlite' else None
+    logger.info("Starting bot in %s mode with %s worker(s)...", RUN_MODE, BOT_WORKERS)
+    await write_queue.start()
+    try:
+        if BOT_WORKERS > 1:
+            await run_gateway()
+        elif RUN_MODE == 'webhook':
+            await run_webhook(dp, bot, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_SECRET)
+        else:
+            # Telegram не отдает апдейты через getUpdates, пока установлен вебхук
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        mirror_sync.cancel()
+        sheets_maintenance.cancel()
+        funnel_task.cancel()
+        funnel_persist.cancel()
+        if fsm_purge is not None:
+            fsm_purge.cancel()
+        notifications_refresh.cancel()
+        notifications_task.cancel()
+        await send_scheduler.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await write_queue.stop()
+        write_queue.outbox.close()
+        if sheets_replica is not None:
+            await sheets_replica.stop()
+            sheets_replica.storage.close()
+        await funnel.persist()
+        funnel.close()
+        mirror.close()
+        notifications.close()
+        if rates is not None:
+            rates.close()
+        storage.close()
 
 
 if __name__ == "__main__":
-    import asyncio
-
-    asyncio.run(main())
\ No newline at end of file
+    try:
+        asyncio.run(main())
+    finally:
+        # Дописываем записи, оставшиеся в очереди лога
+        if log_listener is not None:
+            log_listener.stop()
\ No newline at end of file
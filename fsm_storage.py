@@ -0,0 +1,120 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+from aiogram.fsm.storage.memory import MemoryStorage
+
+logger = logging.getLogger(__name__)
+
+
+# Хранилище состояний анкеты во встроенной SQLite.
+# Переживает перезапуск бота и может использоваться несколькими процессами
+# на одной машине. Анкета, которую не трогали дольше ttl секунд, считается
+# брошенной: она не возвращается, а с диска ее удаляет фоновая задача
+# purge_forever раз в purge_interval секунд.
+class SQLiteStorage(BaseStorage):
+    def __init__(self, path, ttl=None, purge_interval=600):
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self.key_builder = DefaultKeyBuilder(with_destiny=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS fsm ("
+            "key TEXT PRIMARY KEY, "
+            "state TEXT, "
+            "data TEXT NOT NULL DEFAULT '{}', "
+            "expires_at REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS fsm_expires_at ON fsm (expires_at)")
+
+    def _expires_at(self, now):
+        return now + self.ttl if self.ttl else None
+
+    def _read(self, key, column):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {column} FROM fsm WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (key, now)
+            ).fetchone()
+        return row[0] if row else None
+
+    # Запись одного поля; если запись уже истекла, вторая половина анкеты сбрасывается
+    def _write(self, key, state=None, data=None):
+        now = time.time()
+        with self._lock, self._conn:
+            expired = "fsm.expires_at IS NOT NULL AND fsm.expires_at <= :now"
+            if data is None:
+                self._conn.execute(
+                    "INSERT INTO fsm (key, state, expires_at) VALUES (:key, :state, :expires_at) "
+                    "ON CONFLICT(key) DO UPDATE SET state = excluded.state, "
+                    f"data = CASE WHEN {expired} THEN '{{}}' ELSE fsm.data END, "
+                    "expires_at = excluded.expires_at",
+                    {"key": key, "state": state, "expires_at": self._expires_at(now), "now": now}
+                )
+            else:
+                self._conn.execute(
+                    "INSERT INTO fsm (key, data, expires_at) VALUES (:key, :data, :expires_at) "
+                    "ON CONFLICT(key) DO UPDATE SET data = excluded.data, "
+                    f"state = CASE WHEN {expired} THEN NULL ELSE fsm.state END, "
+                    "expires_at = excluded.expires_at",
+                    {"key": key, "data": data, "expires_at": self._expires_at(now), "now": now}
+                )
+            # Завершенные и сброшенные анкеты не храним
+            self._conn.execute("DELETE FROM fsm WHERE key = ? AND state IS NULL AND data = '{}'", (key,))
+
+    # Удаляет истекшие анкеты, возвращает их число
+    def purge(self):
+        with self._lock, self._conn:
+            return self._conn.execute("DELETE FROM fsm WHERE expires_at <= ?", (time.time(),)).rowcount
+
+    # Первая очистка - сразу при запуске: за время простоя анкеты могли истечь
+    async def purge_forever(self):
+        while True:
+            try:
+                purged = await asyncio.to_thread(self.purge)
+                if purged:
+                    logger.info("Purged %s expired FSM records", purged)
+            except sqlite3.Error as e:
+                logger.error("Failed to purge expired FSM records: %s", e)
+            await asyncio.sleep(self.purge_interval)
+
+    async def set_state(self, key, state=None):
+        state = state.state if isinstance(state, State) else state
+        await asyncio.to_thread(self._write, self.key_builder.build(key), state=state)
+
+    async def get_state(self, key):
+        return await asyncio.to_thread(self._read, self.key_builder.build(key), "state")
+
+    async def set_data(self, key, data):
+        data = json.dumps(dict(data), ensure_ascii=False)
+        await asyncio.to_thread(self._write, self.key_builder.build(key), data=data)
+
+    async def get_data(self, key):
+        data = await asyncio.to_thread(self._read, self.key_builder.build(key), "data")
+        return json.loads(data) if data else {}
+
+    async def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# Выбор хранилища состояний по настройке FSM_STORAGE: memory, redis или sqlite
+def create_fsm_storage(kind="memory", redis_url=None, sqlite_path="fsm.sqlite3", ttl=None):
+    if kind == "memory":
+        return MemoryStorage()
+    if kind == "redis":
+        # redis - необязательная зависимость, нужна только для этого режима
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage.from_url(redis_url, state_ttl=ttl, data_ttl=ttl)
+    if kind == "sqlite":
+        return SQLiteStorage(sqlite_path, ttl=ttl)
+    raise ValueError(f"Unknown FSM storage: {kind}")
@@ -0,0 +1,153 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+# Журнал переходов по шагам анкеты в кольцевом буфере фиксированного размера.
+# Запись события - три присваивания в заранее выделенные массивы, поэтому
+# не замедляет обработчики; самые старые события перезаписываются.
+# stages - шаги в порядке анкеты, последний означает, что анкета отправлена.
+# Если задан path, события периодически (persist) дописываются в общий файл
+# SQLite, где хранятся последние capacity событий всех процессов бота, и
+# сводка строится по нему: при BOT_WORKERS > 1 у каждого рабочего процесса
+# своя часть пользователей.
+class FunnelRecorder:
+    def __init__(self, stages, capacity=100_000, path=None):
+        self.stages = list(stages)
+        self.index = {stage: i for i, stage in enumerate(self.stages)}
+        self.capacity = capacity
+        self.user_ids = np.zeros(capacity, dtype=np.int64)
+        self.stage_ids = np.zeros(capacity, dtype=np.int16)
+        self.times = np.zeros(capacity, dtype=np.float64)
+        self.written = 0
+        self.persisted = 0
+        self.report = None
+        self._conn = None
+        self._lock = threading.Lock()
+        if path is not None:
+            self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS events ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "user_id INTEGER NOT NULL, "
+                "stage TEXT NOT NULL, "
+                "time REAL NOT NULL)"
+            )
+
+    # Пользователь перешел на шаг stage
+    def record(self, user_id, stage):
+        position = self.written % self.capacity
+        self.user_ids[position] = user_id
+        self.stage_ids[position] = self.index[stage]
+        self.times[position] = time.time()
+        self.written += 1
+
+    # Копия накопленных событий (делается в потоке цикла событий, расчет - где угодно)
+    def snapshot(self):
+        size = min(self.written, self.capacity)
+        return self.user_ids[:size].copy(), self.stage_ids[:size].copy(), self.times[:size].copy()
+
+    # Копия событий с persisted по written, еще не записанных в общий файл, в порядке записи
+    def _unpersisted(self, written):
+        first = max(self.persisted, written - self.capacity)
+        positions = np.arange(first, written) % self.capacity
+        return self.user_ids[positions], self.stage_ids[positions], self.times[positions]
+
+    def _store(self, user_ids, stage_ids, times):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO events (user_id, stage, time) VALUES (?, ?, ?)",
+                zip(user_ids.tolist(), [self.stages[stage_id] for stage_id in stage_ids.tolist()], times.tolist())
+            )
+            self._conn.execute("DELETE FROM events WHERE id <= (SELECT MAX(id) FROM events) - ?", (self.capacity,))
+
+    # События всех процессов из общего файла; шаги, которых нет в этой версии анкеты, пропускаются
+    def _load(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT user_id, stage, time FROM events ORDER BY id").fetchall()
+        rows = [(user_id, self.index[stage], at) for user_id, stage, at in rows if stage in self.index]
+        return (np.array([row[0] for row in rows], dtype=np.int64),
+                np.array([row[1] for row in rows], dtype=np.int16),
+                np.array([row[2] for row in rows], dtype=np.float64))
+
+    # Дописывает новые события в общий файл
+    async def persist(self):
+        written = self.written
+        if self._conn is None or self.persisted == written:
+            return
+        await asyncio.to_thread(self._store, *self._unpersisted(written))
+        self.persisted = written
+
+    async def refresh(self, abandon_after=1800):
+        if self._conn is None:
+            snapshot = self.snapshot()
+        else:
+            await self.persist()
+            snapshot = await asyncio.to_thread(self._load)
+        self.report = await asyncio.to_thread(aggregate, self.stages, *snapshot, abandon_after=abandon_after)
+        return self.report
+
+    # Периодическая запись событий в общий файл
+    async def persist_forever(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.persist()
+            except Exception as e:
+                logger.error("Failed to persist funnel events: %s", e)
+
+    # Периодический пересчет сводки; on_report получает каждую новую сводку
+    async def refresh_forever(self, interval, abandon_after=1800, on_report=None):
+        while True:
+            await asyncio.sleep(interval)
+            report = await self.refresh(abandon_after)
+            if on_report is not None:
+                on_report(report)
+
+    def close(self):
+        if self._conn is not None:
+            with self._lock:
+                self._conn.close()
+
+
+# Сводка по шагам: сколько пользователей дошло до шага, доля от начавших
+# анкету, медианное время на шаге и сколько пользователей бросили анкету на
+# этом шаге (последнее событие старше abandon_after секунд).
+def aggregate(stages, user_ids, stage_ids, times, abandon_after=1800, now=None):
+    now = time.time() if now is None else now
+    order = np.lexsort((times, user_ids))
+    user_ids, stage_ids, times = user_ids[order], stage_ids[order], times[order]
+
+    # Время на шаге - до следующего события того же пользователя
+    same_user = np.zeros(len(user_ids), dtype=bool)
+    same_user[:-1] = user_ids[1:] == user_ids[:-1]
+    dwell = np.full(len(times), np.nan)
+    dwell[:-1] = np.where(same_user[:-1], times[1:] - times[:-1], np.nan)
+    last = ~same_user
+    abandoned = last & (now - times > abandon_after) & (stage_ids != len(stages) - 1)
+
+    # Уникальные пары (пользователь, шаг): повторные заходы на шаг не считаются
+    pairs = np.unique(user_ids.astype(np.int64) * len(stages) + stage_ids)
+    reached = np.bincount(pairs % len(stages), minlength=len(stages))
+    started = reached[0] or 1
+
+    report = []
+    for stage_id, stage in enumerate(stages):
+        mask = stage_ids == stage_id
+        stage_dwell = dwell[mask & ~np.isnan(dwell)]
+        report.append({
+            "stage": stage,
+            "users": int(reached[stage_id]),
+            "conversion": float(reached[stage_id] / started),
+            "median_dwell": float(np.median(stage_dwell)) if len(stage_dwell) else None,
+            "abandoned": int(np.count_nonzero(abandoned & mask)),
+        })
+    return report
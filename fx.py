@@ -0,0 +1,121 @@
+import csv
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def day_number(day):
+    return int(np.datetime64(day, "D").astype(np.int64))
+
+
+# Код валюты из значения в таблице: "USD (Доллар)" -> "USD"
+def currency_code(value):
+    return value.split()[0].upper() if value and value.split() else ""
+
+
+# Источник курсов из CSV-файла со строками "дата,валюта,курс" (дата ГГГГ-ММ-ДД).
+# Курс - стоимость одной единицы валюты в валюте котировки (quote).
+# На выходные и праздники берется последний известный курс до этой даты,
+# поэтому вместе с курсом возвращается день, на который он установлен.
+class CSVRateProvider:
+    def __init__(self, path, quote="RUB"):
+        self.quote = quote
+        series = {}
+        with open(path, newline="", encoding="utf-8") as file:
+            for row in csv.reader(file):
+                if len(row) < 3 or not row[0][:1].isdigit():
+                    continue  # Заголовок и пустые строки
+                series.setdefault(row[1].strip().upper(), []).append(
+                    (day_number(row[0].strip()), float(row[2].replace(",", ".")))
+                )
+        self._series = {}
+        for code, points in series.items():
+            points.sort()
+            self._series[code] = (np.array([d for d, _ in points]), np.array([r for _, r in points]))
+
+    # Курсы на день day (номер дня от 1970-01-01): {код: (курс, день курса)}
+    def rates(self, day):
+        result = {self.quote: (1.0, day)}
+        for code, (days, values) in self._series.items():
+            index = np.searchsorted(days, day, side="right") - 1
+            if index >= 0:
+                result[code] = (float(values[index]), int(days[index]))
+        return result
+
+
+# Таблица курсов по дням: последние max_days дней в памяти (LRU), а на
+# диске (SQLite) - курсы, установленные именно на запрошенный день, поэтому
+# за ними провайдер не опрашивается даже после перезапуска. Последний
+# известный курс, взятый вместо недостающего, хранится только в памяти:
+# после перезапуска день запрашивается снова, и если у провайдера появился
+# настоящий курс, используется он.
+class RateTable:
+    def __init__(self, provider, currencies, path, max_days=4096):
+        self.provider = provider
+        self.currencies = list(currencies)
+        self.index = {code: i for i, code in enumerate(self.currencies)}
+        self.max_days = max_days
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # В прежней таблице rates курсы прошлых дней могли быть записаны под более поздними датами
+        self._conn.execute("DROP TABLE IF EXISTS rates")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS exact_rates (day INTEGER PRIMARY KEY, rates TEXT NOT NULL)")
+
+    def _vector(self, rates):
+        return np.array([rates.get(code, np.nan) for code in self.currencies], dtype=np.float64)
+
+    # Курсы всех валют на один день в порядке self.currencies
+    def day_rates(self, day):
+        with self._lock:
+            vector = self._memory.get(day)
+            if vector is not None:
+                self._memory.move_to_end(day)
+                return vector
+            row = self._conn.execute("SELECT rates FROM exact_rates WHERE day = ?", (day,)).fetchone()
+            rates = json.loads(row[0]) if row is not None else {}
+            if not rates.keys() >= set(self.currencies):
+                fetched = self.provider.rates(day)
+                exact = {code: rate for code, (rate, rate_day) in fetched.items() if rate_day == day}
+                if exact.keys() - rates.keys():
+                    with self._conn:
+                        self._conn.execute("INSERT OR REPLACE INTO exact_rates (day, rates) VALUES (?, ?)",
+                                           (day, json.dumps({**rates, **exact})))
+                rates = {**{code: rate for code, (rate, _) in fetched.items()}, **rates}
+            vector = self._memory[day] = self._vector(rates)
+            if len(self._memory) > self.max_days:
+                self._memory.popitem(last=False)
+            return vector
+
+    # Пересчет сумм в валюту base на заданные дни (номера дней, nan - дата неизвестна).
+    # Курсы запрашиваются по одному разу на каждый различный день, после чего
+    # коэффициенты для всех строк берутся одной индексацией матрицы курсов.
+    def convert(self, amounts, currencies, days, base):
+        if base not in self.index:
+            raise ValueError(f"Unknown base currency: {base}")
+        amounts = np.asarray(amounts, dtype=np.float64)
+        days = np.asarray(days, dtype=np.float64)
+        if not len(amounts):
+            return np.empty(0, dtype=np.float64)
+
+        names, currency_index = np.unique(np.asarray(currencies, dtype=str), return_inverse=True)
+        columns = np.array([self.index.get(currency_code(name), -1) for name in names])[currency_index]
+
+        known = ~np.isnan(days)
+        unique_days, day_index = np.unique(days[known].astype(np.int64), return_inverse=True)
+        matrix = np.full((len(unique_days) + 1, len(self.currencies) + 1), np.nan)
+        for i, day in enumerate(unique_days):
+            matrix[i, :-1] = self.day_rates(int(day))
+        rows = np.full(len(days), len(unique_days))  # Последняя строка матрицы - неизвестная дата
+        rows[known] = day_index
+
+        with np.errstate(invalid="ignore"):
+            return amounts * matrix[rows, columns] / matrix[rows, self.index[base]]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,101 @@
+import codecs
+import csv
+from datetime import date, datetime
+from typing import NamedTuple
+
+# Форматы файлов импорта по расширению
+FORMATS = {".csv": "csv", ".txt": "csv", ".xlsx": "xlsx"}
+
+
+class ImportResult(NamedTuple):
+    rows: list
+    total: int
+    rejected: int
+    errors: list  # [(номер строки файла, описание)] для первых max_errors отказов
+    truncated: bool
+
+
+# Значение ячейки в том виде, в каком его ввел бы пользователь
+def _cell(value):
+    if value is None:
+        return ""
+    if isinstance(value, (datetime, date)):
+        return value.strftime("%d.%m.%Y")
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+# Строки CSV по одной. Кодировка (UTF-8 или Windows-1251 из Excel) и
+# разделитель (запятая или точка с запятой) определяются по началу файла.
+def _csv_rows(path):
+    with open(path, "rb") as file:
+        head = file.read(64 * 1024)
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(head, final=False)
+        encoding = "utf-8-sig"
+    except UnicodeDecodeError:
+        encoding = "cp1251"
+    sample = head.decode(encoding, errors="ignore")
+    try:
+        dialect = csv.Sniffer().sniff(sample.split("\n", 1)[0], delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    with open(path, newline="", encoding=encoding, errors="replace") as file:
+        yield from csv.reader(file, dialect)
+
+
+# Строки первого листа XLSX по одной (openpyxl в режиме только чтения не
+# загружает лист в память целиком)
+def _xlsx_rows(path):
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        for row in workbook.active.iter_rows(values_only=True):
+            yield [_cell(value) for value in row]
+    finally:
+        workbook.close()
+
+
+def read_table(path, kind):
+    return _csv_rows(path) if kind == "csv" else _xlsx_rows(path)
+
+
+# Потоковый разбор файла импорта.
+# columns: название колонки в заголовке (в нижнем регистре) -> поле;
+# required: поля, без которых файл не принимается;
+# validate(values) -> строка для таблицы или ValueError с описанием ошибки;
+# titles: поле -> название колонки для сообщений об ошибках.
+# Читается не больше max_rows строк данных, пустые строки пропускаются.
+def import_table(path, kind, columns, required, validate, max_rows, max_errors=20, titles=None):
+    rows = iter(read_table(path, kind))
+    header = next(rows, None)
+    if header is None:
+        raise ValueError("файл пустой")
+    fields = [(index, columns.get(str(name).strip().lower())) for index, name in enumerate(header)]
+    fields = [(index, field) for index, field in fields if field is not None]
+    missing = [field for field in required if field not in {field for _, field in fields}]
+    if missing:
+        titles = titles or {}
+        raise ValueError(f"нет колонок: {', '.join(titles.get(field, field) for field in missing)}")
+
+    accepted = []
+    errors = []
+    total = rejected = 0
+    truncated = False
+    for line, row in enumerate(rows, start=2):
+        if not any(str(cell).strip() for cell in row):
+            continue
+        if total == max_rows:
+            truncated = True
+            break
+        total += 1
+        values = {field: str(row[index]).strip() if index < len(row) else "" for index, field in fields}
+        try:
+            accepted.append(validate(values))
+        except ValueError as e:
+            rejected += 1
+            if len(errors) < max_errors:
+                errors.append((line, str(e)))
+    return ImportResult(accepted, total, rejected, errors, truncated)
@@ -0,0 +1,180 @@
+import time
+from bisect import bisect_left
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.fsm.storage.base import BaseStorage
+from aiohttp import web
+
+# Границы корзин гистограмм задержки, с
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+# Набор метрик процесса в текстовом формате Prometheus.
+# Все измерения делаются в потоке цикла событий, поэтому счетчики
+# обновляются без блокировок; метрики создаются при первом обращении.
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._types = {}
+        self._gauges = {}
+
+    def _get(self, kind, name, labels):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            metric = self._metrics[key] = Histogram() if kind == "histogram" else Counter()
+            self._types[name] = kind
+        return metric
+
+    def counter(self, name, **labels):
+        return self._get("counter", name, labels)
+
+    def histogram(self, name, **labels):
+        return self._get("histogram", name, labels)
+
+    # Значение, которое считывается в момент запроса метрик (например, длина очереди)
+    def gauge(self, name, read):
+        self._gauges[name] = read
+
+    def render(self):
+        lines = []
+        typed = set()
+        for (name, labels), metric in sorted(self._metrics.items(), key=lambda item: item[0]):
+            if name not in typed:
+                lines.append(f"# TYPE {name} {self._types[name]}")
+                typed.add(name)
+            if isinstance(metric, Counter):
+                lines.append(f"{name}{_labels(labels)} {metric.value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.buckets, metric.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(labels + (('le', repr(bound)),))} {cumulative}")
+            lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {metric.count}")
+            lines.append(f"{name}_sum{_labels(labels)} {metric.sum}")
+            lines.append(f"{name}_count{_labels(labels)} {metric.count}")
+        for name, read in sorted(self._gauges.items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {read()}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        pairs.append(f'{key}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+REGISTRY = Registry()
+
+
+# Время работы обработчиков по имени обработчика и шагу анкеты
+class HandlerMetricsMiddleware(BaseMiddleware):
+    def __init__(self, registry=REGISTRY):
+        self.registry = registry
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object is not None else "unknown"
+        state = data.get("raw_state") or "none"
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            self.registry.counter("bot_handler_errors_total", handler=name, state=state).inc()
+            raise
+        finally:
+            self.registry.histogram("bot_handler_seconds", handler=name, state=state).observe(
+                time.perf_counter() - started
+            )
+
+
+# Время запросов к Bot API по методам
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    def __init__(self, registry=REGISTRY):
+        self.registry = registry
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            self.registry.counter("telegram_request_errors_total", method=name).inc()
+            raise
+        finally:
+            self.registry.histogram("telegram_request_seconds", method=name).observe(time.perf_counter() - started)
+
+
+# Обертка хранилища состояний, которая меряет время каждого обращения
+class InstrumentedStorage(BaseStorage):
+    def __init__(self, storage, registry=REGISTRY):
+        self.storage = storage
+        self.registry = registry
+
+    async def _timed(self, operation, call):
+        started = time.perf_counter()
+        try:
+            return await call
+        finally:
+            self.registry.histogram("fsm_storage_seconds", operation=operation).observe(
+                time.perf_counter() - started
+            )
+
+    async def set_state(self, key, state=None):
+        return await self._timed("set_state", self.storage.set_state(key, state))
+
+    async def get_state(self, key):
+        return await self._timed("get_state", self.storage.get_state(key))
+
+    async def set_data(self, key, data):
+        return await self._timed("set_data", self.storage.set_data(key, data))
+
+    async def get_data(self, key):
+        return await self._timed("get_data", self.storage.get_data(key))
+
+    async def close(self):
+        await self.storage.close()
+
+
+# Локальный HTTP-эндпоинт /metrics для Prometheus
+async def serve_metrics(host, port, registry=REGISTRY):
+    async def handle(request):
+        return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
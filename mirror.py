@@ -0,0 +1,180 @@
+import asyncio
+import json
+import logging
+import re
+import sqlite3
+import threading
+
+from assets import COLUMN
+
+logger = logging.getLogger(__name__)
+
+# Номер первой строки из ответа Sheets API на append: "'Лист1'!A5:N7" -> 5
+_UPDATED_RANGE = re.compile(r"![A-Za-z]*(\d+)")
+
+# Строки листа шарда хранятся под номерами base + номер строки в листе,
+# base = номер шарда * LINE_SPAN (лист без шардов - шард 0)
+LINE_SPAN = 10_000_000
+
+
+# Telegram id из колонки "ID пользователя" (None, если колонки нет или она не заполнена)
+def row_user_id(row):
+    column = COLUMN["user_id"]
+    value = str(row[column]).strip() if len(row) > column else ""
+    return int(value) if value.isascii() and value.isdigit() else None
+
+
+# Локальная копия листа Google Sheets (SQLite в режиме WAL) для чтения без сети.
+# Строки хранятся под своими номерами в листе и проиндексированы по Telegram id
+# из колонки "ID пользователя": строки пользователя ищутся только по нему, а не
+# по имени, которое может совпадать у разных людей. Строки без id (записанные
+# до появления колонки или добавленные вручную) никому не показываются.
+# Копия пополняется строками, которые бот записал сам, а sync() докачивает
+# строки, добавленные в лист кем-то еще.
+class SheetMirror:
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        # Копия прежнего формата (поиск по имени) удаляется и докачивается из листа заново
+        columns = [column for _, column, *_ in self._conn.execute("PRAGMA table_info(rows)")]
+        if columns and "user_id" not in columns:
+            self._conn.execute("DROP TABLE rows")
+        self._conn.execute("DROP TABLE IF EXISTS users")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS rows ("
+            "line INTEGER PRIMARY KEY, "
+            "user_id INTEGER, "
+            "row TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS rows_user_id ON rows (user_id)")
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM rows").fetchone()[0]
+
+    # Строки листа, начиная с номера first_line
+    def store(self, first_line, rows):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO rows (line, user_id, row) VALUES (?, ?, ?)",
+                [
+                    (line, row_user_id(row), json.dumps(row, ensure_ascii=False))
+                    for line, row in enumerate(rows, start=first_line)
+                ]
+            )
+
+    # Первая строка листа шарда (после заголовка), которой еще нет в копии
+    def first_missing_line(self, base=0):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COALESCE(MIN(line + 1), ? + 2) FROM "
+                "(SELECT ? + 1 AS line UNION ALL SELECT line FROM rows WHERE line > ? AND line < ?) "
+                "WHERE line + 1 NOT IN (SELECT line FROM rows)",
+                (base, base, base, base + LINE_SPAN)
+            ).fetchone()[0]
+
+    def last_line(self, base=0):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COALESCE(MAX(line), ? + 1) FROM rows WHERE line > ? AND line < ?",
+                (base, base, base + LINE_SPAN)
+            ).fetchone()[0]
+
+    # Смещения шардов, строки которых есть в копии
+    def line_bases(self):
+        with self._lock:
+            return [base for base, in self._conn.execute(
+                "SELECT DISTINCT line / ? * ? FROM rows", (LINE_SPAN, LINE_SPAN)
+            )]
+
+    def clear(self, base=0):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM rows WHERE line > ? AND line < ?", (base, base + LINE_SPAN))
+
+    # Все строки пользователя в порядке листа
+    def user_rows(self, user_id):
+        return list(self.iter_user_rows(user_id))
+
+    # То же постранично: блокировка берется на одну страницу, а не на весь обход
+    def iter_user_rows(self, user_id, page_size=500):
+        line = 0
+        while True:
+            with self._lock:
+                page = self._conn.execute(
+                    "SELECT line, row FROM rows WHERE user_id = ? AND line > ? ORDER BY line LIMIT ?",
+                    (user_id, line, page_size)
+                ).fetchall()
+            for line, row in page:
+                yield json.loads(row)
+            if len(page) < page_size:
+                return
+
+    # Отпечаток строк пользователя (количество и последняя строка) - меняется при добавлении и удалении
+    def user_version(self, user_id):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*), COALESCE(MAX(line), 0) FROM rows WHERE user_id = ?", (user_id,)
+            ).fetchone()
+
+    # Строки с Telegram id с номерами от after_line (не включая) до before_line:
+    # [(номер строки, user_id, строка), ...]
+    def rows_with_users(self, after_line=0, before_line=None):
+        with self._lock:
+            cursor = self._conn.execute(
+                "SELECT line, user_id, row FROM rows "
+                "WHERE user_id IS NOT NULL AND line > ? AND line < ? ORDER BY line",
+                (after_line, before_line if before_line is not None else 2 ** 62)
+            )
+            return [(line, user_id, json.loads(row)) for line, user_id, row in cursor]
+
+    # Строки, которые бот только что добавил в лист; номер первой берется из ответа API,
+    # смещение шарда - из поля lineBase, которое добавляет хранилище с шардами.
+    # Если ответа нет, строки докачает следующая синхронизация.
+    def store_appended(self, response, rows):
+        try:
+            first_line = int(_UPDATED_RANGE.search(response["updates"]["updatedRange"]).group(1))
+        except (TypeError, KeyError, AttributeError):
+            return False
+        self.store(response.get("lineBase", 0) + first_line, rows)
+        return True
+
+    # Докачивает строки всех шардов, которых нет в копии
+    async def sync(self, storage, chunk_size=5000):
+        fetched = 0
+        for base, shard in storage.shards():
+            fetched += await self._sync_shard(storage, base, shard, chunk_size)
+        if fetched:
+            logger.info("Synced %s rows into local mirror", fetched)
+        return fetched
+
+    # Сравнивается только число строк: если лист стал короче (строки удалили),
+    # копия шарда собирается заново
+    async def _sync_shard(self, storage, base, shard, chunk_size):
+        total = await storage.count_rows(shard)
+        if total < await asyncio.to_thread(self.last_line, base) - base:
+            logger.info("Sheet shrank to %s rows, rebuilding local mirror of shard at %s", total, base)
+            await asyncio.to_thread(self.clear, base)
+        first = await asyncio.to_thread(self.first_missing_line, base) - base
+        fetched = 0
+        while first <= total:
+            last = min(first + chunk_size - 1, total)
+            rows = await storage.get_rows(first, last, shard)
+            await asyncio.to_thread(self.store, base + first, rows)
+            fetched += len(rows)
+            first = last + 1
+        return fetched
+
+    # Периодическая синхронизация; первая проходит сразу при запуске
+    async def sync_forever(self, storage, interval):
+        while True:
+            try:
+                await self.sync(storage)
+            except Exception as e:
+                logger.error("Failed to sync local mirror: %s", e)
+            await asyncio.sleep(interval)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
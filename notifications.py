@@ -0,0 +1,171 @@
+import asyncio
+import heapq
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import NamedTuple
+
+logger = logging.getLogger(__name__)
+
+
+class Job(NamedTuple):
+    key: str
+    user_id: int
+    kind: str
+    payload: dict
+    due: float | None  # None - задача выключена (уже выполнена или пользователь отписался)
+
+
+# Отложенные уведомления пользователям (напоминания, сводки).
+# Задачи хранятся в SQLite (переживают перезапуск), а в памяти - только
+# min-куча (время, ключ), по которой видно, что пора что-то отправить.
+# Раз в tick секунд из кучи забираются до batch_size наступивших задач, их
+# актуальное состояние читается из базы одним запросом, обработчики
+# выполняются параллельно, а новые сроки записываются одной транзакцией.
+# Обработчик handlers[kind](job) возвращает время следующего запуска или
+# None, если задача больше не нужна; при ошибке запуск повторяется через
+# retry_delay секунд. Базу могут менять и другие процессы: reload()
+# перечитывает кучу целиком.
+class NotificationScheduler:
+    def __init__(self, path, handlers, tick=30.0, batch_size=500, retry_delay=3600.0):
+        self.handlers = handlers
+        self.tick = tick
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self._heap = []
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "key TEXT PRIMARY KEY, "
+            "user_id INTEGER NOT NULL, "
+            "kind TEXT NOT NULL, "
+            "payload TEXT NOT NULL, "
+            "due REAL)"
+        )
+
+    def __len__(self):
+        return len(self._heap)
+
+    def _active(self):
+        with self._lock:
+            return self._conn.execute("SELECT due, key FROM jobs WHERE due IS NOT NULL").fetchall()
+
+    # Куча заново по базе: включает задачи, добавленные другими процессами
+    async def reload(self):
+        heap = await asyncio.to_thread(self._active)
+        heapq.heapify(heap)
+        self._heap = heap
+
+    # Новые задачи; уже известные ключи (в том числе выключенные) не меняются
+    def _insert(self, jobs):
+        with self._lock, self._conn:
+            before = self._conn.total_changes
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO jobs (key, user_id, kind, payload, due) VALUES (?, ?, ?, ?, ?)",
+                [(job.key, job.user_id, job.kind, json.dumps(job.payload, ensure_ascii=False), job.due)
+                 for job in jobs]
+            )
+            return self._conn.total_changes - before
+
+    async def add(self, jobs):
+        added = await asyncio.to_thread(self._insert, jobs)
+        if added:
+            # Повторы в куче безвредны: перед запуском задача сверяется с базой
+            for job in jobs:
+                if job.due is not None:
+                    heapq.heappush(self._heap, (job.due, job.key))
+        return added
+
+    # Создает задачу или меняет срок существующей (None - выключить)
+    def _upsert(self, job):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO jobs (key, user_id, kind, payload, due) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET due = excluded.due",
+                (job.key, job.user_id, job.kind, json.dumps(job.payload, ensure_ascii=False), job.due)
+            )
+
+    async def put(self, job):
+        await asyncio.to_thread(self._upsert, job)
+        if job.due is not None:
+            heapq.heappush(self._heap, (job.due, job.key))
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT key, user_id, kind, payload, due FROM jobs WHERE key = ?",
+                                     (key,)).fetchone()
+        return None if row is None else Job(*row[:3], json.loads(row[3]), row[4])
+
+    def _fetch(self, keys):
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT key, user_id, kind, payload, due FROM jobs WHERE key IN ({', '.join('?' * len(keys))})",
+                keys
+            ).fetchall()
+        return [Job(key, user_id, kind, json.loads(payload), due) for key, user_id, kind, payload, due in rows]
+
+    # Новые сроки выполненных задач. Если срок за это время поменяли
+    # (например, из другого процесса), запись не перетирается.
+    def _finish(self, results):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "UPDATE jobs SET due = ? WHERE key = ? AND due = ?",
+                [(next_due, job.key, job.due) for job, next_due in results]
+            )
+
+    async def _handle(self, job):
+        try:
+            return await self.handlers[job.kind](job)
+        except Exception as e:
+            logger.error("Notification %s failed, retrying in %.0f s: %s", job.key, self.retry_delay, e)
+            return time.time() + self.retry_delay
+
+    # Одна пачка наступивших задач; возвращает, сколько выполнено
+    async def run_tick(self, now=None):
+        now = time.time() if now is None else now
+        keys = set()
+        while self._heap and self._heap[0][0] <= now and len(keys) < self.batch_size:
+            keys.add(heapq.heappop(self._heap)[1])
+        if not keys:
+            return 0
+
+        jobs = []
+        for job in await asyncio.to_thread(self._fetch, list(keys)):
+            if job.due is None:
+                continue
+            if job.due > now:
+                # Срок отодвинули после того, как задача попала в кучу
+                heapq.heappush(self._heap, (job.due, job.key))
+                continue
+            jobs.append(job)
+        if not jobs:
+            return 0
+
+        next_dues = await asyncio.gather(*(self._handle(job) for job in jobs))
+        await asyncio.to_thread(self._finish, list(zip(jobs, next_dues)))
+        for job, next_due in zip(jobs, next_dues):
+            if next_due is not None:
+                heapq.heappush(self._heap, (next_due, job.key))
+        logger.info("Sent %s scheduled notifications", len(jobs))
+        return len(jobs)
+
+    async def run_forever(self):
+        await self.reload()
+        while True:
+            try:
+                done = await self.run_tick()
+            except Exception as e:
+                logger.error("Failed to run scheduled notifications: %s", e)
+                done = 0
+            # Полная пачка - вероятно, наступивших задач больше: сразу берем следующую
+            if done < self.batch_size:
+                await asyncio.sleep(self.tick)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,63 @@
+import json
+import sqlite3
+import threading
+import time
+
+
+# Локальный журнал строк для Google Sheets (SQLite в режиме WAL).
+# Каждая строка сначала записывается сюда и удаляется только после того,
+# как Google подтвердил запись, поэтому сбой API или перезапуск бота
+# не теряют анкеты пользователей.
+# Ключи уже принятых анкет (идемпотентности) хранятся key_ttl секунд, чтобы
+# повторная отправка той же анкеты не добавила строки в таблицу второй раз.
+class Outbox:
+    def __init__(self, path, key_ttl=7 * 24 * 3600):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "row TEXT NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS submissions ("
+            "key TEXT PRIMARY KEY, "
+            "created_at REAL NOT NULL)"
+        )
+        with self._conn:
+            self._conn.execute("DELETE FROM submissions WHERE created_at < ?", (time.time() - key_ttl,))
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    # Все строки одной анкеты пишутся одной транзакцией.
+    # Если анкета с таким key уже принята, ничего не пишется и возвращается False.
+    def append(self, rows, key=None):
+        with self._lock, self._conn:
+            if key is not None:
+                try:
+                    self._conn.execute("INSERT INTO submissions (key, created_at) VALUES (?, ?)", (key, time.time()))
+                except sqlite3.IntegrityError:
+                    return False
+            self._conn.executemany(
+                "INSERT INTO outbox (row) VALUES (?)",
+                [(json.dumps(row, ensure_ascii=False),) for row in rows]
+            )
+            return True
+
+    # Самые старые строки в порядке поступления: [(id, row), ...]
+    def peek(self, limit):
+        with self._lock:
+            cursor = self._conn.execute("SELECT id, row FROM outbox ORDER BY id LIMIT ?", (limit,))
+            return [(row_id, json.loads(row)) for row_id, row in cursor]
+
+    def ack(self, ids):
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM outbox WHERE id = ?", [(row_id,) for row_id in ids])
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,184 @@
+import asyncio
+import bisect
+import itertools
+import logging
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты отправки: ответы пользователям уходят раньше массовых рассылок
+INTERACTIVE = 0
+BULK = 1
+
+_priority = ContextVar("send_priority", default=INTERACTIVE)
+
+
+# Все отправки внутри блока (рассылки, напоминания) идут с низким приоритетом
+@contextmanager
+def bulk_sends():
+    token = _priority.set(BULK)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class _Bucket:
+    __slots__ = ("rate", "burst", "tokens", "updated", "paused_until")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+        self.paused_until = 0.0
+
+    # Через сколько секунд появится токен (0 - можно отправлять сейчас)
+    def wait(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.paused_until > now:
+            return self.paused_until - now
+        if self.tokens >= 1 or not self.rate:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+# Отправляют сообщение в чат: на них действуют лимиты Telegram
+def _is_send(method):
+    return type(method).__name__.startswith(("Send", "Forward", "Copy")) and hasattr(method, "chat_id")
+
+
+# Единая очередь исходящих сообщений бота (middleware сессии Bot API).
+# Сообщения уходят не чаще global_rate в секунду на весь бот и chat_rate в
+# секунду в личный чат (group_rate - в группы и каналы), с запасом burst
+# на короткие всплески. Ожидающие отправки выстраиваются по приоритету
+# (INTERACTIVE раньше BULK), внутри приоритета - по порядку. Если Telegram
+# все же ответил RetryAfter, чат ставится на паузу на указанное время,
+# и запрос повторяется до max_retries раз.
+# chat_rate=0 или group_rate=0 снимает ограничение для чатов, а global_rate=0
+# отключает очередь целиком (например, для нагрузочных тестов с заглушкой Bot API).
+# Остальные методы (getUpdates, getFile и т.п.) проходят без очереди.
+class SendScheduler(BaseRequestMiddleware):
+    def __init__(self, global_rate=30.0, chat_rate=1.0, chat_burst=5, group_rate=20 / 60,
+                 max_retries=3, max_chats=100_000, registry=REGISTRY):
+        now = time.monotonic()
+        self.global_bucket = _Bucket(global_rate, max(1.0, global_rate), now)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self.registry = registry
+        self._chats = OrderedDict()
+        self._queue = []  # [(priority, номер, chat_id, future)] по возрастанию
+        self._order = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self._queue)
+
+    # Ограничение общей скорости (у каждого рабочего процесса своя доля)
+    def set_global_rate(self, rate):
+        self.global_bucket.rate = rate
+        self.global_bucket.burst = max(1.0, rate)
+        self.global_bucket.tokens = min(self.global_bucket.tokens, self.global_bucket.burst)
+
+    def _chat(self, chat_id, now):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            private = isinstance(chat_id, int) and chat_id > 0
+            bucket = _Bucket(self.chat_rate if private else self.group_rate,
+                             self.chat_burst if private else 1, now)
+            self._chats[chat_id] = bucket
+            if len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def __call__(self, make_request, bot, method):
+        if not _is_send(method) or not self.global_bucket.rate:
+            return await make_request(bot, method)
+        chat_id = method.chat_id
+        priority = _priority.get()
+        for attempt in itertools.count():
+            await self._acquire(chat_id, priority)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt >= self.max_retries:
+                    raise
+                logger.warning("Telegram flood control for chat %s, retrying in %s s", chat_id, e.retry_after)
+                self.registry.counter("telegram_retry_after_total", method=type(method).__name__).inc()
+                self._chat(chat_id, time.monotonic()).paused_until = time.monotonic() + e.retry_after
+
+    # Ждет своей очереди на отправку в чат chat_id
+    async def _acquire(self, chat_id, priority):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        bisect.insort(self._queue, (priority, next(self._order), chat_id, future), key=lambda item: item[:2])
+        self._wakeup.set()
+        started = time.perf_counter()
+        try:
+            await future
+        finally:
+            self.registry.histogram("telegram_send_wait_seconds", priority=priority).observe(
+                time.perf_counter() - started
+            )
+
+    # Выдает разрешения на отправку: первому в очереди, чей чат не исчерпал лимит
+    async def _run(self):
+        while True:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            now = time.monotonic()
+            delay = self.global_bucket.wait(now)
+            if delay <= 0:
+                delay = None
+                for index, (_, _, chat_id, future) in enumerate(self._queue):
+                    if future.done():
+                        # Отправитель больше не ждет (задачу отменили)
+                        del self._queue[index]
+                        delay = 0
+                        break
+                    chat_delay = self._chat(chat_id, now).wait(now)
+                    if chat_delay <= 0:
+                        del self._queue[index]
+                        self.global_bucket.take()
+                        self._chats[chat_id].take()
+                        future.set_result(None)
+                        delay = 0
+                        break
+                    delay = chat_delay if delay is None else min(delay, chat_delay)
+            if delay:
+                # Новый запрос может оказаться в чате, где лимит не исчерпан
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
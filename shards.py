@@ -0,0 +1,270 @@
+import asyncio
+import logging
+import re
+import sqlite3
+import threading
+import zlib
+from datetime import datetime
+from typing import NamedTuple
+
+import gspread
+
+from assets import COLUMN
+from mirror import LINE_SPAN
+from sheets_storage import SheetsStorage
+from validators import parse_date
+
+logger = logging.getLogger(__name__)
+
+MODES = ("month", "hash")
+
+# Предел Google: ячеек во всех листах одной таблицы
+SPREADSHEET_CELL_LIMIT = 10_000_000
+
+# Название листа шарда: ключ и номер листа, если ключ занимает несколько: "2024-05 (2)"
+_TITLE = re.compile(r"^(.*?)(?: \((\d+)\))?$")
+_KEYS = {"month": re.compile(r"^\d{4}-\d{2}$"), "hash": re.compile(r"^users-\d+$")}
+
+
+# Для новых шардов не осталось таблицы с запасом ячеек
+class ShardCapacityError(RuntimeError):
+    pass
+
+
+class Shard(NamedTuple):
+    id: int
+    key: str
+    seq: int
+    title: str
+    worksheet_id: int
+    rows: int  # строк в листе вместе с заголовком
+    spreadsheet_id: str = ""  # "" - основная таблица
+
+    # Смещение номеров строк шарда в локальной копии листа
+    @property
+    def base(self):
+        return self.id * LINE_SPAN
+
+
+def shard_title(key, seq):
+    return key if seq == 1 else f"{key} ({seq})"
+
+
+# Локальный индекс шардов (SQLite): какой лист таблицы хранит какой ключ и
+# сколько в нем строк. Хранится и в памяти, поэтому выбор листа для записи
+# не требует ни запросов к Google, ни чтения с диска.
+class ShardIndex:
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS shards ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "key TEXT NOT NULL, "
+            "seq INTEGER NOT NULL, "
+            "title TEXT NOT NULL UNIQUE, "
+            "worksheet_id INTEGER NOT NULL, "
+            "rows INTEGER NOT NULL, "
+            "spreadsheet_id TEXT NOT NULL DEFAULT '', "
+            "UNIQUE (key, seq))"
+        )
+        # Индекс прежней версии: все шарды в основной таблице
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(shards)")}
+        if "spreadsheet_id" not in columns:
+            with self._conn:
+                self._conn.execute("ALTER TABLE shards ADD COLUMN spreadsheet_id TEXT NOT NULL DEFAULT ''")
+        self._shards = {
+            row[0]: Shard(*row) for row in self._conn.execute(
+                "SELECT id, key, seq, title, worksheet_id, rows, spreadsheet_id FROM shards ORDER BY id"
+            )
+        }
+
+    def __len__(self):
+        return len(self._shards)
+
+    def all(self):
+        return list(self._shards.values())
+
+    def get(self, shard_id):
+        return self._shards[shard_id]
+
+    def by_title(self, title):
+        return next((shard for shard in self._shards.values() if shard.title == title), None)
+
+    # Последний лист ключа (в него идут новые строки)
+    def current(self, key):
+        return max((shard for shard in self._shards.values() if shard.key == key),
+                   key=lambda shard: shard.seq, default=None)
+
+    def add(self, key, seq, title, worksheet_id, rows, spreadsheet_id=""):
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO shards (key, seq, title, worksheet_id, rows, spreadsheet_id) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, seq, title, worksheet_id, rows, spreadsheet_id)
+            )
+        shard = self._shards[cursor.lastrowid] = Shard(cursor.lastrowid, key, seq, title, worksheet_id, rows,
+                                                       spreadsheet_id)
+        return shard
+
+    def add_rows(self, shard_id, count):
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE shards SET rows = rows + ? WHERE id = ?", (count, shard_id))
+        shard = self._shards[shard_id]
+        self._shards[shard_id] = shard._replace(rows=shard.rows + count)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# Значение колонки строки ("" для коротких строк из старого журнала)
+def _cell(row, field):
+    column = COLUMN[field]
+    return str(row[column]) if len(row) > column else ""
+
+
+# Хранилище, которое раскладывает новые строки по листам-шардам:
+# mode="month" - по месяцу отправки анкеты (колонка "Дата записи", поэтому
+# строки, записанные после смены месяца, попадают в лист своего месяца),
+# mode="hash" - по хэшу Telegram id пользователя (buckets листов). Когда в
+# листе набирается max_rows строк, для ключа создается следующий лист.
+# Первый лист основной таблицы (данные до включения шардов) по-прежнему
+# читается, но новые строки в него не пишутся.
+# Предел в 10 млн ячеек действует на всю таблицу, поэтому листы шардов
+# создаются в заранее созданных таблицах spreadsheets (по порядку, пока в
+# таблице хватает ячеек на лист из max_rows строк), а без них - в основной.
+# Каждый шард резервирует max_rows строк; если места нет ни в одной таблице,
+# запись завершается ShardCapacityError до того, как Google откажет в создании листа.
+class ShardedSheetsStorage(SheetsStorage):
+    def __init__(self, worksheet, index=None, header=None, mode="month", max_rows=100_000, buckets=16,
+                 spreadsheets=(), **kwargs):
+        if max_rows * len(header) > SPREADSHEET_CELL_LIMIT:
+            raise ValueError(f"A shard of {max_rows} rows x {len(header)} columns exceeds "
+                             f"the {SPREADSHEET_CELL_LIMIT} cell limit of a spreadsheet")
+        self.index = index
+        self.header = header
+        self.mode = mode
+        self.max_rows = max_rows
+        self.buckets = buckets
+        self.spreadsheets = list(spreadsheets) or [""]
+        self._worksheets = {}
+        self._spreadsheets = {}
+        # Ячейки листов таблицы, которые не являются шардами (первый лист и т.п.)
+        self._other_cells = {}
+        self._routing = asyncio.Lock()
+        super().__init__(worksheet, **kwargs)
+
+    # Объекты листов привязаны к соединению: после переподключения открываются заново
+    def invalidate_header(self):
+        super().invalidate_header()
+        self._worksheets = {}
+        self._spreadsheets = {}
+
+    def shard_key(self, row):
+        if self.mode == "hash":
+            return f"users-{zlib.crc32(_cell(row, 'user_id').encode()) % self.buckets:02d}"
+        # Строки без даты записи (из журнала прежней версии) - в лист текущего месяца
+        submitted = parse_date(_cell(row, "submitted_at")[:10])
+        if submitted is None:
+            return datetime.now().strftime("%Y-%m")
+        return f"{submitted[0]:04d}-{submitted[1]:02d}"
+
+    def shards(self):
+        return [(0, None)] + [(shard.base, shard.id) for shard in self.index.all()]
+
+    def partition(self, batch):
+        parts = {}
+        for item in batch:
+            parts.setdefault(self.shard_key(item[1]), []).append(item)
+        return list(parts.items())
+
+    async def _reconnect(self):
+        await super()._reconnect()
+        await self._discover()
+
+    # Листы шардов, которых нет в индексе (индекс потерян или создан другим
+    # экземпляром), и размер остальных листов каждой таблицы
+    async def _discover(self):
+        for spreadsheet_id in dict.fromkeys([""] + self.spreadsheets):
+            spreadsheet = await self._spreadsheet(spreadsheet_id)
+            other_cells = 0
+            for worksheet in await self._run(spreadsheet.worksheets):
+                key, seq = _TITLE.match(worksheet.title).groups()
+                if not _KEYS[self.mode].match(key):
+                    other_cells += worksheet.row_count * worksheet.col_count
+                elif self.index.by_title(worksheet.title) is None:
+                    # row_count - размер сетки листа, заполненные строки считаются по первой колонке
+                    rows = len(await self._run(worksheet.col_values, 1))
+                    self.index.add(key, int(seq or 1), worksheet.title, worksheet.id, rows, spreadsheet_id)
+                    logger.info("Found shard worksheet %s", worksheet.title)
+            self._other_cells[spreadsheet_id] = other_cells
+
+    # Таблица по id; "" - основная таблица (та, в которой первый лист)
+    async def _spreadsheet(self, spreadsheet_id):
+        if not spreadsheet_id:
+            return (await super()._worksheet_for(None)).spreadsheet
+        if spreadsheet_id not in self._spreadsheets:
+            await super()._worksheet_for(None)
+            self._spreadsheets[spreadsheet_id] = await self._run(self.client.open_spreadsheet, spreadsheet_id)
+        return self._spreadsheets[spreadsheet_id]
+
+    async def _worksheet_for(self, shard):
+        if shard is None:
+            return await super()._worksheet_for(None)
+        if shard not in self._worksheets:
+            spreadsheet = await self._spreadsheet(self.index.get(shard).spreadsheet_id)
+            self._worksheets[shard] = await self._run(
+                spreadsheet.get_worksheet_by_id, self.index.get(shard).worksheet_id
+            )
+        return self._worksheets[shard]
+
+    # Первая таблица, в которой хватит ячеек еще на один лист из max_rows строк
+    def _target_spreadsheet(self):
+        width = len(self.header)
+        for spreadsheet_id in self.spreadsheets:
+            reserved = sum(max(shard.rows, self.max_rows) * width for shard in self.index.all()
+                           if shard.spreadsheet_id == spreadsheet_id)
+            if self._other_cells.get(spreadsheet_id, 0) + reserved + self.max_rows * width <= SPREADSHEET_CELL_LIMIT:
+                return spreadsheet_id
+        raise ShardCapacityError(
+            f"No spreadsheet has room for another shard of {self.max_rows} rows x {width} columns "
+            f"({SPREADSHEET_CELL_LIMIT} cells per spreadsheet); add a spreadsheet to SHEETS_SHARD_SPREADSHEETS"
+        )
+
+    async def _create_shard(self, key, seq):
+        title = shard_title(key, seq)
+        spreadsheet_id = self._target_spreadsheet()
+        spreadsheet = await self._spreadsheet(spreadsheet_id)
+        try:
+            worksheet = await self._run(spreadsheet.add_worksheet, title, 1, len(self.header))
+        except gspread.exceptions.APIError:
+            # Лист мог быть создан, а индекс не обновлен
+            await self._discover()
+            if self.index.by_title(title) is None:
+                raise
+            return self.index.by_title(title)
+        await self._run(worksheet.append_row, self.header)
+        shard = self.index.add(key, seq, title, worksheet.id, 1, spreadsheet_id)
+        self._worksheets[shard.id] = worksheet
+        logger.info("Created shard worksheet %s", title)
+        return shard
+
+    async def append_rows(self, rows, key=None):
+        if key is None:
+            return await super().append_rows(rows)
+        async with self._routing:
+            shard = self.index.current(key)
+            # В пустой лист (только заголовок) пачка пишется целиком, даже если она больше max_rows
+            if shard is None or shard.rows > 1 and shard.rows + len(rows) > self.max_rows:
+                shard = await self._create_shard(key, 1 if shard is None else shard.seq + 1)
+        worksheet = await self._worksheet_for(shard.id)
+        response = await self._run(worksheet.append_rows, rows)
+        self.index.add_rows(shard.id, len(rows))
+        if response is not None:
+            response["lineBase"] = shard.base
+        return response
+
+    def close(self):
+        super().close()
+        self.index.close()
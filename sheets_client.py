@@ -0,0 +1,107 @@
+import time
+from datetime import datetime, timezone
+
+import gspread
+import requests
+from google.auth.transport.requests import AuthorizedSession, Request
+from google.oauth2.service_account import Credentials
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+# Предохранитель: после failure_threshold ошибок подряд запросы к Google не
+# выполняются reset_timeout секунд и сразу завершаются CircuitOpenError.
+# Затем пропускается один пробный запрос: успех закрывает предохранитель,
+# ошибка снова размыкает его. Вызывается только из цикла событий.
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    def before_call(self):
+        if self.opened_at is None:
+            return
+        remaining = self.opened_at + self.reset_timeout - time.monotonic()
+        if remaining > 0 or self._trial:
+            raise CircuitOpenError(f"Google Sheets unavailable, next attempt in {max(remaining, 0):.0f} s")
+        self._trial = True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    # Возвращает True, если предохранитель только что разомкнулся
+    def record_failure(self):
+        self.failures += 1
+        self._trial = False
+        if self.failures >= self.failure_threshold:
+            was_open = self.opened_at is not None
+            self.opened_at = time.monotonic()
+            return not was_open
+        return False
+
+
+# Подключение к таблице: ключ сервисного аккаунта, HTTP-сессия с пулом
+# keep-alive соединений (pool_size - по числу потоков, которые делают запросы)
+# и лист. Методы блокирующие, их вызывает SheetsStorage в своем пуле потоков.
+class SheetsClient:
+    def __init__(self, service_account_file, scopes, spreadsheet_id, pool_size=4, timeout=(5, 60)):
+        self.service_account_file = service_account_file
+        self.scopes = scopes
+        self.spreadsheet_id = spreadsheet_id
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.credentials = None
+        self.session = None
+        self.client = None
+        self.worksheet = None
+        # Отдельная сессия для обновления токена, чтобы соединение с сервером OAuth тоже переиспользовалось
+        self._token_session = requests.Session()
+
+    # Новая сессия и лист; токен получается сразу, а не в первом запросе
+    def open(self):
+        credentials = Credentials.from_service_account_file(self.service_account_file, scopes=self.scopes)
+        credentials.refresh(Request(self._token_session))
+        session = AuthorizedSession(credentials)
+        session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size))
+        try:
+            client = gspread.Client(None, session=session)
+            client.set_timeout(self.timeout)
+            worksheet = client.open_by_key(self.spreadsheet_id).sheet1
+        except Exception:
+            session.close()
+            raise
+        previous = self.session
+        self.credentials, self.session, self.client, self.worksheet = credentials, session, client, worksheet
+        if previous is not None:
+            previous.close()
+        return worksheet
+
+    # Другая таблица через то же соединение (листы шардов в дополнительных таблицах)
+    def open_spreadsheet(self, spreadsheet_id):
+        return self.client.open_by_key(spreadsheet_id)
+
+    # Сколько секунд осталось до истечения токена
+    def token_ttl(self):
+        if self.credentials is None or self.credentials.expiry is None:
+            return 0.0
+        expiry = self.credentials.expiry.replace(tzinfo=timezone.utc)
+        return (expiry - datetime.now(timezone.utc)).total_seconds()
+
+    def refresh_token(self):
+        self.credentials.refresh(Request(self._token_session))
+
+    # Самый легкий запрос к таблице: держит соединение открытым и проверяет доступ
+    def ping(self):
+        return self.worksheet.spreadsheet.fetch_sheet_metadata(params={"fields": "spreadsheetId"})
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+        self._token_session.close()
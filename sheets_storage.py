@@ -0,0 +1,179 @@
+import asyncio
+import functools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import gspread
+import requests
+from google.auth.exceptions import GoogleAuthError
+
+from backends import RowStorage
+from metrics import REGISTRY
+from sheets_client import CircuitBreaker, CircuitOpenError, SheetsClient
+
+logger = logging.getLogger(__name__)
+
+
+# Ошибка, после которой соединение открывается заново: сеть, авторизация
+def _needs_reconnect(error):
+    if isinstance(error, gspread.exceptions.APIError):
+        return error.code == 401
+    return isinstance(error, (requests.RequestException, GoogleAuthError, OSError))
+
+
+# Неблокирующий слой доступа к Google Sheets.
+# gspread делает синхронные HTTP-запросы, поэтому каждый вызов уходит
+# в ограниченный пул потоков и не останавливает цикл событий бота.
+# Если задан client (SheetsClient), после сетевой ошибки или ошибки
+# авторизации лист открывается заново при следующем вызове, а после
+# нескольких ошибок подряд предохранитель (breaker) на время отключает запросы.
+class SheetsStorage(RowStorage):
+    def __init__(self, worksheet, max_workers=4, client=None, breaker=None):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sheets")
+        self.client = client
+        self.breaker = breaker or CircuitBreaker()
+        self._reconnect_lock = asyncio.Lock()
+        self._last_request = time.monotonic()
+        self.worksheet = worksheet
+
+    # Смена листа (переподключение, пересоздание таблицы) сбрасывает кэш заголовка
+    @property
+    def worksheet(self):
+        return self._worksheet
+
+    @worksheet.setter
+    def worksheet(self, worksheet):
+        self._worksheet = worksheet
+        self.invalidate_header()
+
+    def invalidate_header(self):
+        self._header_present = False
+
+    # Подключение к таблице (авторизация и открытие листа тоже блокирующие).
+    # Если Google сейчас недоступен, хранилище все равно создается и
+    # подключится при первом запросе; ошибка первого подключения возвращается
+    # вторым значением.
+    @classmethod
+    async def connect(cls, service_account_file, scopes, spreadsheet_id, max_workers=4, breaker=None, **kwargs):
+        client = SheetsClient(service_account_file, scopes, spreadsheet_id, pool_size=max_workers)
+        storage = cls(None, max_workers=max_workers, client=client, breaker=breaker, **kwargs)
+        try:
+            await storage._reconnect()
+        except Exception as e:
+            return storage, e
+        return storage, None
+
+    # Время вызова считается вместе с ожиданием свободного потока в пуле
+    async def _run(self, func, *args, **kwargs):
+        self.breaker.before_call()
+        loop = asyncio.get_running_loop()
+        method = getattr(func, "__name__", "call")
+        started = time.perf_counter()
+        try:
+            result = await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+        except Exception as e:
+            REGISTRY.counter("sheets_request_errors_total", method=method).inc()
+            if self.breaker.record_failure():
+                REGISTRY.counter("sheets_circuit_open_total").inc()
+                logger.error("Google Sheets failed %s times in a row, pausing requests for %.0f s",
+                             self.breaker.failures, self.breaker.reset_timeout)
+            if self.client is not None and _needs_reconnect(e):
+                self.worksheet = None
+            raise
+        finally:
+            self._last_request = time.monotonic()
+            REGISTRY.histogram("sheets_request_seconds", method=method).observe(time.perf_counter() - started)
+        self.breaker.record_success()
+        return result
+
+    async def _reconnect(self):
+        async with self._reconnect_lock:
+            if self.worksheet is None:
+                self.worksheet = await self._run(self.client.open)
+                REGISTRY.counter("sheets_connects_total").inc()
+                logger.info("Connected to Google Sheets")
+
+    # Лист шарда shard; лист открывается заново, если соединение было потеряно.
+    # У хранилища без шардов лист один.
+    async def _worksheet_for(self, shard):
+        if self.worksheet is None and self.client is not None:
+            await self._reconnect()
+        return self.worksheet
+
+    async def _sheet(self, method, *args, shard=None):
+        worksheet = await self._worksheet_for(shard)
+        return await self._run(getattr(worksheet, method), *args)
+
+    async def get_all_values(self):
+        return await self._sheet("get_all_values")
+
+    # Число заполненных строк листа (вместе с заголовком): читается одна колонка
+    async def count_rows(self, shard=None):
+        return len(await self._sheet("col_values", 1, shard=shard))
+
+    # Строки с first по last включительно
+    async def get_rows(self, first, last, shard=None):
+        return await self._sheet("get", f"{first}:{last}", shard=shard)
+
+    async def append_row(self, row):
+        try:
+            return await self._sheet("append_row", row)
+        except Exception:
+            self.invalidate_header()
+            raise
+
+    async def append_rows(self, rows, key=None):
+        try:
+            return await self._sheet("append_rows", rows)
+        except Exception:
+            self.invalidate_header()
+            raise
+
+    # Создает строку заголовков, если ее нет, и дописывает новые колонки в
+    # заголовок, созданный прежней версией бота. Результат кэшируется, поэтому
+    # повторные вызовы ничего не стоят, а проверка читает только первую строку,
+    # а не весь лист.
+    async def ensure_header(self, header):
+        if self._header_present:
+            return
+        if self.worksheet is None and self.client is not None:
+            await self._reconnect()
+        worksheet = self.worksheet
+        current = await self._run(worksheet.row_values, 1)
+        if not current:
+            await self._run(worksheet.append_row, header)
+        elif len(current) < len(header) and current == header[:len(current)]:
+            await self._run(worksheet.update, [header], "A1")
+        if worksheet is self.worksheet:
+            self._header_present = True
+
+    # Фоновое обслуживание подключения, чтобы запросы бота не ждали ни
+    # обновления токена, ни установки TLS-соединения: токен обновляется за
+    # refresh_margin секунд до истечения, а если запросов не было
+    # keepalive_interval секунд, отправляется легкий запрос к таблице.
+    # Он же переподключается после сбоя и пробует закрыть предохранитель.
+    async def maintain_forever(self, refresh_margin=600, keepalive_interval=120, check_interval=30):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(check_interval)
+            if self.client is None:
+                continue
+            try:
+                if self.worksheet is None:
+                    await self._reconnect()
+                elif self.client.token_ttl() < refresh_margin:
+                    await loop.run_in_executor(self._executor, self.client.refresh_token)
+                    REGISTRY.counter("sheets_token_refresh_total").inc()
+                    logger.info("Refreshed Google Sheets access token")
+                elif time.monotonic() - self._last_request >= keepalive_interval:
+                    await self._run(self.client.ping)
+            except CircuitOpenError:
+                pass
+            except Exception as e:
+                logger.error("Google Sheets connection maintenance failed: %s", e)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        if self.client is not None:
+            self.client.close()
@@ -0,0 +1,72 @@
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backends import InMemoryStorage
+from outbox import Outbox
+from write_queue import WriteBehindQueue
+
+
+# Хранилище с задержкой записи, сообщает о начале каждой отправки
+class SlowStorage(InMemoryStorage):
+    def __init__(self, delay):
+        super().__init__()
+        self.delay = delay
+        self.started = asyncio.Event()
+
+    async def append_rows(self, rows, key=None):
+        self.started.set()
+        await asyncio.sleep(self.delay)
+        return await super().append_rows(rows, key)
+
+
+# stop() с ограничением по времени; ожидание не отменяет stop(), чтобы
+# зависание не маскировалось проглоченной отменой
+async def stop_within(queue, timeout):
+    task = asyncio.create_task(queue.stop())
+    done, _ = await asyncio.wait([task], timeout=timeout)
+    if not done:
+        task.cancel()
+        return False
+    task.result()
+    return True
+
+
+class WriteBehindQueueStopTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.outbox = Outbox(os.path.join(self.directory.name, "outbox.sqlite3"))
+
+    async def asyncTearDown(self):
+        self.outbox.close()
+        self.directory.cleanup()
+
+    # stop() во время отправки пачки, когда в журнале еще не меньше max_batch строк,
+    # должен дождаться ее, дописать остальное и завершиться
+    async def test_stop_during_flush(self):
+        storage = SlowStorage(delay=0.05)
+        queue = WriteBehindQueue(storage, ["h"], self.outbox, max_batch=50, flush_interval=0.5,
+                                 max_request_rows=50)
+        await queue.start()
+        for i in range(200):
+            await queue.put([[str(i)]])
+        await asyncio.wait_for(storage.started.wait(), 5)
+        self.assertTrue(await stop_within(queue, 2))
+        self.assertEqual([row[0] for row in storage.rows], [str(i) for i in range(200)])
+        self.assertEqual(len(self.outbox), 0)
+
+    async def test_stop_while_idle(self):
+        storage = InMemoryStorage()
+        queue = WriteBehindQueue(storage, ["h"], self.outbox, max_batch=50, flush_interval=0.5)
+        await queue.start()
+        await queue.put([["a"]])
+        self.assertTrue(await stop_within(queue, 2))
+        self.assertEqual(storage.rows, [["a"]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+import logging
+import time
+from collections import OrderedDict
+
+from aiogram import BaseMiddleware
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+
+# Состояние одного пользователя: корзина токенов и последнее принятое сообщение
+class _Bucket:
+    __slots__ = ("tokens", "updated", "fingerprint", "accepted_at", "warned")
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated = now
+        self.fingerprint = None
+        self.accepted_at = 0.0
+        self.warned = False
+
+
+# Содержимое сообщения для поиска повторов: текст, подпись или файл
+def _fingerprint(message):
+    if message.text is not None:
+        return message.text
+    if message.document is not None:
+        return message.document.file_unique_id
+    return message.caption
+
+
+# Ограничение частоты сообщений от одного пользователя (корзина токенов:
+# burst сообщений подряд, дальше rate сообщений в секунду).
+# Повтор того же сообщения в течение duplicate_window секунд в одном из
+# состояний FSM duplicate_states (None - в любом) отбрасывается без обработки
+# и не расходует токены - так склеиваются многократные нажатия одной кнопки;
+# на каждый отброшенный повтор отправляется duplicate_notice. В остальных
+# состояниях одинаковые ответы подряд обычны ("-", "Назад") и обрабатываются.
+# Лишние сообщения тоже отбрасываются, пользователю один раз
+# отправляется warning. Хранится не больше max_users последних пользователей.
+# rate=0 отключает ограничение частоты, duplicate_window=0 - отбрасывание повторов.
+class ThrottlingMiddleware(BaseMiddleware):
+    def __init__(self, rate=1.0, burst=5, duplicate_window=1.0, warning=None, duplicate_states=None,
+                 duplicate_notice=None, max_users=100_000, registry=REGISTRY):
+        self.rate = rate
+        self.burst = burst
+        self.duplicate_window = duplicate_window
+        self.warning = warning
+        self.duplicate_states = duplicate_states
+        self.duplicate_notice = duplicate_notice
+        self.max_users = max_users
+        self.registry = registry
+        self._buckets = OrderedDict()
+
+    def _bucket(self, user_id, now):
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = _Bucket(self.burst, now)
+            if len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(user_id)
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+        return bucket
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+
+        now = time.monotonic()
+        bucket = self._bucket(user.id, now)
+        fingerprint = _fingerprint(event)
+        if (fingerprint is not None and fingerprint == bucket.fingerprint
+                and now - bucket.accepted_at < self.duplicate_window
+                and (self.duplicate_states is None or data.get("raw_state") in self.duplicate_states)):
+            logger.debug("Dropped duplicate message from user %s", user.id)
+            self.registry.counter("bot_updates_dropped_total", reason="duplicate").inc()
+            if self.duplicate_notice is not None:
+                await event.answer(self.duplicate_notice)
+            return None
+
+        if self.rate and bucket.tokens < 1:
+            logger.debug("Throttled message from user %s", user.id)
+            self.registry.counter("bot_updates_dropped_total", reason="throttled").inc()
+            if self.warning is not None and not bucket.warned:
+                bucket.warned = True
+                await event.answer(self.warning)
+            return None
+
+        bucket.tokens -= 1
+        bucket.warned = False
+        bucket.fingerprint = fingerprint
+        bucket.accepted_at = now
+        return await handler(event, data)
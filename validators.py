@@ -0,0 +1,66 @@
+import re
+
+# Шаблоны компилируются один раз при импорте
+EMAIL_RE = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+PHONE_RE = re.compile(r'^(?:\+7|7|8)?[\s\-]?\(?(\d{3})\)?[\s\-]?(\d{3})[\s\-]?(\d{2})[\s\-]?(\d{2})$')
+NUMBER_RE = re.compile(r'^[+-]?\d+(?:\.\d+)?$')
+
+# Разделители разрядов, которые пользователи ставят в числах: "1 250,50"
+_THOUSANDS = (' ', '\u00a0', '\u202f', "'")
+_DAYS_IN_MONTH = (0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+
+def is_valid_email(email):
+    return EMAIL_RE.match(email) is not None
+
+
+# Телефон в едином виде +7XXXXXXXXXX или None, если номер не распознан
+def normalize_phone(phone):
+    match = PHONE_RE.match(phone)
+    if match is None:
+        return None
+    return '+7%s%s%s%s' % match.groups()
+
+
+# Дата строго в формате ДД.ММ.ГГГГ -> (год, месяц, день) или None.
+# Разбор по позициям символов без strptime и исключений.
+def parse_date(text):
+    if len(text) != 10 or text[2] != '.' or text[5] != '.':
+        return None
+    digits = text[:2] + text[3:5] + text[6:]
+    if not (digits.isascii() and digits.isdigit()):
+        return None
+    day, month, year = int(digits[:2]), int(digits[2:4]), int(digits[4:])
+    if not 1 <= month <= 12 or year < 1:
+        return None
+    days = _DAYS_IN_MONTH[month]
+    if month == 2 and year % 4 == 0 and (year % 100 != 0 or year % 400 == 0):
+        days = 29
+    if not 1 <= day <= days:
+        return None
+    return year, month, day
+
+
+def is_valid_date(text):
+    return parse_date(text) is not None
+
+
+# Число в записи, привычной пользователям: "1250,50", "1 250.5", "1.250,50".
+# Если в числе есть и точка, и запятая, десятичный разделитель - последний из них.
+# Бросает ValueError, в том числе для nan и inf, которые принимает float().
+def parse_number(text):
+    # Обычный случай - цифры и, возможно, одна точка
+    if text.isascii() and text.replace('.', '', 1).isdigit():
+        return float(text)
+    text = text.strip()
+    for separator in _THOUSANDS:
+        if separator in text:
+            text = text.replace(separator, '')
+    if ',' in text:
+        if '.' in text and text.rfind('.') > text.rfind(','):
+            text = text.replace(',', '')
+        else:
+            text = text.replace('.', '').replace(',', '.')
+    if NUMBER_RE.match(text) is None:
+        raise ValueError
+    return float(text)
@@ -0,0 +1,35 @@
+import asyncio
+
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+
+# aiohttp-приложение, которое принимает апдейты Telegram и передает их
+# тому же Dispatcher, что и режим long polling
+def create_webhook_app(dp, bot, path, secret_token=None):
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=secret_token).register(app, path=path)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+# Регистрирует вебхук в Telegram и обслуживает его до остановки бота
+async def run_webhook(dp, bot, base_url, path, host, port, secret_token=None):
+    app = create_webhook_app(dp, bot, path, secret_token)
+    await serve_webhook(app, bot, base_url, path, host, port, secret_token, dp.resolve_used_update_types())
+
+
+async def serve_webhook(app, bot, base_url, path, host, port, secret_token=None, allowed_updates=None):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        await bot.set_webhook(
+            f"{base_url.rstrip('/')}{path}",
+            secret_token=secret_token,
+            allowed_updates=allowed_updates
+        )
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import multiprocessing
+import signal
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+
+# Пользователь, от которого пришел апдейт (или чат, если пользователя нет).
+# По нему апдейты распределяются между процессами: все сообщения одного
+# пользователя попадают в один процесс и обрабатываются по порядку.
+def shard_key(update):
+    for key, event in update.items():
+        if key == "update_id" or not isinstance(event, dict):
+            continue
+        if isinstance(event.get("from"), dict):
+            return event["from"]["id"]
+        if isinstance(event.get("chat"), dict):
+            return event["chat"]["id"]
+    return 0
+
+
+def _worker_entry(target, index, queue, args):
+    # Остановкой управляет главный процесс через очередь
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    target(index, queue, *args)
+
+
+# Главный процесс: получает апдейты и раскладывает их по очередям рабочих процессов.
+# target(index, queue, *args) запускается в каждом рабочем процессе.
+class UpdateRouter:
+    def __init__(self, workers, target, args=()):
+        context = multiprocessing.get_context("spawn")
+        self.queues = [context.Queue() for _ in range(workers)]
+        self.processes = [
+            context.Process(target=_worker_entry, args=(target, index, queue, args), name=f"bot-worker-{index}")
+            for index, queue in enumerate(self.queues)
+        ]
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+        logger.info("Started %s bot workers", len(self.processes))
+
+    def dispatch(self, update):
+        self.queues[shard_key(update) % len(self.queues)].put(update)
+
+    # Рабочие процессы дорабатывают уже полученные апдейты и завершаются
+    async def stop(self):
+        for queue in self.queues:
+            queue.put(None)
+        for process in self.processes:
+            await asyncio.to_thread(process.join)
+
+
+# Рабочий процесс: обрабатывает апдейты параллельно, но для каждого
+# пользователя строго в порядке поступления
+async def serve_shard(queue, handle):
+    loop = asyncio.get_running_loop()
+    tails = {}
+
+    async def process(previous, update):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await handle(update)
+        except Exception as e:
+            logger.error("Failed to process update %s: %s", update.get('update_id'), e)
+
+    def forget(user_id, task):
+        if tails.get(user_id) is task:
+            del tails[user_id]
+
+    while True:
+        update = await loop.run_in_executor(None, queue.get)
+        if update is None:
+            break
+        user_id = shard_key(update)
+        task = asyncio.create_task(process(tails.get(user_id), update))
+        tails[user_id] = task
+        task.add_done_callback(lambda t, user_id=user_id: forget(user_id, t))
+
+    if tails:
+        await asyncio.wait(list(tails.values()))
+
+
+# Получение апдейтов главным процессом через long polling
+async def poll_updates(bot, router, allowed_updates=None, timeout=30):
+    offset = None
+    failures = 0
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=timeout, allowed_updates=allowed_updates)
+            failures = 0
+        except Exception as e:
+            delay = min(2 ** failures, 60)
+            failures += 1
+            logger.error("Failed to fetch updates, retrying in %s s: %s", delay, e)
+            await asyncio.sleep(delay)
+            continue
+        for update in updates:
+            router.dispatch(update.model_dump(mode="json", by_alias=True, exclude_none=True))
+            offset = update.update_id + 1
+
+
+# Получение апдейтов главным процессом через вебхук
+def create_gateway_app(router, path, secret_token=None):
+    async def handle(request):
+        if secret_token and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret_token:
+            return web.Response(status=401)
+        router.dispatch(await request.json())
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(path, handle)
+    return app
@@ -0,0 +1,142 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# Очередь отложенной записи в хранилище анкет (Google Sheets, база SQL и т.п.).
+# Обработчики только записывают строки в локальный журнал (Outbox), а фоновая
+# задача отправляет их одним запросом append_rows, как только набралось
+# max_batch строк или прошло flush_interval секунд с момента появления первой
+# строки в пачке. Если Google недоступен, отправка повторяется с
+# экспоненциальной задержкой, а строки остаются в журнале.
+# Если в журнал пишут и другие процессы, poll_interval задает, как часто
+# проверять его на новые строки.
+# Одним запросом отправляется не больше max_request_rows строк, поэтому
+# большой импорт или накопившийся за время сбоя журнал уходит целиком.
+# Отправленные строки дописываются в локальную копию листа (mirror), если она есть.
+class WriteBehindQueue:
+    def __init__(self, storage, header, outbox, max_batch=50, flush_interval=0.5,
+                 retry_delay=1.0, max_retry_delay=300.0, poll_interval=None, mirror=None,
+                 max_request_rows=10_000):
+        self.storage = storage
+        self.header = header
+        self.outbox = outbox
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.poll_interval = poll_interval
+        self.mirror = mirror
+        self.max_request_rows = max_request_rows
+        self._pending = 0
+        self._not_empty = asyncio.Event()
+        self._batch_full = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._stopping = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return self._pending
+
+    # Запускает отправку, в том числе строк, оставшихся в журнале с прошлого запуска
+    async def start(self):
+        self._pending = await asyncio.to_thread(len, self.outbox)
+        if self._pending:
+            logger.info("Found %s unsent rows in outbox", self._pending)
+        self._update_events()
+        self._stopping.clear()
+        self._task = asyncio.create_task(self._run())
+
+    # Строки считаются принятыми, как только записаны в журнал на диске.
+    # key - ключ идемпотентности: повтор с тем же ключом не записывается и возвращает False.
+    async def put(self, rows, key=None):
+        if not await asyncio.to_thread(self.outbox.append, rows, key):
+            return False
+        self._pending += len(rows)
+        self._update_events()
+        return True
+
+    # Ждет event или остановки очереди не дольше timeout (None - без ограничения).
+    # Возвращает False, если время вышло.
+    async def _wait(self, event, timeout):
+        waiters = [asyncio.ensure_future(event.wait()), asyncio.ensure_future(self._stopping.wait())]
+        try:
+            done, _ = await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for waiter in waiters:
+                waiter.cancel()
+        return bool(done)
+
+    # Цикл останавливается по событию _stopping, а не отменой задачи: в Python 3.11
+    # asyncio.wait_for проглатывает отмену, если ожидаемое событие уже наступило
+    async def _run(self):
+        failures = 0
+        while not self._stopping.is_set():
+            if not await self._wait(self._not_empty, self.poll_interval):
+                self._pending = await asyncio.to_thread(len, self.outbox)
+                self._update_events()
+                continue
+            await self._wait(self._batch_full, self.flush_interval)
+            if self._stopping.is_set():
+                break
+            try:
+                await self.flush()
+                failures = 0
+            except Exception as e:
+                delay = min(self.retry_delay * 2 ** failures, self.max_retry_delay)
+                failures += 1
+                logger.error("Failed to flush rows to %s (%s pending), retrying in %.1f s: %s",
+                             type(self.storage).__name__, self._pending, delay, e)
+                await self._wait(self._stopping, delay)
+
+    # Отправляет одну пачку из журнала и удаляет ее оттуда после успеха
+    async def flush(self):
+        async with self._flush_lock:
+            batch = await asyncio.to_thread(self.outbox.peek, self.max_request_rows)
+            if not batch:
+                self._pending = 0
+                self._update_events()
+                return
+            await self.storage.ensure_header(self.header)
+            # Строки разных шардов уходят разными запросами; каждая часть
+            # удаляется из журнала сразу после записи, чтобы при сбое на
+            # следующей части не отправить ее повторно
+            for key, part in self.storage.partition(batch):
+                rows = [row for _, row in part]
+                response = await self.storage.append_rows(rows, key)
+                await asyncio.to_thread(self.outbox.ack, [row_id for row_id, _ in part])
+                if self.mirror is not None:
+                    # Строки уже в листе: ошибка копии не должна приводить к повторной отправке
+                    try:
+                        await asyncio.to_thread(self.mirror.store_appended, response, rows)
+                    except Exception as e:
+                        logger.error("Failed to store flushed rows in local mirror: %s", e)
+            self._pending = await asyncio.to_thread(len, self.outbox)
+            self._update_events()
+            logger.info("Flushed %s rows to %s", len(batch), type(self.storage).__name__)
+
+    def _update_events(self):
+        if self._pending:
+            self._not_empty.set()
+        else:
+            self._not_empty.clear()
+        if self._pending >= self.max_batch:
+            self._batch_full.set()
+        else:
+            self._batch_full.clear()
+
+    # Останавливает фоновую задачу и пытается дописать все, что осталось.
+    # Неотправленные строки остаются в журнале до следующего запуска.
+    async def stop(self):
+        if self._task is not None:
+            # Пачка, которая уже отправляется, дописывается до конца
+            self._stopping.set()
+            await self._task
+            self._task = None
+        while self._pending:
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("%s rows left in outbox on shutdown: %s", self._pending, e)
+                break